@@ -1,5 +1,18 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
 
 
 class GreenhouseConfig(AppConfig):
     name = 'greenhouse'
+
+    def ready(self):
+        from greenhouse.database import configure_connection
+        from greenhouse.graphql_cache import invalidate_catalog
+        from greenhouse.models import Device, Installation
+
+        connection_created.connect(configure_connection, dispatch_uid='configure-connection')
+
+        for model in (Device, Installation):
+            post_save.connect(invalidate_catalog, sender=model, dispatch_uid=f'catalog-save-{model.__name__}')
+            post_delete.connect(invalidate_catalog, sender=model, dispatch_uid=f'catalog-delete-{model.__name__}')
@@ -0,0 +1,225 @@
+"""
+Bulk import of transmission dumps, CSV or NDJSON files (optionally
+gzipped) with the columns written by the export endpoint. HC-SR04 dumps
+are told apart by their `mac` column; `timestamp_receive` defaults to
+`timestamp_origin` for readings buffered by the devices. Unknown MACs
+are registered as devices, as the live ingest does.
+"""
+import csv
+import gzip
+import json
+import math
+from collections import Counter
+from django.db import models, transaction
+from greenhouse.models import ESPTransmission, SensorHCSR04
+from greenhouse.timeseries import DEVICE_COLUMNS, SENSOR_FIELDS, insert_transmissions
+
+
+class ImportStats:
+    def __init__(self, path=None):
+        self.path = path
+        self.rows = 0
+        self.imported = 0
+        self.duplicates = 0
+        self.invalid = 0
+        # (model name, Device) -> earliest imported timestamp_origin
+        self.since = {}
+        self.errors = Counter()
+
+    def merge(self, other):
+        self.rows += other.rows
+        self.imported += other.imported
+        self.duplicates += other.duplicates
+        self.invalid += other.invalid
+        self.errors.update(other.errors)
+        for key, since in other.since.items():
+            self.since[key] = min(since, self.since.get(key, since))
+
+
+def dump_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith(('.ndjson', '.jsonl', '.json')):
+        return 'ndjson'
+    raise ValueError(f'Unknown dump format of {path}, expected .csv or .ndjson')
+
+
+def read_dump(path):
+    """
+    Yield the rows of a dump as dicts.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', newline='', encoding='utf-8') as dump:
+        if dump_format(path) == 'csv':
+            yield from csv.DictReader(dump)
+            return
+        for line in dump:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+
+
+def detect_model(row):
+    if 'mac_address' in row:
+        return ESPTransmission
+    if 'mac' in row:
+        return SensorHCSR04
+    raise ValueError('Cannot tell the transmission type, no mac_address nor mac column')
+
+
+def _integer(value):
+    if isinstance(value, bool):
+        raise ValueError(f'Invalid integer {value!r}')
+    if isinstance(value, int):
+        return value
+    number = float(value)
+    if not number.is_integer():
+        raise ValueError(f'Invalid integer {value!r}')
+    return int(number)
+
+
+def _float(value):
+    if isinstance(value, bool):
+        raise ValueError(f'Invalid number {value!r}')
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f'Invalid number {value!r}')
+    return number
+
+
+def _string(value):
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(f'Invalid string {value!r}')
+    return value.strip()
+
+
+def row_cleaner(model, devices):
+    """
+    Return a function turning a dump row into an unsaved `model` instance
+    linked to its Device from the `devices` registry, raising ValueError
+    on missing or invalid values.
+    """
+    device_column = DEVICE_COLUMNS[model][0]
+    converters = []
+    for field in model._meta.concrete_fields:
+        if field.primary_key:
+            continue
+        if field.is_relation:
+            device_field = DEVICE_COLUMNS[model][1]
+            convert = _integer if isinstance(device_field, models.IntegerField) else _string
+            converters.append((device_column, convert))
+        elif isinstance(field, models.IntegerField):
+            converters.append((field.attname, _integer))
+        elif isinstance(field, models.FloatField):
+            converters.append((field.attname, _float))
+        else:
+            converters.append((field.attname, _string))
+
+    def clean(row):
+        if not isinstance(row, dict):
+            raise ValueError('Invalid row')
+        values = []
+        device = None
+        for name, convert in converters:
+            value = row.get(name)
+            if (value is None or value == '') and name == 'timestamp_receive':
+                value = row.get('timestamp_origin')
+            if value is None or value == '':
+                raise ValueError(f'Missing {name}')
+            try:
+                value = convert(value)
+            except (TypeError, ValueError):
+                raise ValueError(f'Invalid {name}')
+            if name == device_column:
+                device = devices.get(model, value)
+                value = device.pk
+            values.append(value)
+        # positional arguments are much cheaper than keywords for the model
+        # constructor, in concrete field order with the primary key first
+        instance = model(None, *values)
+        instance.device = device
+        return instance
+
+    return clean
+
+
+def _insert(model, instances, stats, devices):
+    """
+    Insert the instances whose (device, timestamp_origin) is neither
+    already stored nor repeated within the chunk, linked again to their
+    Device through the `devices` registry.
+    """
+    keys = {}
+    for instance in instances:
+        key = (instance.device_id, instance.timestamp_origin)
+        if key in keys:
+            stats.duplicates += 1
+        else:
+            keys[key] = instance
+
+    instances = list(keys.values())
+    devices.assign(model, instances)
+    with transaction.atomic():
+        # rows already stored, or stored by the live ingest meanwhile,
+        # are skipped
+        new = insert_transmissions(model, instances, batch_size=2000)
+    stats.duplicates += len(instances) - len(new)
+    stats.imported += len(new)
+
+    for instance in new:
+        key = (model.__name__, instance.device)
+        stats.since[key] = min(instance.timestamp_origin, stats.since.get(key, instance.timestamp_origin))
+
+
+def import_dump(path, chunk_size=10000, max_errors=None):
+    """
+    Import a dump in chunks of `chunk_size` rows, one transaction each.
+    Rollups are not updated, see `refresh_derived`. Raises ValueError
+    after more than `max_errors` invalid rows.
+    """
+    from greenhouse.ingest import DeviceRegistry
+
+    stats = ImportStats(path)
+    devices = DeviceRegistry()
+    model = None
+    clean = None
+    chunk = []
+    for row in read_dump(path):
+        stats.rows += 1
+        try:
+            if model is None:
+                model = detect_model(row)
+                clean = row_cleaner(model, devices)
+            chunk.append(clean(row))
+        except ValueError as e:
+            stats.invalid += 1
+            stats.errors[str(e)] += 1
+            if max_errors is not None and stats.invalid > max_errors:
+                raise ValueError(f'{path}: too many invalid rows, last at row {stats.rows}: {e}')
+            continue
+
+        if len(chunk) >= chunk_size:
+            _insert(model, chunk, stats, devices)
+            chunk = []
+
+    if chunk:
+        _insert(model, chunk, stats, devices)
+    return stats
+
+
+def refresh_derived(stats, rollups=True):
+    """
+    Bring caches, and rollups unless `rollups` is False, up to date with
+    the imported transmissions.
+    """
+    from greenhouse.graphql_cache import invalidate_history
+    from greenhouse.rollups import rebuild_rollups
+
+    if rollups:
+        models_by_name = {model.__name__: model for model in SENSOR_FIELDS}
+        for (model_name, device), since in stats.since.items():
+            rebuild_rollups(models_by_name[model_name], device=device, since=since)
+    invalidate_history(device.device_id for _, device in stats.since)
@@ -0,0 +1,176 @@
+"""
+Helpers shared by the benchmark management commands.
+
+Benchmarks never touch the configured database: they run against a
+throwaway test database created with the same migrations.
+"""
+import math
+import random
+from contextlib import contextmanager
+from time import perf_counter
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from greenhouse.models import Device, ESPTransmission, Installation, SensorHCSR04
+
+
+@contextmanager
+def scratch_database(alias=DEFAULT_DB_ALIAS):
+    """
+    Create a migrated test database for `alias`, yield its connection and
+    destroy it afterwards.
+    """
+    connection = connections[alias]
+    old_name = connection.creation.create_test_db(
+        verbosity=0,
+        autoclobber=True,
+        serialize=False
+    )
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def device_macs(devices):
+    return [
+        ':'.join(f'{(i >> shift) & 0xff:02X}' for shift in (40, 32, 24, 16, 8, 0))
+        for i in range(1, devices + 1)
+    ]
+
+
+def esp_readings(device, start, count, step=60, seed=None):
+    """
+    Generate `count` ESPTransmission instances of `device` every `step`
+    seconds, following a daily cycle with some noise. `device` may be
+    unsaved, `bulk_insert` links the instances to the stored one.
+    """
+    rand = random.Random(seed if seed is not None else device.device_id)
+    phase = rand.uniform(0, 2 * math.pi)
+    for i in range(count):
+        timestamp = start + i * step
+        day = math.sin(2 * math.pi * (timestamp % 86400) / 86400 + phase)
+        yield ESPTransmission(
+            timestamp_origin=timestamp,
+            timestamp_receive=timestamp + rand.randint(0, 2),
+            device=device,
+            ldr_sensor=max(0.0, 1800 + 1600 * day + rand.gauss(0, 60)),
+            temperature_sensor=24 + 6 * day + rand.gauss(0, 0.3),
+            pressure=1013 + 4 * math.sin(timestamp / 43200) + rand.gauss(0, 0.2),
+            moisture=min(100.0, max(0.0, 55 - 15 * day + rand.gauss(0, 1.5))),
+        )
+
+
+def hcsr04_readings(device, start, count, step=60, seed=None):
+    rand = random.Random(seed if seed is not None else device.device_id)
+    for i in range(count):
+        timestamp = start + i * step
+        yield SensorHCSR04(
+            timestamp_origin=timestamp,
+            timestamp_receive=timestamp + rand.randint(0, 2),
+            device=device,
+            distance=max(2.0, 120 + 40 * math.sin(timestamp / 7200) + rand.gauss(0, 2)),
+        )
+
+
+def bulk_insert(model, instances, chunk_size=10000):
+    """
+    Insert an iterable of instances in chunks, linked to their devices
+    (registered if unknown), returning the row count.
+    """
+    from greenhouse.ingest import DeviceRegistry
+
+    devices = DeviceRegistry()
+    total = 0
+    chunk = []
+    for instance in instances:
+        chunk.append(instance)
+        if len(chunk) >= chunk_size:
+            devices.assign(model, chunk)
+            model.objects.bulk_create(chunk, batch_size=chunk_size)
+            total += len(chunk)
+            chunk = []
+    if chunk:
+        devices.assign(model, chunk)
+        model.objects.bulk_create(chunk, batch_size=chunk_size)
+        total += len(chunk)
+    return total
+
+
+def seed_dataset(esp_devices, hcsr04_devices, transmissions, start=1668000000,
+                 step=60):
+    """
+    Create installed ESP devices and HC-SR04 devices with `transmissions`
+    readings each, plus their rollups. Returns the ESP macs, the HC-SR04
+    ids and the (start, end) timestamps of the readings.
+    """
+    from greenhouse.rollups import rebuild_rollups
+
+    macs = device_macs(esp_devices)
+    hcsr04_ids = [str(i) for i in range(1, hcsr04_devices + 1)]
+    Device.objects.bulk_create(
+        [Device(hardware_type='esp', device_id=mac, description='') for mac in macs]
+        + [Device(hardware_type='hcsr04_device', device_id=i, description='') for i in hcsr04_ids]
+    )
+    # primary keys are not set by bulk_create on every backend
+    devices = Device.objects.filter(device_id__in=macs).order_by('id')
+    Installation.objects.bulk_create([
+        Installation(
+            reference=f'installation-{i}',
+            device=device,
+            latitude=40 + i / 100,
+            longitude=-8 - i / 100,
+            description=''
+        )
+        for i, device in enumerate(devices)
+    ])
+
+    for device in devices:
+        bulk_insert(ESPTransmission, esp_readings(device, start, transmissions, step))
+    for device in Device.objects.filter(device_id__in=hcsr04_ids).order_by('id'):
+        bulk_insert(SensorHCSR04, hcsr04_readings(device, start, transmissions, step))
+    rebuild_rollups(ESPTransmission)
+    rebuild_rollups(SensorHCSR04)
+
+    return macs, hcsr04_ids, (start, start + (transmissions - 1) * step)
+
+
+def table_bytes(connection, model):
+    """
+    Bytes used by the table of `model` and its indexes, or None when the
+    database cannot tell (SQLite built without the dbstat table).
+    """
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT pg_total_relation_size(%s)', [table])
+            return cursor.fetchone()[0]
+        try:
+            cursor.execute(
+                "SELECT SUM(pgsize) FROM dbstat WHERE name = %s OR name IN "
+                "(SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s)",
+                [table, table]
+            )
+        except DatabaseError:
+            return None
+        return cursor.fetchone()[0]
+
+
+def timed(function, repeat=5):
+    """
+    Run `function` `repeat` times and return (best seconds, last result).
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = perf_counter()
+        result = function()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, math.ceil(pct / 100 * len(values)) - 1))
+    return values[index]
@@ -0,0 +1,405 @@
+"""
+Columnar store of raw transmissions: one chunk per device and UTC day
+holding its rows column by column in a binary blob.
+
+A chunk is a header followed by one block per column of `columns()`, each
+block being a codec byte, the length of its payload and the payload:
+
+    - delta: integers as their difference to the previous one;
+    - offset: integers as their difference to timestamp_origin;
+    - xor: float64 bits XORed with the previous value, so slowly moving
+      readings leave most of their bytes zero.
+
+Differences are zigzag encoded, then the 8 bytes of every value are
+split into 8 planes before zlib, which packs the runs of zeros about as
+well as the bit level Gorilla encoding while staying vectorized.
+
+Chunks are written by compact_transmissions for closed days and kept
+when prune_transmissions deletes the rows. Rows added to a compacted day
+(backfills) are merged into its chunk. Readers take the days that have a
+chunk from it and the others from the row table, so those rows are only
+seen once compact_transmissions runs again.
+
+Summaries, buckets (see greenhouse.timeseries) and exports read the raw
+rows older than the retention cutoff (see retention.raw_cutoff) from the
+chunks, so the history pruned from the row table stays reachable as long
+as it was compacted first.
+"""
+import heapq
+import math
+import struct
+import zlib
+from itertools import groupby
+from time import time
+import numpy as np
+from django.db import transaction
+from django.db.models import Count, ExpressionWrapper, F, IntegerField, Max, Q
+from greenhouse.models import (ESPTransmission, ESPTransmissionChunk,
+                               SensorHCSR04, SensorHCSR04Chunk)
+from greenhouse.timeseries import DEVICE_COLUMNS, SENSOR_FIELDS
+
+
+CHUNK_MODELS = {
+    ESPTransmission: ESPTransmissionChunk,
+    SensorHCSR04: SensorHCSR04Chunk,
+}
+
+DAY = 86400
+MAGIC = b'GHC1'
+HEADER = struct.Struct('<4sIB')
+BLOCK = struct.Struct('<BI')
+DELTA, OFFSET, XOR = range(3)
+
+
+def columns(model):
+    """
+    The (name, codec) of the columns stored in chunks of `model`.
+    """
+    return [('id', DELTA), ('timestamp_origin', DELTA), ('timestamp_receive', OFFSET)] + [
+        (field, XOR) for field in SENSOR_FIELDS[model]
+    ]
+
+
+def _zigzag(values):
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def _unzigzag(values):
+    return ((values >> np.uint64(1)).view(np.int64)) ^ -(values & np.uint64(1)).view(np.int64)
+
+
+def _pack(words):
+    # byte planes: all first bytes, then all second bytes...
+    return zlib.compress(np.ascontiguousarray(words.view(np.uint8).reshape(-1, 8).T).tobytes())
+
+
+def _unpack(payload, count):
+    planes = np.frombuffer(zlib.decompress(payload), dtype=np.uint8).reshape(8, count)
+    return np.ascontiguousarray(planes.T).view(np.uint64).ravel()
+
+
+def encode_chunk(model, values):
+    """
+    Encode a dict of numpy arrays, one per column of `model`, ordered by
+    timestamp_origin.
+    """
+    count = len(values['timestamp_origin'])
+    blocks = [HEADER.pack(MAGIC, count, len(columns(model)))]
+    origin = values['timestamp_origin'].astype(np.int64)
+    for name, codec in columns(model):
+        if codec == XOR:
+            bits = values[name].astype(np.float64).view(np.uint64)
+            words = bits ^ np.concatenate(([np.uint64(0)], bits[:-1]))
+        elif codec == OFFSET:
+            words = _zigzag(values[name].astype(np.int64) - origin)
+        else:
+            words = _zigzag(np.diff(values[name].astype(np.int64), prepend=np.int64(0)))
+        payload = _pack(words)
+        blocks.append(BLOCK.pack(codec, len(payload)))
+        blocks.append(payload)
+    return b''.join(blocks)
+
+
+def decode_chunk(model, data, names=None):
+    """
+    Decode a chunk into a dict of numpy arrays: int64 for ids and
+    timestamps, float64 for sensor fields. `names` limits the columns
+    decoded, timestamp_origin always is.
+    """
+    data = bytes(data)
+    magic, count, column_count = HEADER.unpack_from(data)
+    if magic != MAGIC or column_count != len(columns(model)):
+        raise ValueError(f'Not a chunk of {model.__name__}')
+
+    values = {}
+    position = HEADER.size
+    for name, expected in columns(model):
+        codec, length = BLOCK.unpack_from(data, position)
+        if codec != expected:
+            raise ValueError(f'Unexpected codec {codec} of column {name}')
+        position += BLOCK.size
+        payload = data[position:position + length]
+        position += length
+        if names is not None and name not in names and name != 'timestamp_origin':
+            continue
+        words = _unpack(payload, count)
+        if codec == XOR:
+            values[name] = np.bitwise_xor.accumulate(words).view(np.float64)
+        elif codec == OFFSET:
+            values[name] = _unzigzag(words) + values['timestamp_origin']
+        else:
+            values[name] = np.cumsum(_unzigzag(words))
+    return values
+
+
+def _day(field='timestamp_origin'):
+    return ExpressionWrapper(F(field) / DAY, output_field=IntegerField())
+
+
+def _selected(model, names):
+    return [
+        (name, codec) for name, codec in columns(model)
+        if names is None or name in names or name == 'timestamp_origin'
+    ]
+
+
+def _row_values(model, queryset, names=None):
+    selected = _selected(model, names)
+    rows = list(queryset.order_by('timestamp_origin').values_list(*(name for name, _ in selected)))
+    if not rows:
+        return {
+            name: np.zeros(0, dtype=np.float64 if codec == XOR else np.int64)
+            for name, codec in selected
+        }
+    table = np.array(rows, dtype=np.float64)
+    return {
+        name: table[:, i] if codec == XOR else table[:, i].astype(np.int64)
+        for i, (name, codec) in enumerate(selected)
+    }
+
+
+def _merge(chunk, rows):
+    """
+    Union of the values of a chunk and of rows, by timestamp_origin (unique
+    per device), the rows replacing the chunk values they share.
+    """
+    kept = ~np.isin(chunk['timestamp_origin'], rows['timestamp_origin'])
+    values = {name: np.concatenate([chunk[name][kept], rows[name]]) for name in rows}
+    order = np.argsort(values['timestamp_origin'], kind='stable')
+    return {name: column[order] for name, column in values.items()}
+
+
+def compact_transmissions(model, device=None, since=None, until=None, replace=False):
+    """
+    Write the chunks of the days before `until` (by default, today) with
+    rows of `model`, of one device (a Device or its primary key) if given,
+    from the day of `since` on. Days whose chunk already
+    holds as many rows up to the same last timestamp are skipped. Returns
+    the (chunks written, rows compacted).
+
+    The rows of a day are merged into its existing chunk, which keeps the
+    rows pruned since, unless `replace` rewrites it from the rows alone.
+    """
+    chunk_model = CHUNK_MODELS[model]
+    until = until if until is not None else int(time())
+    until -= until % DAY
+    rows = model.objects.filter(timestamp_origin__lt=until)
+    chunks = chunk_model.objects.all()
+    if since is not None:
+        rows = rows.filter(timestamp_origin__gte=since - since % DAY)
+        chunks = chunks.filter(day_start__gte=since - since % DAY)
+    if device is not None:
+        rows = rows.filter(device=device)
+        chunks = chunks.filter(device=device)
+
+    days = rows.annotate(day=_day()).values('device', 'day').annotate(
+        rows=Count('id'),
+        last=Max('timestamp_origin')
+    ).order_by('device', 'day')
+    compacted = {
+        (device, day_start // DAY): (count, last)
+        for device, day_start, count, last in chunks.values_list('device', 'day_start', 'count', 'last_timestamp')
+    }
+
+    written = compacted_rows = 0
+    for day in days.iterator():
+        stored = compacted.get((day['device'], day['day']))
+        if stored == (day['rows'], day['last']):
+            continue
+        day_start = day['day'] * DAY
+        values = _row_values(model, model.objects.filter(
+            device=day['device'],
+            timestamp_origin__gte=day_start,
+            timestamp_origin__lt=day_start + DAY,
+        ))
+        if stored is not None and not replace:
+            chunk = decode_chunk(model, chunk_model.objects.filter(
+                device=day['device'],
+                day_start=day_start,
+            ).values_list('data', flat=True).get())
+            merged = _merge(chunk, values)
+            if len(merged['id']) == len(chunk['id']) and all(
+                np.array_equal(merged[name], chunk[name], equal_nan=True) for name in merged
+            ):
+                # rows of a partly pruned day, all in the chunk already
+                continue
+            values = merged
+
+        with transaction.atomic():
+            chunk_model.objects.update_or_create(
+                device_id=day['device'],
+                day_start=day_start,
+                defaults={
+                    'count': len(values['id']),
+                    'last_timestamp': int(values['timestamp_origin'][-1]),
+                    'data': encode_chunk(model, values),
+                }
+            )
+        written += 1
+        compacted_rows += day['rows']
+    return written, compacted_rows
+
+
+def read_columns(model, device, start=None, end=None, names=None):
+    """
+    Transmissions of a device (a Device or its primary key) with timestamp_origin in [start, end) as a
+    dict of numpy arrays ordered by timestamp_origin, decoded from the
+    chunks of compacted days and read from the row table for the others.
+    `names` limits the columns read, timestamp_origin always is.
+    """
+    chunk_model = CHUNK_MODELS[model]
+    chunks = chunk_model.objects.filter(device=device)
+    rows = model.objects.filter(device=device)
+    if start is not None:
+        chunks = chunks.filter(day_start__gt=start - DAY)
+        rows = rows.filter(timestamp_origin__gte=start)
+    if end is not None:
+        chunks = chunks.filter(day_start__lt=end)
+        rows = rows.filter(timestamp_origin__lt=end)
+
+    parts = []
+    gaps = []
+    position = start
+    for day_start, data in chunks.order_by('day_start').values_list('day_start', 'data'):
+        values = decode_chunk(model, data, names)
+        selected = np.ones(len(values['timestamp_origin']), dtype=bool)
+        if start is not None:
+            selected &= values['timestamp_origin'] >= start
+        if end is not None:
+            selected &= values['timestamp_origin'] < end
+        parts.append({name: column[selected] for name, column in values.items()})
+        if position is None or position < day_start:
+            gaps.append((position, day_start))
+        position = day_start + DAY
+    if position is None or end is None or position < end:
+        gaps.append((position, end))
+
+    # only the time ranges without chunks are read from rows
+    if gaps:
+        ranges = Q()
+        for gap_start, gap_end in gaps:
+            gap = Q()
+            if gap_start is not None:
+                gap &= Q(timestamp_origin__gte=gap_start)
+            if gap_end is not None:
+                gap &= Q(timestamp_origin__lt=gap_end)
+            ranges |= gap
+        parts.append(_row_values(model, rows.filter(ranges), names))
+
+    values = {name: np.concatenate([part[name] for part in parts]) for name, _ in _selected(model, names)}
+    order = np.argsort(values['timestamp_origin'], kind='stable')
+    return {name: column[order] for name, column in values.items()}
+
+
+def column_totals(model, device, field, ranges):
+    """
+    Count, sum, sum of squares, min and max of a sensor field over the
+    [start, end) `ranges` of a device, the keys of the aggregates of
+    timeseries.sensor_summary.
+    """
+    values = np.concatenate(
+        [read_columns(model, device, start, end, [field])[field] for start, end in ranges] or [np.zeros(0)]
+    )
+    if not len(values):
+        return {'count': 0, 'total': None, 'total_sq': None, 'minimum': None, 'maximum': None}
+    return {
+        'count': len(values),
+        'total': float(values.sum()),
+        'total_sq': float((values * values).sum()),
+        'minimum': float(values.min()),
+        'maximum': float(values.max()),
+    }
+
+
+def column_summary(model, device, field, start, end):
+    """
+    Same as timeseries.sensor_summary, computed over `read_columns`.
+    """
+    totals = column_totals(model, device, field, [(start, end)])
+    if not totals['count']:
+        return {'count': 0, 'mean': None, 'std': None, 'min': None, 'max': None}
+    mean = totals['total'] / totals['count']
+    return {
+        'count': totals['count'],
+        'mean': mean,
+        'std': math.sqrt(max(0.0, totals['total_sq'] / totals['count'] - mean * mean)),
+        'min': totals['minimum'],
+        'max': totals['maximum'],
+    }
+
+
+def column_buckets(model, device, ranges, bucket):
+    """
+    Aggregate the transmissions of a device within the [start, end)
+    `ranges` into `bucket` seconds wide buckets, as the rows of
+    timeseries._raw_buckets, over `read_columns`.
+    """
+    fields = SENSOR_FIELDS[model]
+    parts = [read_columns(model, device, start, end, fields) for start, end in ranges]
+    timestamps = np.concatenate([part['timestamp_origin'] for part in parts] or [np.zeros(0, dtype=np.int64)])
+    if not len(timestamps):
+        return []
+    order = np.argsort(timestamps, kind='stable')
+    timestamps = timestamps[order]
+    values = {field: np.concatenate([part[field] for part in parts])[order] for field in fields}
+
+    keys = timestamps // bucket
+    firsts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    lasts = np.append(firsts[1:], len(keys)) - 1
+    aggregates = {}
+    for field in fields:
+        aggregates[f'{field}__sum'] = np.add.reduceat(values[field], firsts).tolist()
+        aggregates[f'{field}__min'] = np.minimum.reduceat(values[field], firsts).tolist()
+        aggregates[f'{field}__max'] = np.maximum.reduceat(values[field], firsts).tolist()
+
+    rows = []
+    for i, (first, last) in enumerate(zip(firsts.tolist(), lasts.tolist())):
+        row = {
+            'bucket': int(keys[first]),
+            'count': last - first + 1,
+            'last_timestamp': int(timestamps[last]),
+            'last': tuple(float(values[field][last]) for field in fields),
+        }
+        for name, column in aggregates.items():
+            row[name] = column[i]
+        rows.append(row)
+    return rows
+
+
+def chunk_rows(model, columns, device=None, start=None, end=None, using=None):
+    """
+    Iterate the rows held by the chunks of `model`, or of a Device, as
+    value tuples of `columns` (the export columns), ordered by origin
+    timestamp, from `start` included to `end` excluded. The chunks are
+    decoded one day at a time.
+    """
+    chunk_model = CHUNK_MODELS[model]
+    chunks = chunk_model.objects.using(using) if using else chunk_model.objects.all()
+    if device is not None:
+        chunks = chunks.filter(device=device)
+    if start is not None:
+        chunks = chunks.filter(day_start__gt=start - DAY)
+    if end is not None:
+        chunks = chunks.filter(day_start__lt=end)
+    device_column, device_field = DEVICE_COLUMNS[model]
+    timestamp = columns.index('timestamp_origin')
+
+    days = chunks.order_by('day_start', 'device').values_list(
+        'day_start', 'device__device_id', 'data'
+    ).iterator(chunk_size=100)
+    for _, day in groupby(days, key=lambda chunk: chunk[0]):
+        day_rows = []
+        for _, device_id, data in day:
+            values = decode_chunk(model, data)
+            selected = np.ones(len(values['timestamp_origin']), dtype=bool)
+            if start is not None:
+                selected &= values['timestamp_origin'] >= start
+            if end is not None:
+                selected &= values['timestamp_origin'] < end
+            count = int(selected.sum())
+            device_value = device_field.to_python(device_id)
+            day_rows.append(zip(*(
+                [device_value] * count if name == device_column else values[name][selected].tolist()
+                for name in columns
+            )))
+        yield from heapq.merge(*day_rows, key=lambda row: row[timestamp])
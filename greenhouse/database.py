@@ -0,0 +1,13 @@
+from django.conf import settings
+
+
+def configure_connection(sender, connection, **kwargs):
+    """
+    connection_created receiver applying settings.SQLITE_PRAGMAS to new
+    SQLite connections.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
@@ -0,0 +1,162 @@
+"""
+Payload decoders for device transmissions, selected by MQTT topic.
+
+Devices publish on their base topic (settings.LDR_DEVICE or
+settings.HCSR_DEVICE) using the text format, or on the `/json` and `/bin`
+sub-topics using the JSON and binary formats:
+
+    text    ['AA:BB:CC:DD:EE:FF', 1668000000, 1200.0, 25.3, 1013.2, 41.0]
+    json    ["AA:BB:CC:DD:EE:FF", 1668000000, 1200.0, 25.3, 1013.2, 41.0]
+    binary  little endian struct, see BINARY_LAYOUTS
+
+Every decoder returns the transmission as a tuple in that field order.
+"""
+import json
+import math
+import struct
+from django.conf import settings
+
+
+ESP = 'esp'
+HCSR04 = 'hcsr04'
+
+BINARY_LAYOUTS = {
+    # 6 bytes MAC, uint32 origin timestamp, float32 ldr, temperature, pressure, moisture
+    ESP: struct.Struct('<6sIffff'),
+    # uint32 device id, uint32 origin timestamp, float32 distance
+    HCSR04: struct.Struct('<IIf'),
+}
+
+FIELD_COUNT = {
+    ESP: 6,
+    HCSR04: 3,
+}
+
+class DecodeError(ValueError):
+    pass
+
+
+def _parse_scalar(token):
+    if token[0] in '\'"':
+        if len(token) < 2 or token[-1] != token[0]:
+            raise DecodeError(f'Invalid string {token}')
+        value = token[1:-1]
+        if '\\' in value or token[0] in value:
+            raise DecodeError(f'Invalid string {token}')
+        return value
+
+    # int() and float() only accept numeric literals, non-finite values are
+    # rejected by _check
+    try:
+        if '.' in token or 'e' in token or 'E' in token:
+            return float(token)
+        return int(token)
+    except ValueError:
+        raise DecodeError(f'Invalid value {token}')
+
+
+def decode_text(payload):
+    """
+    Strict parser of the `str(list(...))` format: a flat list or tuple of
+    quoted strings and numbers. Anything else is rejected rather than
+    evaluated.
+    """
+    try:
+        text = payload.decode('utf-8').strip()
+    except UnicodeDecodeError as e:
+        raise DecodeError(str(e))
+
+    if len(text) < 2 or text[0] + text[-1] not in ('[]', '()'):
+        raise DecodeError('Payload must be a list or tuple')
+
+    body = text[1:-1].strip()
+    if not body:
+        return ()
+    if body.endswith(','):
+        body = body[:-1]
+
+    values = []
+    for token in body.split(','):
+        token = token.strip()
+        if not token:
+            raise DecodeError('Empty value')
+        values.append(_parse_scalar(token))
+    return tuple(values)
+
+
+def decode_json(payload):
+    try:
+        data = json.loads(payload)
+    except ValueError as e:
+        raise DecodeError(str(e))
+    if not isinstance(data, list):
+        raise DecodeError('Payload must be a JSON array')
+    return tuple(data)
+
+
+def decode_binary(kind, payload):
+    layout = BINARY_LAYOUTS[kind]
+    try:
+        values = layout.unpack(payload)
+    except struct.error as e:
+        raise DecodeError(str(e))
+
+    if kind == ESP:
+        mac, *values = values
+        return (':'.join(f'{byte:02X}' for byte in mac), *values)
+    return values
+
+
+def encode_binary(kind, values):
+    """
+    Pack a transmission tuple in the binary format, as device firmware does.
+    """
+    values = list(values)
+    if kind == ESP:
+        values[0] = bytes.fromhex(values[0].replace(':', ''))
+    return BINARY_LAYOUTS[kind].pack(*values)
+
+
+def _check(kind, data):
+    if len(data) != FIELD_COUNT[kind]:
+        raise DecodeError(f'Expected {FIELD_COUNT[kind]} values, got {len(data)}')
+    device_type = str if kind == ESP else int
+    if isinstance(data[0], bool) or not isinstance(data[0], device_type):
+        raise DecodeError(f'Invalid device id {data[0]!r}')
+    for value in data[1:]:
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise DecodeError(f'Invalid reading {value!r}')
+    return data
+
+
+def _decoder(kind, payload_format):
+    if payload_format == 'bin':
+        return lambda payload: _check(kind, decode_binary(kind, payload))
+    if payload_format == 'json':
+        return lambda payload: _check(kind, decode_json(payload))
+    return lambda payload: _check(kind, decode_text(payload))
+
+
+_routes = {}
+
+
+def route(topic):
+    """
+    Return (kind, decoder) for a topic, or None if it carries no
+    transmissions.
+    """
+    if topic in _routes:
+        return _routes[topic]
+
+    routed = None
+    for kind, base in ((ESP, settings.LDR_DEVICE), (HCSR04, settings.HCSR_DEVICE)):
+        if not base:
+            continue
+        if topic == base:
+            routed = (kind, _decoder(kind, 'text'))
+        elif topic in (f'{base}/json', f'{base}/bin'):
+            routed = (kind, _decoder(kind, topic.rsplit('/', 1)[1]))
+
+    if routed is not None:
+        _routes[topic] = routed
+    return routed
@@ -0,0 +1,168 @@
+"""
+Streaming export of raw transmissions as CSV, NDJSON or Parquet.
+
+Rows are read with a chunked `.iterator()` (a server-side cursor on
+PostgreSQL) and encoded chunk by chunk, so memory stays flat whatever the
+number of rows. Rows pruned to archives (see greenhouse.retention) and
+the rows older than the retention cutoff kept in columnar chunks (see
+greenhouse.columnar) are merged back in. Parquet needs the optional
+pyarrow package.
+"""
+import csv
+import io
+import json
+import os
+from greenhouse.columnar import chunk_rows
+from greenhouse.retention import archive_dir, archived_rows, merge_rows, raw_cutoff
+from greenhouse.timeseries import DEVICE_COLUMNS, row_fields, with_device_column
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+# pyarrow type of the values of each internal field type
+PARQUET_TYPES = {
+    'CharField': 'string',
+    'FloatField': 'float64',
+    'IntegerField': 'int64',
+}
+
+
+def export_columns(model):
+    return row_fields(model)
+
+
+def export_rows(model, device=None, start=None, end=None, chunk_size=2000,
+                using=None):
+    """
+    Iterate the transmissions of `model`, or of a Device, as value tuples
+    of `export_columns`, ordered by origin timestamp, archived and
+    compacted ones included. `start` is included and `end` excluded.
+    """
+    columns = export_columns(model)
+    transmissions = model.objects.using(using) if using else model.objects.all()
+    if device is not None:
+        transmissions = transmissions.filter(device=device)
+    if start is not None:
+        transmissions = transmissions.filter(timestamp_origin__gte=start)
+    if end is not None:
+        transmissions = transmissions.filter(timestamp_origin__lt=end)
+    rows = with_device_column(model, transmissions).order_by('timestamp_origin', 'id').values_list(
+        *columns
+    ).iterator(chunk_size=chunk_size)
+    sources = []
+    if os.path.isdir(archive_dir(model)):
+        device_id = device.device_id if device is not None else None
+        sources.append(archived_rows(model, columns, device_id, start, end))
+    cutoff = raw_cutoff(model)
+    if cutoff is not None and (start is None or start < cutoff):
+        chunks_end = min(end, cutoff) if end is not None else cutoff
+        sources.append(chunk_rows(model, columns, device, start, chunks_end, using))
+    if not sources:
+        return rows
+    return merge_rows(model, columns, *sources, rows)
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def stream_csv(columns, rows, chunk_size=2000):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for batch in _batches(rows, chunk_size):
+        writer.writerows(batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def stream_ndjson(columns, rows, chunk_size=2000):
+    for batch in _batches(rows, chunk_size):
+        yield ''.join(
+            json.dumps(dict(zip(columns, row)), separators=(',', ':')) + '\n'
+            for row in batch
+        ).encode('utf-8')
+
+
+class _Chunks(io.RawIOBase):
+    """
+    Write-only file collecting what pyarrow writes until it is taken.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_schema(model, columns):
+    """
+    pyarrow schema of the value tuples of `columns` of `model`, typed from
+    its fields rather than from the values of the rows.
+    """
+    device_column, device_field = DEVICE_COLUMNS[model]
+    fields = {field.attname: field for field in model._meta.concrete_fields}
+    fields[device_column] = device_field
+    return pyarrow.schema([
+        pyarrow.field(name, getattr(pyarrow, PARQUET_TYPES[fields[name].get_internal_type()])())
+        for name in columns
+    ])
+
+
+def stream_parquet(schema, rows, chunk_size=50000):
+    """
+    Write a Parquet file of `schema` (see `parquet_schema`) with one row
+    group per `chunk_size` rows. Without rows the file only holds the
+    schema.
+    """
+    if pyarrow is None:
+        raise ImportError('Parquet export requires pyarrow')
+
+    sink = _Chunks()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    for batch in _batches(rows, chunk_size):
+        writer.write_table(pyarrow.Table.from_pydict(dict(zip(schema.names, zip(*batch))), schema=schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+STREAMS = {
+    'csv': stream_csv,
+    'ndjson': stream_ndjson,
+    'parquet': stream_parquet,
+}
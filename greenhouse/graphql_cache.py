@@ -0,0 +1,214 @@
+"""
+Persisted queries and result caching for the GraphQL views.
+
+Documents are parsed and validated once and kept in a process-local LRU
+keyed by the SHA-256 of their text, which is also the hash clients send
+instead of the query (Apollo automatic persisted queries):
+
+    {"extensions": {"persistedQuery": {"version": 1, "sha256Hash": "..."}}}
+
+A hash the process does not know yet gets a PersistedQueryNotFound error,
+and the client retries with the query and the hash.
+
+Results of query operations are cached in the Django cache for
+settings.GRAPHQL_RESULT_CACHE_TTL seconds (0 disables it). Resolvers call
+`depends_on` with the devices they read and an entry is ignored once one
+of them got new transmissions, or devices and installations changed. The
+ingest process bumps those generations in the Django cache, so it must be
+shared (e.g. memcached) for the invalidation to reach the web server,
+otherwise entries only expire with the TTL.
+
+Commands changing past transmissions (imports, pruning) also bump a
+per-device history generation, read by the caches that assume an
+append-only history (statistics.HourStatisticsCache).
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from graphql.backend.base import GraphQLDocument
+from graphql.backend.core import GraphQLCoreBackend
+from graphql.execution import ExecutionResult, execute
+from graphql.language.base import parse
+from graphql.validation import validate
+
+
+GENERATION_PREFIX = 'graphql-generation'
+ALL_DEVICES = '*'
+CATALOG = 'catalog'
+HISTORY = 'history'
+
+
+def query_hash(query):
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+
+class PersistedQueryBackend(GraphQLCoreBackend):
+    """
+    Backend keeping the last `max_entries` parsed and validated documents,
+    by SHA-256 of their text.
+    """
+    def __init__(self, max_entries=256, executor=None):
+        super().__init__(executor)
+        self.max_entries = max_entries
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sha256):
+        with self._lock:
+            document = self._documents.get(sha256)
+            if document is not None:
+                self._documents.move_to_end(sha256)
+            return document
+
+    def document_from_string(self, schema, document_string):
+        if not isinstance(document_string, str):
+            return super().document_from_string(schema, document_string)
+
+        key = query_hash(document_string)
+        document = self.get(key)
+        if document is not None and document.schema is schema:
+            return document
+
+        document_ast = parse(document_string)
+        errors = validate(schema, document_ast)
+        document = GraphQLDocument(
+            schema=schema,
+            document_string=document_string,
+            document_ast=document_ast,
+            execute=lambda *args, **kwargs: self._execute(schema, document_ast, errors, *args, **kwargs),
+        )
+        document.sha256 = key
+        with self._lock:
+            self._documents[key] = document
+            self._documents.move_to_end(key)
+            while len(self._documents) > self.max_entries:
+                self._documents.popitem(last=False)
+        return document
+
+    def _execute(self, schema, document_ast, errors, *args, **kwargs):
+        if errors:
+            return ExecutionResult(errors=errors, invalid=True)
+        kwargs.pop('validate', None)
+        return execute(schema, document_ast, *args, **dict(self.execute_params, **kwargs))
+
+
+backend = PersistedQueryBackend(settings.GRAPHQL_DOCUMENT_CACHE_SIZE)
+
+
+def persisted_query_hash(data):
+    """
+    Return the sha256Hash of a persisted query request, or None.
+    """
+    extensions = data.get('extensions')
+    if isinstance(extensions, str):
+        try:
+            extensions = json.loads(extensions)
+        except ValueError:
+            return None
+    if not isinstance(extensions, dict):
+        return None
+    persisted = extensions.get('persistedQuery')
+    if isinstance(persisted, dict) and persisted.get('version') == 1:
+        return persisted.get('sha256Hash')
+    return None
+
+
+def _generation_key(name):
+    return f'{GENERATION_PREFIX}:{name}'
+
+
+def depends_on(info, *device_ids):
+    """
+    Record that the result being built reads transmissions of
+    `device_ids`, or of every device when none is given.
+    """
+    dependencies = getattr(info.context, 'graphql_dependencies', None)
+    if dependencies is None:
+        return
+    for name in device_ids or (ALL_DEVICES,):
+        key = _generation_key(name)
+        if key not in dependencies:
+            # read now, before the resolver reads the database
+            dependencies[key] = cache.get(key, 0)
+
+
+def start_tracking(request):
+    request.graphql_dependencies = {}
+    depends_on_catalog(request)
+
+
+def depends_on_catalog(request):
+    key = _generation_key(CATALOG)
+    request.graphql_dependencies[key] = cache.get(key, 0)
+
+
+def _bump(names):
+    for name in names:
+        key = _generation_key(name)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+
+
+def invalidate_devices(device_ids):
+    """
+    Invalidate the cached results reading transmissions of `device_ids`.
+    """
+    _bump(set(device_ids) | {ALL_DEVICES})
+
+
+def history_generation(device_id):
+    """
+    Generation of the past transmissions of `device_id`, bumped by
+    `invalidate_history`.
+    """
+    return cache.get(_generation_key(f'{HISTORY}:{device_id}'), 0)
+
+
+def invalidate_history(device_ids):
+    """
+    Invalidate everything cached from transmissions of `device_ids` after
+    rows were inserted into their past or deleted.
+    """
+    device_ids = set(device_ids)
+    _bump(f'{HISTORY}:{device_id}' for device_id in device_ids)
+    invalidate_devices(device_ids)
+
+
+def invalidate_transmissions(model, instances):
+    invalidate_devices(instance.device.device_id for instance in instances)
+
+
+def invalidate_catalog(**kwargs):
+    _bump([CATALOG])
+
+
+def result_cache_key(sha256, variables, operation_name):
+    variables = json.dumps(variables or {}, sort_keys=True, default=str)
+    return (
+        f'graphql-result:{sha256}:{operation_name or ""}:'
+        f'{hashlib.sha256(variables.encode("utf-8")).hexdigest()}'
+    )
+
+
+def get_cached_result(key):
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    current = cache.get_many(list(entry['dependencies']))
+    for dependency, generation in entry['dependencies'].items():
+        if current.get(dependency, 0) != generation:
+            return None
+    return entry['data']
+
+
+def set_cached_result(key, data, dependencies):
+    cache.set(
+        key,
+        {'data': data, 'dependencies': dependencies},
+        settings.GRAPHQL_RESULT_CACHE_TTL
+    )
@@ -0,0 +1,455 @@
+"""
+Hot window: the last settings.HOT_WINDOW['SIZE'] transmissions of every
+device kept in memory, so `last_transmission` and connections over the
+last minutes are answered without SQL.
+
+Each model has a fixed table of device slots holding a ring of numpy
+columns: id, timestamp_origin and timestamp_receive as int64 and the
+sensor fields as float32. Only rows committed by BatchWriter.flush enter
+it. The table lives in a bytearray of the ingest process, or, when
+HOT_WINDOW['SHARED_MEMORY'] is set, in one shared memory segment per
+model and ingest worker:
+
+    <SHARED_MEMORY>-<model>-<worker index>
+
+written by that worker only and read by the web server processes of the
+same host. A slot is guarded by a sequence number, odd while its writer
+updates it, so readers retry instead of locking.
+
+The window knows from which timestamp it holds every stored row of a
+device: the time its table was created (earlier rows are in the database
+only), raised past each row it evicts. Reads starting before that, and
+devices or segments it does not know, fall back to SQL. Rows written by
+import_transmissions, or deleted by prune_transmissions, bypass it, and
+a device clock running ahead of the server may hide rows stored before
+the window was created.
+"""
+import threading
+from multiprocessing import resource_tracker, shared_memory
+from time import monotonic, sleep, time
+from zlib import crc32
+import numpy as np
+from django.conf import settings
+from greenhouse.metrics import registry
+from greenhouse.timeseries import DEVICE_COLUMNS, SENSOR_FIELDS, row_fields
+
+
+LOOKUPS = registry.counter(
+    'greenhouse_hot_window_lookups_total',
+    'Device lookups of the hot window, by result.'
+)
+
+MAGIC = 0x67686877
+VERSION = 1
+KEY_SIZE = 64
+# seconds before readers open the shared segments again, to follow
+# restarted ingest workers
+ATTACH_SECONDS = 5
+READ_RETRIES = 100
+
+# header fields
+H_MAGIC, H_VERSION, H_SLOTS, H_CAPACITY, H_FIELDS, H_CREATED, H_INDEX, H_WORKERS = range(8)
+# slot fields
+M_SEQ, M_COUNT, M_HEAD, M_COVERED, M_LAST = range(5)
+META_SIZE = 5
+
+
+def segment_name(model, index):
+    return f'{settings.HOT_WINDOW["SHARED_MEMORY"]}-{model._meta.model_name}-{index}'
+
+
+def _nbytes(slots, capacity, fields):
+    return 8 * 8 + slots * (KEY_SIZE + META_SIZE * 8) + slots * capacity * (3 * 8 + fields * 4)
+
+
+class HotWindow:
+    """
+    Rings of the last `capacity` transmissions of up to `slots` devices of
+    `model`, laid out in `buffer`. Only one thread of one process writes a
+    given window; `extend` is serialized by a lock.
+    """
+    def __init__(self, model, buffer, slots=None, capacity=None, index=0, workers=1):
+        self.model = model
+        self.fields = SENSOR_FIELDS[model]
+        self.buffer = buffer
+        header = np.frombuffer(buffer, dtype=np.int64, count=8)
+        if slots is not None:
+            header[:] = (MAGIC, VERSION, slots, capacity, len(self.fields), int(time()), index, workers)
+        elif header[H_MAGIC] != MAGIC or header[H_VERSION] != VERSION or header[H_FIELDS] != len(self.fields):
+            raise ValueError(f'Not a hot window of {model.__name__}')
+        self.header = header
+        self.slots = int(header[H_SLOTS])
+        self.capacity = int(header[H_CAPACITY])
+        self.created = int(header[H_CREATED])
+        self.workers = int(header[H_WORKERS])
+
+        offset = header.nbytes
+        self.keys = np.frombuffer(buffer, dtype=f'S{KEY_SIZE}', count=self.slots, offset=offset)
+        offset += self.keys.nbytes
+        self.meta = np.frombuffer(buffer, dtype=np.int64, count=self.slots * META_SIZE, offset=offset).reshape(self.slots, META_SIZE)
+        offset += self.meta.nbytes
+        shape = (self.slots, self.capacity)
+        columns = {}
+        for name in ('id', 'timestamp_origin', 'timestamp_receive'):
+            columns[name] = np.frombuffer(buffer, dtype=np.int64, count=shape[0] * shape[1], offset=offset).reshape(shape)
+            offset += columns[name].nbytes
+        self.columns = columns
+        self.values = np.frombuffer(
+            buffer,
+            dtype=np.float32,
+            count=shape[0] * shape[1] * len(self.fields),
+            offset=offset
+        ).reshape(shape + (len(self.fields),))
+
+        self._slot_of = {}
+        self._lock = threading.Lock()
+
+    def close(self):
+        """
+        Release the numpy views, then the shared segment if any.
+        """
+        segment = self.__dict__.pop('segment', None)
+        self.__dict__.clear()
+        if segment is not None:
+            segment.close()
+
+    @classmethod
+    def local(cls, model, slots, capacity):
+        return cls(model, bytearray(_nbytes(slots, capacity, len(SENSOR_FIELDS[model]))), slots, capacity)
+
+    def _probe(self, key):
+        start = crc32(key) % self.slots
+        for i in range(self.slots):
+            yield (start + i) % self.slots
+
+    def _find(self, key):
+        # slots are never freed, found ones are remembered
+        slot = self._slot_of.get(key)
+        if slot is not None:
+            return slot
+        for slot in self._probe(key):
+            stored = self.keys[slot]
+            if stored == key:
+                self._slot_of[key] = slot
+                return slot
+            if not stored:
+                return None
+        return None
+
+    def _claim(self, key):
+        slot = self._slot_of.get(key)
+        if slot is not None:
+            return slot
+        for slot in self._probe(key):
+            if self.keys[slot] == key:
+                self._slot_of[key] = slot
+                return slot
+            if not self.keys[slot]:
+                self.meta[slot, M_SEQ] += 1
+                self.meta[slot, M_COUNT] = 0
+                self.meta[slot, M_HEAD] = 0
+                self.meta[slot, M_COVERED] = self.created
+                self.keys[slot] = key
+                self.meta[slot, M_SEQ] += 1
+                self._slot_of[key] = slot
+                return slot
+        # full, the device stays out of the window
+        return None
+
+    def extend(self, instances):
+        """
+        Append saved transmissions, evicting the oldest ones of their
+        device.
+        """
+        devices = {}
+        for instance in instances:
+            devices.setdefault(instance.device.device_id, []).append(instance)
+
+        with self._lock:
+            for device_id, rows in devices.items():
+                key = device_id.encode('utf-8')[:KEY_SIZE]
+                slot = self._claim(key)
+                if slot is None:
+                    continue
+                meta = self.meta[slot]
+                meta[M_SEQ] += 1
+                count, head, covered = int(meta[M_COUNT]), int(meta[M_HEAD]), int(meta[M_COVERED])
+                for instance in rows[-self.capacity:]:
+                    if count == self.capacity:
+                        covered = max(covered, int(self.columns['timestamp_origin'][slot, head]) + 1)
+                    self.columns['id'][slot, head] = instance.pk
+                    self.columns['timestamp_origin'][slot, head] = instance.timestamp_origin
+                    self.columns['timestamp_receive'][slot, head] = instance.timestamp_receive
+                    self.values[slot, head] = [getattr(instance, field) for field in self.fields]
+                    head = (head + 1) % self.capacity
+                    count = min(count + 1, self.capacity)
+                if len(rows) > self.capacity:
+                    skipped = rows[:-self.capacity]
+                    covered = max(covered, max(instance.timestamp_origin for instance in skipped) + 1)
+                # timestamps are unique per device
+                last = int(np.argmax(self.columns['timestamp_origin'][slot, :count]))
+                meta[M_COUNT], meta[M_HEAD], meta[M_COVERED], meta[M_LAST] = count, head, covered, last
+                meta[M_SEQ] += 1
+
+    def read(self, device_id):
+        """
+        Copy the ring of a device as (covered since, columns, values).
+        None when the device is unknown or being written too often.
+        """
+        slot = self._find(str(device_id).encode('utf-8')[:KEY_SIZE])
+        if slot is None:
+            return None
+        meta = self.meta[slot]
+        for _ in range(READ_RETRIES):
+            seq = int(meta[M_SEQ])
+            if seq % 2:
+                sleep(0)
+                continue
+            count, covered = int(meta[M_COUNT]), int(meta[M_COVERED])
+            columns = {name: column[slot, :count].copy() for name, column in self.columns.items()}
+            values = self.values[slot, :count].copy()
+            if int(meta[M_SEQ]) == seq:
+                return covered, columns, values
+        return None
+
+    def read_last(self, device_ids):
+        """
+        Copy the latest row of the known devices of `device_ids` as
+        (their positions in device_ids, covered since, columns, values).
+        """
+        found = [
+            (i, slot)
+            for i, slot in enumerate(self._find(str(device_id).encode('utf-8')[:KEY_SIZE]) for device_id in device_ids)
+            if slot is not None
+        ]
+        positions, slots = (np.array(values, dtype=np.int64) for values in zip(*found)) if found else (np.zeros(0, np.int64),) * 2
+        for _ in range(READ_RETRIES):
+            seqs = self.meta[slots, M_SEQ]
+            meta = self.meta[slots]
+            columns = {name: column[slots, meta[:, M_LAST]] for name, column in self.columns.items()}
+            values = self.values[slots, meta[:, M_LAST]]
+            valid = (seqs % 2 == 0) & (self.meta[slots, M_SEQ] == seqs)
+            if valid.all():
+                break
+            sleep(0)
+        valid &= meta[:, M_COUNT] > 0
+        return (
+            positions[valid],
+            meta[valid, M_COVERED],
+            {name: column[valid] for name, column in columns.items()},
+            values[valid]
+        )
+
+
+_local = {}
+_created = set()
+_attached = {}
+_attach_lock = threading.Lock()
+
+
+def _config():
+    return settings.HOT_WINDOW
+
+
+def writing_window(model):
+    """
+    The window this process writes transmissions of `model` into, None
+    when disabled.
+    """
+    window = _local.get(model)
+    if window is None and _config()['SIZE'] and not _config()['SHARED_MEMORY']:
+        window = _local.setdefault(model, HotWindow.local(model, _config()['DEVICES'], _config()['SIZE']))
+    return window
+
+
+def record(model, instances):
+    window = writing_window(model)
+    if window is not None:
+        window.extend(instances)
+
+
+def create_shared(index=0, workers=1):
+    """
+    Create the shared segments this ingest worker writes, replacing those
+    left by a previous run.
+    """
+    for model in SENSOR_FIELDS:
+        name = segment_name(model, index)
+        size = _nbytes(_config()['DEVICES'], _config()['SIZE'], len(SENSOR_FIELDS[model]))
+        try:
+            segment = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            shared_memory.SharedMemory(name).unlink()
+            segment = shared_memory.SharedMemory(name, create=True, size=size)
+        window = HotWindow(model, segment.buf, _config()['DEVICES'], _config()['SIZE'], index, workers)
+        window.segment = segment
+        _created.add(name)
+        _local[model] = window
+
+
+def close_shared():
+    for model, window in list(_local.items()):
+        segment = getattr(window, 'segment', None)
+        if segment is not None:
+            del _local[model]
+            window.close()
+            segment.unlink()
+            _created.discard(segment.name)
+
+
+def _attach(name, model):
+    try:
+        segment = shared_memory.SharedMemory(name)
+    except FileNotFoundError:
+        return None
+    if name not in _created:
+        # only the ingest worker owns the segment, do not unlink it on exit
+        resource_tracker.unregister(segment._name, 'shared_memory')
+    try:
+        window = HotWindow(model, segment.buf)
+    except ValueError:
+        segment.close()
+        return None
+    window.segment = segment
+    return window
+
+
+def _shared_windows(model):
+    with _attach_lock:
+        attached_at, windows = _attached.get(model, (None, []))
+        if attached_at is not None and monotonic() - attached_at < ATTACH_SECONDS:
+            return windows
+
+        # the previous mappings stay valid while other threads read them
+        windows = []
+        first = _attach(segment_name(model, 0), model)
+        if first is not None:
+            windows.append(first)
+            for index in range(1, first.workers):
+                window = _attach(segment_name(model, index), model)
+                if window is None:
+                    # a worker is missing, its devices are not covered
+                    windows = []
+                    break
+                windows.append(window)
+        _attached[model] = (monotonic(), windows)
+        return windows
+
+
+def reading_windows(model):
+    if not _config()['SIZE']:
+        return []
+    if model in _local:
+        return [_local[model]]
+    if _config()['SHARED_MEMORY']:
+        return _shared_windows(model)
+    return []
+
+
+def _read(model, device_id):
+    """
+    The stored rows of a device held by the windows and the timestamp
+    since which they are all there, or None.
+    """
+    windows = reading_windows(model)
+    if not windows:
+        return None
+    covered = max(window.created for window in windows)
+    parts = []
+    for window in windows:
+        data = window.read(device_id)
+        if data is not None:
+            covered = max(covered, data[0])
+            parts.append(data[1:])
+    if not parts:
+        return None
+
+    columns = {name: np.concatenate([part[0][name] for part in parts]) for name in parts[0][0]}
+    values = np.concatenate([part[1] for part in parts])
+    order = np.argsort(columns['timestamp_origin'], kind='stable')
+    return covered, {name: column[order] for name, column in columns.items()}, values[order]
+
+
+def _rows(model, device_ids, columns, values):
+    """
+    `.values()` dicts of rows read from the windows, `device_ids` giving
+    the device of each row.
+    """
+    column, device_field = DEVICE_COLUMNS[model]
+    names = ['id'] + row_fields(model)
+    # shortest float32 representation, 25.3 rather than 25.299999237
+    values = values.astype(str).astype(np.float64).tolist()
+    ids, origins, receives = (columns[name].tolist() for name in ('id', 'timestamp_origin', 'timestamp_receive'))
+    devices = {device_id: device_field.to_python(device_id) for device_id in set(device_ids)}
+    rows = []
+    for i, device_id in enumerate(device_ids):
+        row = dict(zip(SENSOR_FIELDS[model], values[i]))
+        row.update(id=ids[i], timestamp_origin=origins[i], timestamp_receive=receives[i])
+        row[column] = devices[device_id]
+        rows.append({name: row[name] for name in names})
+    return rows
+
+
+def last_rows(model, device_ids):
+    """
+    {device_id: latest transmission} of the devices the window can
+    answer for, as `.values()` dicts.
+    """
+    device_ids = [str(device_id) for device_id in device_ids]
+    windows = reading_windows(model)
+    parts = [window.read_last(device_ids) for window in windows]
+    parts = [part for part in parts if len(part[0])]
+    if not parts:
+        LOOKUPS.inc(len(device_ids), result='miss')
+        return {}
+
+    positions = np.concatenate([part[0] for part in parts])
+    covered = np.full(len(device_ids), max(window.created for window in windows))
+    np.maximum.at(covered, positions, np.concatenate([part[1] for part in parts]))
+    columns = {name: np.concatenate([part[2][name] for part in parts]) for name in parts[0][2]}
+    values = np.concatenate([part[3] for part in parts])
+
+    # the latest row of every device over the windows
+    order = np.lexsort((columns['timestamp_origin'], positions))
+    last = order[np.append(positions[order][1:] != positions[order][:-1], True)]
+    # rows stored before the windows may be more recent
+    last = last[columns['timestamp_origin'][last] >= covered[positions[last]]]
+
+    devices = [device_ids[position] for position in positions[last].tolist()]
+    LOOKUPS.inc(len(devices), result='hit')
+    LOOKUPS.inc(len(device_ids) - len(devices), result='miss')
+    rows = _rows(model, devices, {name: column[last] for name, column in columns.items()}, values[last])
+    return dict(zip(devices, rows))
+
+
+def recent_rows(model, device_id, start, end=None):
+    """
+    Transmissions of a device with timestamp_origin in [start, end], as
+    `.values()` dicts ordered by (timestamp_origin, id), or None when the
+    window does not hold all of them.
+    """
+    found = _read(model, device_id)
+    if found is None or start < found[0]:
+        LOOKUPS.inc(result='miss')
+        return None
+    LOOKUPS.inc(result='hit')
+
+    covered, columns, values = found
+    selected = columns['timestamp_origin'] >= start
+    if end is not None:
+        selected &= columns['timestamp_origin'] <= end
+    return _rows(
+        model,
+        [device_id] * int(selected.sum()),
+        {name: column[selected] for name, column in columns.items()},
+        values[selected]
+    )
+
+
+def reset():
+    """
+    Forget the windows of this process, for tests.
+    """
+    close_shared()
+    _local.clear()
+    _attached.clear()
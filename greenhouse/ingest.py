@@ -0,0 +1,350 @@
+import queue
+import threading
+from collections import OrderedDict, defaultdict
+from time import monotonic, perf_counter, sleep
+from django.db import OperationalError, connection, transaction
+from greenhouse import hotwindow
+from greenhouse.graphql_cache import invalidate_catalog, invalidate_transmissions
+from greenhouse.metrics import registry
+from greenhouse.models import Device
+from greenhouse.pubsub import publish_transmissions
+from greenhouse.rollups import apply_rollups
+from greenhouse.timeseries import HARDWARE_TYPES, insert_transmissions, transmission_key
+
+
+OVERFLOW_POLICIES = ('block', 'drop_newest', 'drop_oldest')
+
+FLUSH_SECONDS = registry.histogram(
+    'greenhouse_ingest_flush_seconds',
+    'Time to write a batch of transmissions and their rollups.'
+)
+ROWS_WRITTEN = registry.counter(
+    'greenhouse_ingest_rows_written_total',
+    'Transmissions written to the database.'
+)
+WRITE_FAILURES = registry.counter(
+    'greenhouse_ingest_write_failures_total',
+    'Failed attempts to write a batch, retried or split.'
+)
+ROWS_FAILED = registry.counter(
+    'greenhouse_ingest_rows_failed_total',
+    'Transmissions lost because they could not be written.'
+)
+ROWS_DROPPED = registry.counter(
+    'greenhouse_ingest_rows_dropped_total',
+    'Transmissions dropped because the writer queue was full.'
+)
+QUEUE_DEPTH = registry.gauge(
+    'greenhouse_ingest_queue_depth',
+    'Transmissions waiting in the writer queue.'
+)
+DUPLICATES = registry.counter(
+    'greenhouse_ingest_duplicates_total',
+    'Redelivered transmissions skipped, by where they were caught.'
+)
+
+
+class RecentKeys:
+    """
+    Thread safe LRU set of the last `max_size` transmission keys.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        """
+        Remember `key`, returning False if it was already known.
+        """
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                return False
+            self._keys[key] = None
+            if len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+            return True
+
+    def discard(self, keys):
+        with self._lock:
+            for key in keys:
+                self._keys.pop(key, None)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class DeviceRegistry:
+    """
+    Thread safe cache of the Device of every device id (MAC) seen in
+    transmissions. Unknown ids are registered as auto_registered devices,
+    concurrent registrations being settled by the unique device_id.
+
+    The cached Device instances are shared by the transmissions referring
+    to them, so their device id is read without a query.
+    """
+    def __init__(self):
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def devices(self, model, device_ids):
+        """
+        {device id: Device} of `device_ids`, as strings.
+        """
+        device_ids = {str(device_id) for device_id in device_ids}
+        with self._lock:
+            missing = [device_id for device_id in device_ids if device_id not in self._devices]
+            if missing:
+                with transaction.atomic():
+                    Device.objects.bulk_create([
+                        Device(
+                            hardware_type=HARDWARE_TYPES[model],
+                            device_id=device_id,
+                            description='',
+                            auto_registered=True
+                        )
+                        for device_id in missing
+                    ], ignore_conflicts=True)
+                # bulk_create sends no post_save
+                invalidate_catalog()
+                self._devices.update(
+                    (device.device_id, device) for device in Device.objects.filter(device_id__in=missing)
+                )
+            return {device_id: self._devices[device_id] for device_id in device_ids}
+
+    def get(self, model, device_id):
+        """
+        The Device of `device_id`, for a transmission of `model`.
+        """
+        device_id = str(device_id)
+        device = self._devices.get(device_id)
+        if device is None:
+            device = self.devices(model, [device_id])[device_id]
+        return device
+
+    def assign(self, model, instances):
+        """
+        Link transmission instances to the cached Device of their device
+        id, registering it again after `clear`.
+        """
+        devices = self.devices(model, {instance.device.device_id for instance in instances})
+        for instance in instances:
+            instance.device = devices[instance.device.device_id]
+
+    def clear(self):
+        with self._lock:
+            self._devices.clear()
+
+
+class BatchWriter:
+    """
+    Buffers unsaved transmission instances in a bounded queue and persists
+    them from a background thread using bulk inserts, one transaction per
+    flush. A flush happens when `batch_size` rows are collected or when
+    `flush_interval` seconds have passed since the first row of the batch.
+
+    When the queue is full the `overflow` policy decides what happens:
+        - block: the producer waits (backpressure on the MQTT loop);
+        - drop_newest: the incoming row is discarded;
+        - drop_oldest: the oldest queued row is discarded.
+
+    QoS 1 redeliveries are dropped by `put` when their (device,
+    timestamp_origin) is among the last `recent_keys` seen, and by `flush`
+    when already stored.
+
+    Producers take the Device of the instances from the `devices`
+    registry. Instances are linked again to the cached Device of their
+    device id before every write, so a device deleted meanwhile is
+    registered anew. Written rows are appended to the hot window (see
+    greenhouse.hotwindow) once committed, then passed to `on_written`
+    as (model, instances) when given.
+    """
+    def __init__(self, batch_size=500, flush_interval=0.25, queue_size=10000,
+                 overflow='block', recent_keys=10000, retries=3, retry_delay=0.1,
+                 on_written=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f'Invalid overflow policy {overflow}, '
+                f'choose one of {", ".join(OVERFLOW_POLICIES)}'
+            )
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.recent = RecentKeys(recent_keys) if recent_keys else None
+        self.devices = DeviceRegistry()
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.on_written = on_written
+        self.dropped = 0
+        self.duplicates = 0
+        self.written = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def put(self, instance):
+        """
+        Enqueue an unsaved model instance. Returns False if it was dropped.
+        """
+        if self.recent is not None and not self.recent.add(transmission_key(instance)):
+            self.duplicates += 1
+            DUPLICATES.inc(stage='memory')
+            return False
+
+        if self.overflow == 'block':
+            self.queue.put(instance)
+            return True
+
+        while True:
+            try:
+                self.queue.put_nowait(instance)
+                return True
+            except queue.Full:
+                if self.overflow == 'drop_newest':
+                    self.dropped += 1
+                    ROWS_DROPPED.inc()
+                    return False
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                    ROWS_DROPPED.inc()
+                except queue.Empty:
+                    pass
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='transmission-writer',
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the writer thread after draining every queued row.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        try:
+            while not (self._stop.is_set() and self.queue.empty()):
+                batch = self._collect()
+                if batch:
+                    self.flush(batch)
+        finally:
+            connection.close()
+
+    def _collect(self):
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return batch
+
+        deadline = monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def flush(self, batch):
+        """
+        Persist a list of unsaved instances and update their rollups in a
+        single transaction, then publish them to subscriptions. Instances
+        already stored, or repeated in the batch, are skipped.
+
+        Transient database errors (OperationalError: a locked database, a
+        lost connection, a deadlock) are retried `retries` times. Other
+        errors split the rows in halves written separately, so only the
+        rows failing on their own are lost.
+        """
+        rows = {}
+        for instance in batch:
+            rows.setdefault(transmission_key(instance), instance)
+
+        QUEUE_DEPTH.set(self.queue.qsize())
+        start = perf_counter()
+        written = defaultdict(list)
+        failed = self._write(list(rows.values()), written)
+
+        FLUSH_SECONDS.observe(perf_counter() - start)
+        skipped = len(batch) - failed - sum(len(new) for new in written.values())
+        if skipped:
+            self.duplicates += skipped
+            DUPLICATES.inc(skipped, stage='flush')
+        for model, instances in written.items():
+            self.written += len(instances)
+            if not instances:
+                continue
+            ROWS_WRITTEN.inc(len(instances), model=model.__name__)
+            hotwindow.record(model, instances)
+            invalidate_transmissions(model, instances)
+            publish_transmissions(model, instances)
+            if self.on_written is not None:
+                self.on_written(model, instances)
+
+    def _write(self, instances, written):
+        """
+        Write `instances`, adding the rows inserted to `written` by model.
+        Returns the number of rows lost.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                for model, new in self._insert(instances).items():
+                    written[model] += new
+                return 0
+            except OperationalError as e:
+                error = e
+                WRITE_FAILURES.inc()
+                if not connection.in_atomic_block:
+                    # reconnect after a lost connection
+                    connection.close_if_unusable_or_obsolete()
+                if attempt < self.retries:
+                    sleep(self.retry_delay * 2 ** attempt)
+            except Exception as e:
+                error = e
+                WRITE_FAILURES.inc()
+                # a deleted device leaves a stale id behind
+                self.devices.clear()
+                if len(instances) == 1:
+                    break
+                middle = len(instances) // 2
+                return self._write(instances[:middle], written) + self._write(instances[middle:], written)
+
+        ROWS_FAILED.inc(len(instances))
+        if self.recent is not None:
+            # let redeliveries of the lost rows in
+            self.recent.discard(transmission_key(instance) for instance in instances)
+        print(f'Failed saving {len(instances)} transmissions with error: {str(error)}')
+        return len(instances)
+
+    def _insert(self, instances):
+        by_model = defaultdict(list)
+        for instance in instances:
+            by_model[type(instance)].append(instance)
+        # registered devices are kept even if the transaction fails
+        for model, group in by_model.items():
+            self.devices.assign(model, group)
+
+        written = {}
+        with transaction.atomic():
+            for model, group in by_model.items():
+                # only the rows actually inserted are rolled up and
+                # published, not those stored before or meanwhile
+                new = insert_transmissions(model, group, self.batch_size)
+                apply_rollups(model, new)
+                written[model] = new
+        return written
@@ -0,0 +1,163 @@
+"""
+Request scoped DataLoaders batching the per device lookups of DeviceType.
+
+Each loader collects the keys requested while a GraphQL response is being
+built and resolves all of them with a single grouped query.
+"""
+from collections import defaultdict
+from time import perf_counter
+from django.db.models import Count, OuterRef, Subquery
+from promise import Promise
+from promise.dataloader import DataLoader
+from greenhouse import hotwindow
+from greenhouse.metrics import COUNT_BUCKETS, registry
+from greenhouse.middleware import counting_queries
+from greenhouse.models import Device, Installation
+from greenhouse.timeseries import DEVICE_COLUMNS, row_fields, transmission_model, with_device_column
+
+
+LOADER_SECONDS = registry.histogram(
+    'greenhouse_graphql_loader_seconds',
+    'Time spent loading a DataLoader batch.'
+)
+LOADER_QUERIES = registry.histogram(
+    'greenhouse_graphql_loader_queries',
+    'SQL queries run to load a DataLoader batch.',
+    COUNT_BUCKETS
+)
+LOADER_KEYS = registry.histogram(
+    'greenhouse_graphql_loader_keys',
+    'Keys in a DataLoader batch.',
+    COUNT_BUCKETS
+)
+
+
+class BatchLoader(DataLoader):
+    """
+    DataLoader recording every batch into the metrics registry, and into
+    `timing` when given. Subclasses implement `load_batch`.
+    """
+    def __init__(self, timing=None, **kwargs):
+        super().__init__(**kwargs)
+        self.timing = timing
+
+    def batch_load_fn(self, keys):
+        start = perf_counter()
+        stack, counter = counting_queries()
+        with stack:
+            values = self.load_batch(keys)
+        elapsed = perf_counter() - start
+
+        loader = type(self).__name__
+        LOADER_SECONDS.observe(elapsed, loader=loader)
+        LOADER_QUERIES.observe(counter.count, loader=loader)
+        LOADER_KEYS.observe(len(keys), loader=loader)
+        if self.timing is not None:
+            self.timing.append({
+                'loader': loader,
+                'duration_ms': elapsed * 1000,
+                'queries': counter.count,
+                'keys': len(keys),
+            })
+        return Promise.resolve(values)
+
+
+class TransmissionCountLoader(BatchLoader):
+    """
+    Keys are (hardware_type, Device primary key, start) tuples, `start`
+    being an optional lower bound of timestamp_origin.
+    """
+    def load_batch(self, keys):
+        groups = defaultdict(set)
+        for hardware_type, device, start in keys:
+            groups[(transmission_model(hardware_type), start)].add(device)
+
+        counts = {}
+        for (model, start), devices in groups.items():
+            transmissions = model.objects.filter(device__in=devices)
+            if start is not None:
+                transmissions = transmissions.filter(timestamp_origin__gte=start)
+            rows = transmissions.order_by().values('device').annotate(
+                total=Count('id')
+            ).values_list('device', 'total')
+            for device, total in rows:
+                counts[(model, start, device)] = total
+
+        return [
+            counts.get((transmission_model(hardware_type), start, device), 0)
+            for hardware_type, device, start in keys
+        ]
+
+
+class LastTransmissionLoader(BatchLoader):
+    """
+    Keys are (hardware_type, device_id) tuples. Values are the latest
+    transmission by timestamp_origin, as a dict, or None. The hot window
+    answers first, the database for the devices it misses.
+    """
+    def load_batch(self, keys):
+        groups = defaultdict(set)
+        for hardware_type, device_id in keys:
+            groups[transmission_model(hardware_type)].add(device_id)
+
+        latest = {}
+        for model, device_ids in groups.items():
+            for device_id, row in hotwindow.last_rows(model, device_ids).items():
+                latest[(model, device_id)] = row
+            device_ids = {device_id for device_id in device_ids if (model, str(device_id)) not in latest}
+            if not device_ids:
+                continue
+
+            column = DEVICE_COLUMNS[model][0]
+            # one (device, timestamp_origin) index seek per device, then
+            # the rows are fetched by id
+            last_ids = Device.objects.filter(device_id__in=device_ids).annotate(
+                last_id=Subquery(
+                    model.objects.filter(device=OuterRef('pk')).order_by(
+                        '-timestamp_origin', '-id'
+                    ).values('id')[:1]
+                )
+            ).values('last_id')
+            rows = with_device_column(model, model.objects.filter(id__in=last_ids))
+            for row in rows.values('id', *row_fields(model)):
+                latest[(model, str(row[column]))] = row
+
+        return [
+            latest.get((transmission_model(hardware_type), str(device_id)))
+            for hardware_type, device_id in keys
+        ]
+
+
+class InstalledLoader(BatchLoader):
+    """
+    Keys are Device primary keys. Values tell if the device has an
+    installation.
+    """
+    def load_batch(self, keys):
+        installed = set(
+            Installation.objects.filter(device_id__in=keys).values_list(
+                'device_id',
+                flat=True
+            ).distinct()
+        )
+        return [key in installed for key in keys]
+
+
+class Loaders:
+    def __init__(self, timing=None):
+        self.transmission_count = TransmissionCountLoader(timing)
+        self.last_transmission = LastTransmissionLoader(timing)
+        self.installed = InstalledLoader(timing)
+
+
+def get_loaders(context):
+    """
+    Return the loaders bound to a GraphQL context (the Django request),
+    creating them on first use.
+    """
+    loaders = getattr(context, 'greenhouse_loaders', None)
+    if loaders is None:
+        loaders = Loaders(getattr(context, 'graphql_timing', None))
+        if context is not None:
+            context.greenhouse_loaders = loaders
+    return loaders
@@ -0,0 +1,75 @@
+from time import perf_counter
+from django.core.management.base import BaseCommand
+from greenhouse.bench import (bulk_insert, device_macs, esp_readings,
+                              scratch_database, table_bytes, timed)
+from greenhouse.columnar import (CHUNK_MODELS, _row_values, column_summary,
+                                 compact_transmissions, read_columns)
+from greenhouse.models import Device, ESPTransmission
+from greenhouse.timeseries import device_transmissions, sensor_summary
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a scratch database with ESP transmissions, compact them into '
+        'columnar chunks and compare bytes per row and the read and '
+        'summary speed of a device history from rows and from chunks.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000)
+        parser.add_argument('--devices', type=int, default=20)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        devices = device_macs(options['devices'])
+        per_device = options['rows'] // len(devices)
+        start = 1668000000 - 1668000000 % 86400
+        end = start + per_device * 60
+
+        with scratch_database() as connection:
+            self.stdout.write(f'Seeding {per_device * len(devices)} rows...')
+            for mac in devices:
+                bulk_insert(ESPTransmission, esp_readings(Device(device_id=mac), start, per_device))
+
+            started = perf_counter()
+            chunks, rows = compact_transmissions(ESPTransmission, until=end + 86400)
+            elapsed = perf_counter() - started
+            self.stdout.write(
+                f'compacted {rows} rows into {chunks} chunks in {elapsed:.1f}s '
+                f'({rows / elapsed:.0f} rows/s)'
+            )
+
+            row_bytes = table_bytes(connection, ESPTransmission)
+            chunk_bytes = table_bytes(connection, CHUNK_MODELS[ESPTransmission])
+            if row_bytes is None or chunk_bytes is None:
+                self.stdout.write('table sizes are not available on this database')
+            else:
+                self.stdout.write(
+                    f'bytes/row: rows {row_bytes / rows:6.1f} | chunks {chunk_bytes / rows:6.1f} | '
+                    f'{row_bytes / chunk_bytes:.1f}x smaller'
+                )
+
+            device = Device.objects.get(device_id=devices[len(devices) // 2])
+            # unaligned, so the summary reads raw rows rather than rollups
+            summary_start, summary_end = start + 30, end - 30
+            timings = {
+                'read history': (
+                    lambda: _row_values(ESPTransmission, device_transmissions(ESPTransmission, device)),
+                    lambda: read_columns(ESPTransmission, device),
+                ),
+                'temperature summary': (
+                    lambda: sensor_summary(
+                        ESPTransmission, device, 'temperature_sensor', summary_start, summary_end
+                    ),
+                    lambda: column_summary(
+                        ESPTransmission, device, 'temperature_sensor', summary_start, summary_end
+                    ),
+                ),
+            }
+            for name, (from_rows, from_chunks) in timings.items():
+                rows_time, _ = timed(from_rows, options['repeat'])
+                chunks_time, _ = timed(from_chunks, options['repeat'])
+                self.stdout.write(
+                    f'{name:>20} of {per_device} rows: rows {rows_time * 1000:8.1f}ms | '
+                    f'chunks {chunks_time * 1000:8.1f}ms | {rows_time / chunks_time:5.1f}x'
+                )
@@ -0,0 +1,51 @@
+import json
+from ast import literal_eval
+from time import perf_counter
+from django.core.management.base import BaseCommand
+from greenhouse.bench import device_macs, esp_readings
+from greenhouse.decoders import ESP, decode_binary, decode_json, decode_text, encode_binary
+from greenhouse.models import Device
+
+
+class Command(BaseCommand):
+    help = 'Compare messages/second of every payload decoder against literal_eval.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=100000)
+
+    def handle(self, *args, **options):
+        count = options['messages']
+        macs = device_macs(100)
+        readings = [
+            (tx.device.device_id, tx.timestamp_origin, tx.ldr_sensor,
+             tx.temperature_sensor, tx.pressure, tx.moisture)
+            for mac in macs
+            for tx in esp_readings(Device(device_id=mac), 1668000000, count // len(macs) + 1)
+        ][:count]
+
+        text = [str(list(values)).encode('utf-8') for values in readings]
+        payloads = {
+            'literal_eval': (
+                text,
+                lambda payload: literal_eval(payload.decode('utf-8'))
+            ),
+            'text': (text, decode_text),
+            'json': ([json.dumps(values).encode('utf-8') for values in readings], decode_json),
+            'binary': (
+                [encode_binary(ESP, values) for values in readings],
+                lambda payload: decode_binary(ESP, payload)
+            ),
+        }
+
+        baseline = None
+        for name, (messages, decode) in payloads.items():
+            start = perf_counter()
+            for payload in messages:
+                decode(payload)
+            rate = len(messages) / (perf_counter() - start)
+            baseline = baseline or rate
+            size = sum(len(payload) for payload in messages) / len(messages)
+            self.stdout.write(
+                f'{name:>12}: {rate:>10.0f} msg/s  {rate / baseline:5.1f}x  '
+                f'{size:5.1f} bytes/msg'
+            )
@@ -0,0 +1,101 @@
+from django.core.management.base import BaseCommand
+from greenhouse.bench import (bulk_insert, device_macs, esp_readings,
+                              scratch_database, timed)
+from greenhouse.models import Device, ESPTransmission
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a scratch database with ESP transmissions and compare query '
+        'plans and timings of the per-device resolvers with and without '
+        'the unique (device, timestamp_origin) index.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000)
+        parser.add_argument('--devices', type=int, default=100)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        devices = device_macs(options['devices'])
+        per_device = options['rows'] // len(devices)
+        start = 1668000000
+        window_start = start + per_device * 60 - 86400
+
+        with scratch_database() as connection:
+            self.stdout.write(f'Seeding {per_device * len(devices)} rows...')
+            for mac in devices:
+                bulk_insert(ESPTransmission, esp_readings(Device(device_id=mac), start, per_device))
+
+            device = Device.objects.get(device_id=devices[len(devices) // 2])
+            queries = {
+                'transmission_count': lambda: ESPTransmission.objects.filter(
+                    device=device,
+                    timestamp_origin__gte=window_start
+                ).count(),
+                'transmissions': lambda: len(ESPTransmission.objects.filter(
+                    device=device,
+                    timestamp_origin__gte=window_start
+                )),
+                'last_transmission': lambda: ESPTransmission.objects.filter(
+                    device=device
+                ).order_by('-timestamp_origin', '-id').values().first(),
+            }
+
+            meta = ESPTransmission._meta
+            constraints = meta.constraints
+            constraint = constraints[0]
+            # SQLite drops a constraint by remaking the table from the model
+            # options, which must not list it anymore
+            meta.constraints = []
+            try:
+                with connection.schema_editor() as editor:
+                    editor.remove_constraint(ESPTransmission, constraint)
+            finally:
+                meta.constraints = constraints
+            without_index = self.run_queries(connection, queries, options['repeat'])
+
+            with connection.schema_editor() as editor:
+                editor.add_constraint(ESPTransmission, constraint)
+            with_index = self.run_queries(connection, queries, options['repeat'])
+
+        for name in queries:
+            before_plan, before_time = without_index[name]
+            after_plan, after_time = with_index[name]
+            self.stdout.write(f'\n== {name}')
+            self.stdout.write(f'without index: {before_time * 1000:.2f} ms')
+            self.stdout.write(f'    {before_plan}')
+            self.stdout.write(f'with index:    {after_time * 1000:.2f} ms')
+            self.stdout.write(f'    {after_plan}')
+            self.stdout.write(f'speedup: {before_time / after_time:.1f}x')
+
+    def run_queries(self, connection, queries, repeat):
+        results = {}
+        for name, query in queries.items():
+            plan = self.explain(connection, query)
+            elapsed, _ = timed(query, repeat)
+            results[name] = (plan, elapsed)
+        return results
+
+    @staticmethod
+    def explain(connection, query):
+        capture = _CaptureSQL()
+        with connection.execute_wrapper(capture):
+            query()
+        with connection.cursor() as cursor:
+            prefix = connection.ops.explain_query_prefix()
+            cursor.execute(f'{prefix} {capture.sql}', capture.params)
+            return ' | '.join(' '.join(str(col) for col in row) for row in cursor.fetchall())
+
+
+class _CaptureSQL:
+    """
+    Execute wrapper keeping the last SQL statement issued.
+    """
+    sql = None
+    params = None
+
+    def __call__(self, execute, sql, params, many, context):
+        self.sql = sql
+        self.params = params
+        return execute(sql, params, many, context)
@@ -0,0 +1,285 @@
+import asyncio
+import json
+import platform
+import threading
+from datetime import datetime
+from time import perf_counter, sleep
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import override_settings
+from greenhouse import decoders
+from greenhouse.bench import device_macs, esp_readings, hcsr04_readings, percentile, scratch_database
+from greenhouse.ingest import OVERFLOW_POLICIES
+from greenhouse.models import Device, ESPTransmission, SensorHCSR04
+from greenhouse.pubsub import hub
+
+
+MODES = ('direct', 'broker')
+FORMATS = {'text': '', 'json': '/json', 'bin': '/bin'}
+# keeps the transmissions of every run apart in the scratch database
+RUN_SPACING = 10 ** 7
+
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class FakeClient:
+    def publish(self, topic, payload):
+        pass
+
+
+class CommitProbe:
+    """
+    Records when every transmission is committed, through the same hub
+    that feeds GraphQL subscriptions.
+    """
+    def __init__(self):
+        self.committed = {}
+        self._ready = threading.Event()
+        self._loop = None
+        self._thread = threading.Thread(target=self._run, name='commit-probe', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._task.cancel)
+        self._thread.join()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        self._task = self._loop.create_task(self._listen())
+        try:
+            self._loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._loop.close()
+
+    async def _listen(self):
+        subscriber = hub.subscribe()
+        self._ready.set()
+        _, queue = subscriber
+        try:
+            while True:
+                transmissions = await queue.get()
+                now = perf_counter()
+                for transmission in transmissions:
+                    key = (transmission['device_id'], transmission['timestamp_origin'])
+                    self.committed.setdefault(key, now)
+        finally:
+            hub.unsubscribe(subscriber)
+
+
+class Command(BaseCommand):
+    help = (
+        'Simulate devices publishing transmissions, feed them to on_message '
+        'directly or through an MQTT broker, and report the end to end '
+        'latency (publish to committed row) and the sustained rows/second '
+        'as JSON. Runs against a scratch database.'
+    )
+
+    def add_arguments(self, parser):
+        config = settings.INGEST_CONFIG
+        parser.add_argument('--mode', choices=MODES + ('all',), default='direct')
+        parser.add_argument('--devices', type=int, default=50, help='ESP devices.')
+        parser.add_argument('--hcsr04-devices', type=int, default=10)
+        parser.add_argument(
+            '--rate',
+            type=float,
+            default=2.0,
+            help='Messages/second sent by every device, 0 to send as fast as possible.'
+        )
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds of load.')
+        parser.add_argument('--format', choices=FORMATS, default='text')
+        parser.add_argument('--drain-timeout', type=float, default=30.0)
+        parser.add_argument('--batch-size', type=int, default=config['BATCH_SIZE'])
+        parser.add_argument('--flush-interval', type=float, default=config['FLUSH_INTERVAL'])
+        parser.add_argument('--queue-size', type=int, default=config['QUEUE_SIZE'])
+        parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default=config['OVERFLOW'])
+        parser.add_argument('--host', default=settings.MQTT_CONFIG['MQTT_HOST'] or 'localhost')
+        parser.add_argument('--port', type=int, default=settings.MQTT_CONFIG['MQTT_PORT'] or 1883)
+        parser.add_argument('--qos', type=int, choices=(0, 1, 2), default=0)
+        parser.add_argument('--output', help='Write the JSON report to this file.')
+
+    def handle(self, *args, **options):
+        modes = MODES if options['mode'] == 'all' else (options['mode'],)
+        if options['devices'] + options['hcsr04_devices'] <= 0:
+            raise CommandError('Nothing to simulate, add some devices')
+
+        # the routes only exist for configured device topics
+        topics = override_settings(
+            LDR_DEVICE=settings.LDR_DEVICE or 'greenhouse/esp',
+            HCSR_DEVICE=settings.HCSR_DEVICE or 'greenhouse/hcsr04',
+        )
+        report = {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'config': {
+                key: options[key] for key in (
+                    'devices', 'hcsr04_devices', 'rate', 'duration', 'format',
+                    'batch_size', 'flush_interval', 'queue_size', 'overflow', 'qos'
+                )
+            },
+            'results': {},
+        }
+
+        with topics, scratch_database():
+            report['database'] = connection.vendor
+            for run, mode in enumerate(modes):
+                report['results'][mode] = self.run(mode, run * RUN_SPACING, options)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as report_file:
+                report_file.write(output)
+        self.stdout.write(output)
+
+    def messages(self, offset, options):
+        """
+        Yield (topic, payload, key) round robin over the devices, `key` being
+        the (device_id, timestamp_origin) the transmission is committed with.
+        """
+        suffix = FORMATS[options['format']]
+        devices = [
+            (decoders.ESP, settings.LDR_DEVICE + suffix, mac, esp_readings)
+            for mac in device_macs(options['devices'])
+        ] + [
+            (decoders.HCSR04, settings.HCSR_DEVICE + suffix, device_id, hcsr04_readings)
+            for device_id in range(1, options['hcsr04_devices'] + 1)
+        ]
+
+        readings = [
+            readings(Device(device_id=str(device_id)), 1668000000 + offset, 10 ** 7, step=1)
+            for _, _, device_id, readings in devices
+        ]
+        while True:
+            for (kind, topic, device_id, _), device_readings in zip(devices, readings):
+                tx = next(device_readings)
+                if kind == decoders.ESP:
+                    values = (device_id, tx.timestamp_origin, tx.ldr_sensor,
+                              tx.temperature_sensor, tx.pressure, tx.moisture)
+                else:
+                    values = (device_id, tx.timestamp_origin, tx.distance)
+
+                if options['format'] == 'bin':
+                    payload = decoders.encode_binary(kind, values)
+                elif options['format'] == 'json':
+                    payload = json.dumps(values).encode('utf-8')
+                else:
+                    payload = str(list(values)).encode('utf-8')
+                yield topic, payload, (str(device_id), tx.timestamp_origin)
+
+    def run(self, mode, offset, options):
+        from greenhouse import transmission_parser
+
+        writer = transmission_parser.start_writer(
+            batch_size=options['batch_size'],
+            flush_interval=options['flush_interval'],
+            queue_size=options['queue_size'],
+            overflow=options['overflow'],
+        )
+        probe = CommitProbe()
+        probe.start()
+
+        total_rate = options['rate'] * (options['devices'] + options['hcsr04_devices'])
+        count = int((total_rate or 1000) * options['duration'])
+        sent = {}
+        close = None
+        try:
+            if mode == 'direct':
+                fake_client = FakeClient()
+
+                def send(topic, payload):
+                    transmission_parser.on_message(fake_client, None, FakeMessage(topic, payload))
+            else:
+                send, close = self.connect_broker(transmission_parser, options)
+
+            start = perf_counter()
+            for i, (topic, payload, key) in enumerate(self.messages(offset, options)):
+                if i >= count:
+                    break
+                if total_rate:
+                    # latency counts from the scheduled time, so a slow
+                    # consumer is not hidden by a sender falling behind
+                    due = start + i / total_rate
+                    delay = due - perf_counter()
+                    if delay > 0:
+                        sleep(delay)
+                    sent[key] = due
+                else:
+                    sent[key] = perf_counter()
+                send(topic, payload)
+            sent_seconds = perf_counter() - start
+
+            deadline = perf_counter() + options['drain_timeout']
+            while len(probe.committed) < len(sent) and perf_counter() < deadline:
+                sleep(0.05)
+        finally:
+            if close is not None:
+                close()
+            writer.stop()
+            probe.stop()
+
+        latencies = [
+            (probe.committed[key] - sent_at) * 1000
+            for key, sent_at in sent.items()
+            if key in probe.committed
+        ]
+        last_commit = max(probe.committed.values(), default=start)
+        committed = len(latencies)
+        return {
+            'sent': len(sent),
+            'committed': committed,
+            'lost': len(sent) - committed,
+            'dropped': writer.dropped,
+            'rows': (
+                ESPTransmission.objects.filter(timestamp_origin__gte=1668000000 + offset).count()
+                + SensorHCSR04.objects.filter(timestamp_origin__gte=1668000000 + offset).count()
+            ),
+            'offered_per_second': total_rate or None,
+            'sent_per_second': len(sent) / sent_seconds,
+            'rows_per_second': committed / (last_commit - start) if committed else 0,
+            'p50_ms': percentile(latencies, 50),
+            'p99_ms': percentile(latencies, 99),
+            'max_ms': max(latencies, default=None),
+        }
+
+    def connect_broker(self, transmission_parser, options):
+        import paho.mqtt.client as mqttClient
+
+        suffix = FORMATS[options['format']]
+        topics = [(settings.LDR_DEVICE + suffix, options['qos']), (settings.HCSR_DEVICE + suffix, options['qos'])]
+        subscribed = threading.Event()
+
+        consumer = transmission_parser.create_client(f'bench-ingest-consumer-{id(self)}')
+        consumer.on_connect = lambda client, *args: client.subscribe(topics)
+        consumer.on_subscribe = lambda *args: subscribed.set()
+        publisher = mqttClient.Client(f'bench-ingest-publisher-{id(self)}')
+        try:
+            consumer.connect(options['host'], options['port'])
+            publisher.connect(options['host'], options['port'])
+        except OSError as e:
+            raise CommandError(f'Cannot reach the broker at {options["host"]}:{options["port"]}: {e}')
+        consumer.loop_start()
+        publisher.loop_start()
+        if not subscribed.wait(10):
+            raise CommandError('The broker did not acknowledge the subscription')
+
+        def send(topic, payload):
+            publisher.publish(topic, payload, qos=options['qos'])
+
+        def close():
+            publisher.loop_stop()
+            publisher.disconnect()
+            consumer.loop_stop()
+            consumer.disconnect()
+
+        return send, close
@@ -0,0 +1,177 @@
+import json
+import tracemalloc
+from datetime import datetime, timezone
+from statistics import median
+from time import perf_counter
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from greenhouse.bench import percentile, scratch_database, seed_dataset
+from greenhouse.statistics import hour_statistics
+from iot_api.schema import schema
+
+
+def representative_queries(macs, hcsr04_ids, start, end):
+    """
+    The queries the dashboards run, as name -> (query, variables), aimed at
+    the last day of the seeded data.
+    """
+    day_start = max(start, end - 86400)
+    iso = lambda timestamp: datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+    return {
+        'devices': ("""
+            {
+                devices {
+                    deviceId hardwareType transmissionCount isInstalled lastTransmission
+                }
+            }
+        """, {}),
+        'installation': ("""
+            query ($reference: String!, $start: DateTime) {
+                installation(reference: $reference, txDatetimeStart: $start) {
+                    reference latitude longitude
+                    device {
+                        deviceId transmissionCount lastTransmission
+                        transmissions(first: 100) { edges { node } }
+                    }
+                }
+            }
+        """, {'reference': 'installation-0', 'start': iso(day_start)}),
+        'esp_transmissions': ("""
+            query ($macs: [String], $gte: Int, $lte: Int) {
+                espTransmissions(
+                    first: 500, macAddress_In: $macs,
+                    timestampOrigin_Gte: $gte, timestampOrigin_Lte: $lte
+                ) {
+                    edges { node { macAddress timestampOrigin ldrSensor temperatureSensor } }
+                    pageInfo { hasNextPage endCursor }
+                }
+            }
+        """, {'macs': macs[:5], 'gte': day_start, 'lte': end}),
+        'hcsr04_readings': ("""
+            query ($mac: Int, $gte: Int, $lte: Int) {
+                hcsr04Readings(first: 500, mac: $mac, timestampOrigin_Gte: $gte, timestampOrigin_Lte: $lte) {
+                    edges { node { mac timestampOrigin distance } }
+                    pageInfo { hasNextPage endCursor }
+                }
+            }
+        """, {'mac': int(hcsr04_ids[0]) if hcsr04_ids else 0, 'gte': day_start, 'lte': end}),
+        'transmission_buckets': ("""
+            query ($device: String!, $start: DateTime!, $end: DateTime!) {
+                transmissionBuckets(deviceId: $device, start: $start, end: $end, bucket: 3600) {
+                    bucketStart count temperatureSensor { avg min max }
+                }
+            }
+        """, {'device': macs[0], 'start': iso(start - start % 86400), 'end': iso(end)}),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a scratch database with devices and realistic transmissions, '
+        'then report latency, database queries and peak memory of the '
+        'representative GraphQL queries.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=20, help='Installed ESP devices.')
+        parser.add_argument('--hcsr04-devices', type=int, default=5)
+        parser.add_argument('--transmissions', type=int, default=10000, help='Readings per device.')
+        parser.add_argument('--step', type=int, default=60, help='Seconds between readings.')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--query', nargs='+', help='Only run these queries.')
+        parser.add_argument('--json', action='store_true', help='Print a JSON report')
+
+    def handle(self, *args, **options):
+        if options['devices'] < 1:
+            raise CommandError('At least one ESP device is needed')
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be at least 1')
+
+        with scratch_database():
+            start = perf_counter()
+            macs, hcsr04_ids, (first, last) = seed_dataset(
+                options['devices'],
+                options['hcsr04_devices'],
+                options['transmissions'],
+                step=options['step']
+            )
+            seeded = perf_counter() - start
+
+            queries = representative_queries(macs, hcsr04_ids, first, last)
+            names = options['query'] or list(queries)
+            unknown = set(names) - set(queries)
+            if unknown:
+                raise CommandError(
+                    f'Unknown queries {", ".join(sorted(unknown))}, '
+                    f'choose from {", ".join(queries)}'
+                )
+
+            report = {
+                'devices': options['devices'],
+                'hcsr04_devices': options['hcsr04_devices'],
+                'transmissions_per_device': options['transmissions'],
+                'seed_seconds': seeded,
+                'database': connection.vendor,
+                'queries': {
+                    name: self.measure(*queries[name], options['repeat'])
+                    for name in names
+                },
+            }
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write(
+            f'{options["devices"]} + {options["hcsr04_devices"]} devices x '
+            f'{options["transmissions"]} transmissions, seeded in {seeded:.1f}s'
+        )
+        for name, result in report['queries'].items():
+            self.stdout.write(
+                f'{name:>22}: cold {result["cold_ms"]:8.1f}ms | '
+                f'p50 {result["p50_ms"]:8.1f}ms | p99 {result["p99_ms"]:8.1f}ms | '
+                f'{result["db_queries"]:4} queries | '
+                f'peak {result["peak_memory_kb"]:9.1f}KB'
+            )
+
+    def run_query(self, query, variables):
+        # a new request per execution, as loaders are request scoped
+        result = schema.execute(
+            query,
+            variables=variables,
+            context_value=RequestFactory().post('/graphql/')
+        )
+        if result.errors:
+            raise CommandError(f'Query failed: {result.errors[0]}')
+        return result
+
+    def measure(self, query, variables, repeat):
+        hour_statistics.invalidate()
+        with CaptureQueriesContext(connection) as captured:
+            start = perf_counter()
+            self.run_query(query, variables)
+            cold = perf_counter() - start
+
+        latencies = []
+        for _ in range(repeat):
+            start = perf_counter()
+            self.run_query(query, variables)
+            latencies.append((perf_counter() - start) * 1000)
+
+        # tracemalloc slows everything down, so memory gets its own run
+        tracemalloc.start()
+        try:
+            self.run_query(query, variables)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        return {
+            'cold_ms': cold * 1000,
+            'p50_ms': median(latencies),
+            'p99_ms': percentile(latencies, 99),
+            'db_queries': len(captured),
+            'peak_memory_kb': peak / 1024,
+        }
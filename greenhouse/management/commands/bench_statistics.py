@@ -0,0 +1,110 @@
+from datetime import datetime
+import pandas as pd
+import pytz
+from django.core.management.base import BaseCommand
+from greenhouse.bench import bulk_insert, esp_readings, scratch_database, timed
+from greenhouse.models import Device, ESPTransmission
+from greenhouse.statistics import hour_relative_freq
+
+
+def hour_relative_freq_legacy(transmissions, period):
+    """
+    Row by row implementation of `hour_relative_freq`, the reference the
+    vectorized version is tested and benchmarked against.
+    """
+    data = []
+    for tx in transmissions:
+        dt = datetime.fromtimestamp(tx.timestamp_origin).astimezone(
+            pytz.timezone('America/Sao_Paulo')
+        )
+        data.append([
+            dt,
+            tx.ldr_sensor,
+            tx.temperature_sensor,
+            tx.pressure,
+            tx.moisture
+        ])
+
+    # set up dataframe
+    df = pd.DataFrame(data, columns=['DATETIME', 'LDR', 'TEMP', 'PRES', 'MOIS'])
+    df = df.set_index(df['DATETIME'])
+
+    df['HOUR'] = df.index.round(freq=period).strftime('%H:'+'%M')
+    df['F'] = df.HOUR.value_counts(normalize=True)
+
+    # calculate sensor value differences
+    df['LDR_DIFF'] = df.LDR.diff().fillna(0)
+    df['TEMP_DIFF'] = df.TEMP.diff().fillna(0)
+    df['PRES_DIFF'] = df.PRES.diff().fillna(0)
+    df['MOIS_DIFF'] = df.MOIS.diff().fillna(0)
+
+    # group diff sums by time
+    df = df[['LDR_DIFF', 'TEMP_DIFF', 'PRES_DIFF', 'MOIS_DIFF', 'HOUR', 'F']].groupby('HOUR').sum()
+
+    # calculate the relative frequency
+    df['LDR_REL_FREQ'] = df['LDR_DIFF'] / df.LDR_DIFF.sum()
+    df['TEMP_REL_FREQ'] = df['TEMP_DIFF'] / df.TEMP_DIFF.sum()
+    df['PRES_REL_FREQ'] = df['PRES_DIFF'] / df.PRES_DIFF.sum()
+    df['MOIS_REL_FREQ'] = df['MOIS_DIFF'] / df.MOIS_DIFF.sum()
+
+    # caulcutae positive and negative deviations
+    df['LDR_POS_STD'] = df[['LDR_REL_FREQ', 'F']].T.var() + (df.LDR_REL_FREQ + df[['LDR_REL_FREQ', 'F']].T.std())
+    df['LDR_NEG_STD'] = df[['LDR_REL_FREQ', 'F']].T.var() + (df.LDR_REL_FREQ - df[['LDR_REL_FREQ', 'F']].T.std())
+
+    df['TEMP_POS_STD'] = df[['TEMP_REL_FREQ', 'F']].T.var() + (df.TEMP_REL_FREQ + df[['TEMP_REL_FREQ', 'F']].T.std())
+    df['TEMP_NEG_STD'] = df[['TEMP_REL_FREQ', 'F']].T.var() + (df.TEMP_REL_FREQ - df[['TEMP_REL_FREQ', 'F']].T.std())
+
+    df['PRES_POS_STD'] = df[['PRES_REL_FREQ', 'F']].T.var() + (df.PRES_REL_FREQ + df[['PRES_REL_FREQ', 'F']].T.std())
+    df['PRES_NEG_STD'] = df[['PRES_REL_FREQ', 'F']].T.var() + (df.PRES_REL_FREQ - df[['PRES_REL_FREQ', 'F']].T.std())
+
+    df['MOIS_POS_STD'] = df[['MOIS_REL_FREQ', 'F']].T.var() + (df.MOIS_REL_FREQ + df[['PRES_REL_FREQ', 'F']].T.std())
+    df['MOIS_NEG_STD'] = df[['MOIS_REL_FREQ', 'F']].T.var() + (df.MOIS_REL_FREQ - df[['PRES_REL_FREQ', 'F']].T.std())
+
+    df[['LDR_REL_FREQ', 'LDR_POS_STD', 'LDR_NEG_STD']] = (df[['LDR_REL_FREQ', 'LDR_POS_STD', 'LDR_NEG_STD']].clip(0)) * 100
+    df[['TEMP_REL_FREQ', 'TEMP_POS_STD', 'TEMP_NEG_STD']] = (df[['TEMP_REL_FREQ', 'TEMP_POS_STD', 'TEMP_NEG_STD']].clip(0)) * 100
+    df[['PRES_REL_FREQ', 'PRES_POS_STD', 'PRES_NEG_STD']] = (df[['PRES_REL_FREQ', 'PRES_POS_STD', 'PRES_NEG_STD']].clip(0)) * 100
+    df[['MOIS_REL_FREQ', 'MOIS_POS_STD', 'MOIS_NEG_STD']] = (df[['MOIS_REL_FREQ', 'MOIS_POS_STD', 'MOIS_NEG_STD']].clip(0)) * 100
+
+    return df.fillna(0).round(2)
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the row by row and the vectorized hour_relative_freq on '
+        'scratch databases of increasing size, including the database read.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            default=[10000, 100000, 1000000]
+        )
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            seeded = 0
+            for size in sorted(options['sizes']):
+                seeded += bulk_insert(
+                    ESPTransmission,
+                    esp_readings(Device(device_id='AA:BB:CC:DD:EE:FF'), 1668000000 + seeded * 60, size - seeded)
+                )
+                transmissions = ESPTransmission.objects.order_by('timestamp_origin', 'id')
+
+                legacy_time, legacy = timed(
+                    lambda: hour_relative_freq_legacy(transmissions, '3600S'),
+                    options['repeat']
+                )
+                vectorized_time, vectorized = timed(
+                    lambda: hour_relative_freq(transmissions, '3600S'),
+                    options['repeat']
+                )
+                difference = (legacy - vectorized).abs().max().max()
+                self.stdout.write(
+                    f'{size:>9} rows: row by row {legacy_time:8.3f}s | '
+                    f'vectorized {vectorized_time:8.3f}s | '
+                    f'speedup {legacy_time / vectorized_time:6.1f}x | '
+                    f'max difference {difference:.2f}'
+                )
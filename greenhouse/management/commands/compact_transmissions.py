@@ -0,0 +1,59 @@
+from time import perf_counter
+from django.core.management.base import BaseCommand, CommandError
+from greenhouse.columnar import compact_transmissions
+from greenhouse.models import Device, ESPTransmission, SensorHCSR04
+
+
+MODELS = {
+    'esp': ESPTransmission,
+    'hcsr04': SensorHCSR04,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Write the columnar chunks (see greenhouse.columnar) of every '
+        'closed day of raw transmissions that is new or changed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--model',
+            choices=list(MODELS) + ['all'],
+            default='all'
+        )
+        parser.add_argument('--device', help='Only compact transmissions of this device')
+        parser.add_argument(
+            '--since',
+            type=int,
+            help='Only compact from this unix timestamp on (rounded down to the day)'
+        )
+        parser.add_argument(
+            '--replace',
+            action='store_true',
+            help=(
+                'Rewrite changed chunks from the rows in the table alone, '
+                'dropping the pruned rows they hold.'
+            )
+        )
+
+    def handle(self, *args, **options):
+        device = None
+        if options['device'] is not None:
+            device = Device.objects.filter(device_id=options['device']).first()
+            if device is None:
+                raise CommandError(f'Unknown device {options["device"]}')
+
+        names = MODELS if options['model'] == 'all' else [options['model']]
+        for name in names:
+            start = perf_counter()
+            chunks, rows = compact_transmissions(
+                MODELS[name],
+                device=device,
+                since=options['since'],
+                replace=options['replace']
+            )
+            self.stdout.write(
+                f'{name}: compacted {rows} transmissions into {chunks} chunks '
+                f'in {perf_counter() - start:.1f}s'
+            )
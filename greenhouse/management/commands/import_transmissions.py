@@ -0,0 +1,86 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter
+from django.core.management.base import BaseCommand, CommandError
+from greenhouse.backfill import ImportStats, dump_format, import_dump, refresh_derived
+from greenhouse.workers import setup_django
+
+
+class Command(BaseCommand):
+    help = (
+        'Import transmission dumps (CSV or NDJSON, optionally gzipped) '
+        'skipping rows already stored, then rebuild the rollups of the '
+        'imported devices.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+')
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Rows per transaction.')
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=1,
+            help='Files imported in parallel, each by its own process (PostgreSQL).'
+        )
+        parser.add_argument('--max-errors', type=int, help='Abort a file after this many invalid rows.')
+        parser.add_argument(
+            '--no-rollups',
+            action='store_true',
+            help='Do not rebuild the rollups, e.g. to run rebuild_rollups once after several imports. '
+                 'Cached results are invalidated all the same.'
+        )
+
+    def handle(self, *args, **options):
+        paths = options['paths']
+        try:
+            for path in paths:
+                dump_format(path)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        total = ImportStats()
+        start = perf_counter()
+        try:
+            for stats in self.import_files(paths, options):
+                total.merge(stats)
+                self.stdout.write(
+                    f'{stats.path}: {stats.imported} imported, {stats.duplicates} '
+                    f'duplicates, {stats.invalid} invalid of {stats.rows} rows'
+                )
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        elapsed = perf_counter() - start
+
+        for error, count in total.errors.most_common(5):
+            self.stdout.write(f'  {count} rows: {error}')
+
+        if total.since:
+            # cached results are stale even when the rollups are rebuilt later
+            rollup_start = perf_counter()
+            refresh_derived(total, rollups=not options['no_rollups'])
+            if not options['no_rollups']:
+                self.stdout.write(
+                    f'Rebuilt rollups of {len(total.since)} devices in '
+                    f'{perf_counter() - rollup_start:.1f}s'
+                )
+
+        self.stdout.write(
+            f'Imported {total.imported} of {total.rows} rows in {elapsed:.1f}s, '
+            f'{total.rows / elapsed if elapsed else 0:.0f} rows/s'
+        )
+
+    def import_files(self, paths, options):
+        kwargs = dict(chunk_size=options['chunk_size'], max_errors=options['max_errors'])
+        if options['jobs'] <= 1 or len(paths) == 1:
+            for path in paths:
+                yield import_dump(path, **kwargs)
+            return
+
+        with ProcessPoolExecutor(
+            max_workers=options['jobs'],
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=setup_django
+        ) as pool:
+            futures = [pool.submit(import_dump, path, **kwargs) for path in paths]
+            for future in as_completed(futures):
+                yield future.result()
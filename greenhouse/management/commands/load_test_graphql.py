@@ -0,0 +1,77 @@
+import json
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from django.core.management.base import BaseCommand
+from greenhouse.bench import percentile
+
+
+DEFAULT_QUERY = '{ devices { deviceId transmissionCount isInstalled lastTransmission } }'
+
+
+class Command(BaseCommand):
+    help = (
+        'Fire concurrent GraphQL requests at one or more running endpoints, '
+        'e.g. the WSGI /graphql/ and the ASGI /graphql/async/, and report '
+        'throughput and latency of each.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'urls',
+            nargs='+',
+            help='Endpoints, e.g. http://localhost:8890/graphql/ http://localhost:8891/graphql/async/'
+        )
+        parser.add_argument('--query', default=DEFAULT_QUERY)
+        parser.add_argument('--concurrency', type=int, default=32)
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--timeout', type=float, default=60)
+        parser.add_argument('--json', action='store_true', help='Print a JSON report')
+
+    def handle(self, *args, **options):
+        body = json.dumps({'query': options['query']}).encode('utf-8')
+        report = {}
+        for url in options['urls']:
+            report[url] = self.run(url, body, options)
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        for url, result in report.items():
+            self.stdout.write(
+                f'{url}: {result["requests_per_second"]:.1f} req/s, '
+                f'p50 {result["p50_ms"]:.1f}ms, p99 {result["p99_ms"]:.1f}ms, '
+                f'{result["errors"]} errors'
+            )
+
+    def run(self, url, body, options):
+        def request(_):
+            start = perf_counter()
+            try:
+                http_request = urllib.request.Request(
+                    url,
+                    data=body,
+                    headers={'Content-Type': 'application/json'}
+                )
+                with urllib.request.urlopen(http_request, timeout=options['timeout']) as response:
+                    ok = 'errors' not in json.loads(response.read())
+            except Exception:
+                ok = False
+            return perf_counter() - start, ok
+
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            results = list(pool.map(request, range(options['requests'])))
+        elapsed = perf_counter() - start
+
+        latencies = [latency * 1000 for latency, _ in results]
+        return {
+            'requests': len(results),
+            'concurrency': options['concurrency'],
+            'errors': sum(1 for _, ok in results if not ok),
+            'seconds': elapsed,
+            'requests_per_second': len(results) / elapsed,
+            'p50_ms': percentile(latencies, 50),
+            'p99_ms': percentile(latencies, 99),
+        }
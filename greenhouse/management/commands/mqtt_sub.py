@@ -1,12 +1,97 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from greenhouse.transmission_parser import subscribe
+from greenhouse.ingest import OVERFLOW_POLICIES
+from greenhouse.metrics import serve_metrics
+from greenhouse.workers import SHARDING_MODES, Supervisor
 
 
 class Command(BaseCommand):
     def add_arguments(self, parser):
-        # parser.add_argument('--name', type=int)
-        ...
+        config = settings.INGEST_CONFIG
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=config['BATCH_SIZE'],
+            help='Max rows written per flush.'
+        )
+        parser.add_argument(
+            '--flush-interval',
+            type=float,
+            default=config['FLUSH_INTERVAL'],
+            help='Max seconds a row waits in the buffer before being flushed.'
+        )
+        parser.add_argument(
+            '--queue-size',
+            type=int,
+            default=config['QUEUE_SIZE'],
+            help='Max rows buffered between the MQTT loop and the writer.'
+        )
+        parser.add_argument(
+            '--overflow',
+            choices=OVERFLOW_POLICIES,
+            default=config['OVERFLOW'],
+            help='What to do when the buffer is full.'
+        )
+        parser.add_argument(
+            '--recent-keys',
+            type=int,
+            default=config['RECENT_KEYS'],
+            help='Recent transmission keys remembered to drop redeliveries, 0 disables it.'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of consumer processes, restarted when they die.'
+        )
+        parser.add_argument(
+            '--sharding',
+            choices=SHARDING_MODES,
+            default='hash',
+            help=(
+                'How messages are spread over the workers: a hash of the '
+                'device id, so one worker writes all the rows and rollups of '
+                'a device, or an MQTT v5 shared subscription, which spreads '
+                'the load without every worker receiving every message.'
+            )
+        )
+        parser.add_argument(
+            '--group',
+            default='greenhouse',
+            help='Shared subscription group name.'
+        )
+        parser.add_argument(
+            '--metrics-port',
+            type=int,
+            help=(
+                'Serve Prometheus metrics on this port, the worker N of '
+                '--workers on this port + N.'
+            )
+        )
 
     def handle(self, *args, **options):
+        writer_options = dict(
+            batch_size=options['batch_size'],
+            flush_interval=options['flush_interval'],
+            queue_size=options['queue_size'],
+            overflow=options['overflow'],
+            recent_keys=options['recent_keys'],
+        )
+        if options['workers'] > 1:
+            print(f'Starting {options["workers"]} mosquitto workers')
+            Supervisor(options['workers'], args=(
+                options['sharding'],
+                options['group'],
+                settings.MQTT_CONFIG['MQTT_CLIENT'],
+                writer_options,
+                options['metrics_port'],
+            )).run()
+            return
+
+        from greenhouse.transmission_parser import subscribe
+
+        if options['metrics_port']:
+            serve_metrics(options['metrics_port'])
+
         print('Staring mosquitto daemon')
-        subscribe()
+        subscribe(**writer_options)
@@ -0,0 +1,69 @@
+from time import perf_counter
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from greenhouse.graphql_cache import invalidate_history
+from greenhouse.retention import (ARCHIVE_FORMATS, RETENTION_MODELS, prune_minute_rollups,
+                                  prune_model, pyarrow, retention_cutoff)
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete raw transmissions and 1 minute rollups older than their '
+        'retention (settings.TRANSMISSION_RETENTION_DAYS), in small '
+        'transactions, optionally archiving the raw rows first.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--model',
+            choices=list(RETENTION_MODELS) + ['all'],
+            default='all'
+        )
+        parser.add_argument('--days', type=int, help='Override the configured retention of raw rows.')
+        parser.add_argument(
+            '--archive',
+            choices=ARCHIVE_FORMATS,
+            help=f'Archive pruned rows under {settings.TRANSMISSION_ARCHIVE_DIR} first.'
+        )
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows deleted per transaction.')
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0,
+            help='Seconds to sleep between transactions, to let the ingest write.'
+        )
+
+    def handle(self, *args, **options):
+        if options['archive'] == 'parquet' and pyarrow is None:
+            raise CommandError('Parquet archives require pyarrow')
+
+        retention = settings.TRANSMISSION_RETENTION_DAYS
+        names = RETENTION_MODELS if options['model'] == 'all' else [options['model']]
+        for name in names:
+            model = RETENTION_MODELS[name]
+            days = options['days'] if options['days'] is not None else retention[name]
+            if days:
+                start = perf_counter()
+                deleted = prune_model(
+                    model,
+                    retention_cutoff(days),
+                    batch_size=options['batch_size'],
+                    archive_format=options['archive'],
+                    pause=options['pause']
+                )
+                invalidate_history(str(device_id) for device_id in deleted)
+                self.stdout.write(
+                    f'{name}: deleted {sum(deleted.values())} transmissions older than '
+                    f'{days} days of {len(deleted)} devices in {perf_counter() - start:.1f}s'
+                )
+            else:
+                self.stdout.write(f'{name}: raw transmissions are kept forever')
+
+            if retention['minute_rollups']:
+                deleted = prune_minute_rollups(
+                    model,
+                    retention_cutoff(retention['minute_rollups']),
+                    batch_size=options['batch_size'],
+                    pause=options['pause']
+                )
+                self.stdout.write(f'{name}: deleted {deleted} 1 minute rollups')
@@ -0,0 +1,57 @@
+from time import perf_counter
+from django.core.management.base import BaseCommand, CommandError
+from greenhouse.models import Device, ESPTransmission, SensorHCSR04
+from greenhouse.rollups import rebuild_rollups
+
+
+MODELS = {
+    'esp': ESPTransmission,
+    'hcsr04': SensorHCSR04,
+}
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the 1 minute, 1 hour and 1 day rollups from raw transmissions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--model',
+            choices=list(MODELS) + ['all'],
+            default='all'
+        )
+        parser.add_argument('--device', help='Only rebuild rollups of this device')
+        parser.add_argument(
+            '--since',
+            type=int,
+            help='Only rebuild from this unix timestamp on (rounded down to the day)'
+        )
+        parser.add_argument(
+            '--all-days',
+            action='store_true',
+            help=(
+                'Also rebuild the days whose rollups count more transmissions than '
+                'their raw rows: after deleting duplicates, but losing the history '
+                'of days pruned since.'
+            )
+        )
+
+    def handle(self, *args, **options):
+        device = None
+        if options['device'] is not None:
+            device = Device.objects.filter(device_id=options['device']).first()
+            if device is None:
+                raise CommandError(f'Unknown device {options["device"]}')
+
+        names = MODELS if options['model'] == 'all' else [options['model']]
+        for name in names:
+            start = perf_counter()
+            rows = rebuild_rollups(
+                MODELS[name],
+                device=device,
+                since=options['since'],
+                all_days=options['all_days']
+            )
+            elapsed = perf_counter() - start
+            self.stdout.write(
+                f'{name}: rolled up {rows} transmissions in {elapsed:.1f}s'
+            )
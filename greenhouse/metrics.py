@@ -0,0 +1,178 @@
+"""
+In-process metrics rendered in the Prometheus text format.
+
+Metrics are kept per process: the web server exposes its registry on
+/metrics and `mqtt_sub --metrics-port` exposes the ingest one.
+"""
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500, 1000, 10000)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._values.get(key, (None, 0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(tuple(sorted(labels.items())), ([], 0))
+        return sum(counts)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', key + (('le', _format_value(bound)),), cumulative))
+            samples.append((f'{self.name}_sum', key, total))
+            samples.append((f'{self.name}_count', key, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args)
+            elif not isinstance(metric, cls):
+                raise ValueError(f'Metric {name} is already registered as a {metric.type}')
+            return metric
+
+    def counter(self, name, help):
+        return self._register(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self._register(Gauge, name, help)
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        return self._register(Histogram, name, help, buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class QueryCounter:
+    """
+    Database execute wrapper counting the queries run through it.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port, address=''):
+    """
+    Serve the registry over HTTP from a daemon thread, for processes
+    without a web server such as mqtt_sub.
+    """
+    server = ThreadingHTTPServer((address, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
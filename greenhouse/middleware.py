@@ -0,0 +1,103 @@
+from contextlib import ExitStack
+from functools import partial
+from time import perf_counter
+from django.db import connections
+from django.db.models import QuerySet
+from graphene.types.resolver import attr_resolver, dict_or_attr_resolver, dict_resolver
+from promise import Promise
+from greenhouse.metrics import COUNT_BUCKETS, QueryCounter, registry
+
+
+RESOLVE_SECONDS = registry.histogram(
+    'greenhouse_graphql_resolve_seconds',
+    'Time spent resolving a GraphQL field.'
+)
+RESOLVE_QUERIES = registry.histogram(
+    'greenhouse_graphql_resolve_queries',
+    'SQL queries run while resolving a GraphQL field.',
+    COUNT_BUCKETS
+)
+RESOLVE_ROWS = registry.histogram(
+    'greenhouse_graphql_resolve_rows',
+    'Rows returned by a GraphQL field.',
+    COUNT_BUCKETS
+)
+
+DEFAULT_RESOLVERS = (attr_resolver, dict_or_attr_resolver, dict_resolver)
+
+
+def counting_queries():
+    """
+    Count the queries run on every database connection within the block.
+    """
+    counter = QueryCounter()
+    stack = ExitStack()
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(counter))
+    return stack, counter
+
+
+def row_count(value):
+    if value is None:
+        return 0
+    if isinstance(value, (list, tuple)):
+        return len(value)
+    edges = getattr(value, 'edges', None)
+    if isinstance(edges, list):
+        return len(edges)
+    return 1
+
+
+def is_default_resolver(info):
+    resolver = info.parent_type.fields[info.field_name].resolver
+    return isinstance(resolver, partial) and resolver.func in DEFAULT_RESOLVERS
+
+
+class TimingMiddleware:
+    """
+    Records resolve time, SQL queries and rows of every field with its own
+    resolver into the metrics registry, and into `graphql_timing` of the
+    request when the view asks for it.
+
+    Values coming from DataLoaders are timed until the promise resolves;
+    the batched queries themselves are recorded by the loaders.
+    """
+    def resolve(self, next, root, info, **args):
+        if is_default_resolver(info):
+            return next(root, info, **args)
+
+        start = perf_counter()
+        stack, counter = counting_queries()
+        with stack:
+            result = next(root, info, **args)
+            # graphql-core wraps plain values of the next layers in promises
+            if isinstance(result, Promise) and result.is_fulfilled:
+                result = result.get()
+            if isinstance(result, QuerySet):
+                # evaluate here so the queries are accounted to this field
+                result = list(result)
+
+        field = f'{info.parent_type.name}.{info.field_name}'
+        if Promise.is_thenable(result):
+            return Promise.resolve(result).then(
+                lambda value: self.record(info, field, start, counter.count, value)
+            )
+        return self.record(info, field, start, counter.count, result)
+
+    def record(self, info, field, start, queries, value):
+        elapsed = perf_counter() - start
+        rows = row_count(value)
+        RESOLVE_SECONDS.observe(elapsed, field=field)
+        RESOLVE_QUERIES.observe(queries, field=field)
+        RESOLVE_ROWS.observe(rows, field=field)
+
+        timing = getattr(info.context, 'graphql_timing', None)
+        if timing is not None:
+            timing.append({
+                'path': [str(key) for key in info.path],
+                'field': field,
+                'duration_ms': elapsed * 1000,
+                'queries': queries,
+                'rows': rows,
+            })
+        return value
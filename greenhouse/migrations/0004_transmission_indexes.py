@@ -0,0 +1,21 @@
+# Generated by Django 3.2.9 on 2026-10-18 18:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('greenhouse', '0003_sensorhcsr04'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='esptransmission',
+            index=models.Index(fields=['mac_address', 'timestamp_origin'], name='esp_mac_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sensorhcsr04',
+            index=models.Index(fields=['mac', 'timestamp_origin'], name='hcsr04_mac_timestamp_idx'),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 3.2.9 on 2026-10-18 18:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('greenhouse', '0004_transmission_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ESPTransmissionRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.IntegerField()),
+                ('bucket_start', models.IntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('last_timestamp', models.IntegerField()),
+                ('mac_address', models.CharField(max_length=50)),
+                ('ldr_sensor_sum', models.FloatField(default=0)),
+                ('ldr_sensor_sum_sq', models.FloatField(default=0)),
+                ('ldr_sensor_min', models.FloatField()),
+                ('ldr_sensor_max', models.FloatField()),
+                ('ldr_sensor_last', models.FloatField()),
+                ('temperature_sensor_sum', models.FloatField(default=0)),
+                ('temperature_sensor_sum_sq', models.FloatField(default=0)),
+                ('temperature_sensor_min', models.FloatField()),
+                ('temperature_sensor_max', models.FloatField()),
+                ('temperature_sensor_last', models.FloatField()),
+                ('pressure_sum', models.FloatField(default=0)),
+                ('pressure_sum_sq', models.FloatField(default=0)),
+                ('pressure_min', models.FloatField()),
+                ('pressure_max', models.FloatField()),
+                ('pressure_last', models.FloatField()),
+                ('moisture_sum', models.FloatField(default=0)),
+                ('moisture_sum_sq', models.FloatField(default=0)),
+                ('moisture_min', models.FloatField()),
+                ('moisture_max', models.FloatField()),
+                ('moisture_last', models.FloatField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SensorHCSR04Rollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.IntegerField()),
+                ('bucket_start', models.IntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('last_timestamp', models.IntegerField()),
+                ('mac', models.IntegerField()),
+                ('distance_sum', models.FloatField(default=0)),
+                ('distance_sum_sq', models.FloatField(default=0)),
+                ('distance_min', models.FloatField()),
+                ('distance_max', models.FloatField()),
+                ('distance_last', models.FloatField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='sensorhcsr04rollup',
+            constraint=models.UniqueConstraint(fields=('mac', 'resolution', 'bucket_start'), name='hcsr04_rollup_bucket_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='esptransmissionrollup',
+            constraint=models.UniqueConstraint(fields=('mac_address', 'resolution', 'bucket_start'), name='esp_rollup_bucket_unique'),
+        ),
+    ]
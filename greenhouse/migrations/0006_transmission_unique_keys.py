@@ -0,0 +1,65 @@
+# Generated by Django 3.2.9 on 2026-10-18 19:17
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+DEVICE_FIELDS = {
+    'ESPTransmission': 'mac_address',
+    'SensorHCSR04': 'mac',
+}
+
+
+def delete_duplicates(apps, schema_editor):
+    """
+    Keep the first stored row of every (device, timestamp_origin).
+    """
+    for model_name, field in DEVICE_FIELDS.items():
+        model = apps.get_model('greenhouse', model_name)
+        duplicates = (
+            model.objects.values(field, 'timestamp_origin')
+            .annotate(rows=Count('id'), keep=Min('id'))
+            .filter(rows__gt=1)
+            .order_by()
+        )
+        devices = set()
+        deleted = 0
+        for group in duplicates.iterator():
+            deleted += model.objects.filter(**{
+                field: group[field],
+                'timestamp_origin': group['timestamp_origin'],
+            }).exclude(id=group['keep']).delete()[0]
+            devices.add(group[field])
+
+        if deleted:
+            print(
+                f'\n  Deleted {deleted} duplicate {model_name} rows of {len(devices)} '
+                f'devices, run rebuild_rollups --all-days to fix their rollups'
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('greenhouse', '0005_transmission_rollups'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='esptransmission',
+            constraint=models.UniqueConstraint(fields=('mac_address', 'timestamp_origin'), name='esp_mac_timestamp_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='sensorhcsr04',
+            constraint=models.UniqueConstraint(fields=('mac', 'timestamp_origin'), name='hcsr04_mac_timestamp_unique'),
+        ),
+        migrations.RemoveIndex(
+            model_name='esptransmission',
+            name='esp_mac_timestamp_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='sensorhcsr04',
+            name='hcsr04_mac_timestamp_idx',
+        ),
+    ]
@@ -0,0 +1,71 @@
+from django.conf import settings
+from django.db import migrations
+
+
+TABLES = ('greenhouse_esptransmission', 'greenhouse_sensorhcsr04')
+
+# seconds of timestamp_origin per hypertable chunk
+CHUNK_INTERVAL = 7 * 86400
+
+
+def _is_hypertable(cursor, table):
+    cursor.execute(
+        'SELECT 1 FROM timescaledb_information.hypertables WHERE hypertable_name = %s',
+        [table]
+    )
+    return cursor.fetchone() is not None
+
+
+def time_partitioning(apps, schema_editor):
+    """
+    PostgreSQL only: turn the transmission tables into TimescaleDB
+    hypertables on timestamp_origin when settings.TIMESCALEDB is set,
+    otherwise add a BRIN index on timestamp_origin. Rows mostly arrive in
+    time order, so BRIN serves the time range scans of exports and
+    retention at a tiny fraction of a btree size.
+    """
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+
+    with connection.cursor() as cursor:
+        if not settings.TIMESCALEDB:
+            for table in TABLES:
+                cursor.execute(
+                    f'CREATE INDEX IF NOT EXISTS {table}_time_brin '
+                    f'ON {table} USING brin (timestamp_origin)'
+                )
+            return
+
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS timescaledb')
+        for table in TABLES:
+            if _is_hypertable(cursor, table):
+                continue
+            # unique indexes of a hypertable must include its time column
+            cursor.execute(f'ALTER TABLE {table} DROP CONSTRAINT {table}_pkey')
+            cursor.execute(f'ALTER TABLE {table} ADD PRIMARY KEY (id, timestamp_origin)')
+            cursor.execute(
+                'SELECT create_hypertable(%s, %s, chunk_time_interval => %s, migrate_data => true)',
+                [table, 'timestamp_origin', CHUNK_INTERVAL]
+            )
+
+
+def drop_brin_indexes(apps, schema_editor):
+    # hypertables are left as they are
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        for table in TABLES:
+            cursor.execute(f'DROP INDEX IF EXISTS {table}_time_brin')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('greenhouse', '0006_transmission_unique_keys'),
+    ]
+
+    operations = [
+        migrations.RunPython(time_partitioning, drop_brin_indexes),
+    ]
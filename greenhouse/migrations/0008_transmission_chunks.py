@@ -0,0 +1,43 @@
+# Generated by Django 3.2.9 on 2026-10-18 19:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('greenhouse', '0007_transmission_time_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ESPTransmissionChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day_start', models.IntegerField()),
+                ('count', models.IntegerField()),
+                ('last_timestamp', models.IntegerField()),
+                ('data', models.BinaryField()),
+                ('mac_address', models.CharField(max_length=50)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SensorHCSR04Chunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day_start', models.IntegerField()),
+                ('count', models.IntegerField()),
+                ('last_timestamp', models.IntegerField()),
+                ('data', models.BinaryField()),
+                ('mac', models.IntegerField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='sensorhcsr04chunk',
+            constraint=models.UniqueConstraint(fields=('mac', 'day_start'), name='hcsr04_chunk_day_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='esptransmissionchunk',
+            constraint=models.UniqueConstraint(fields=('mac_address', 'day_start'), name='esp_chunk_day_unique'),
+        ),
+    ]
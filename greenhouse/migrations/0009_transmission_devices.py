@@ -0,0 +1,169 @@
+# Generated by Django 3.2.9 on 2026-10-18 19:49
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+import django.db.models.deletion
+
+
+# model: (MAC field, hardware_type of the devices it registers)
+DEVICE_MODELS = {
+    'ESPTransmission': ('mac_address', 'esp'),
+    'SensorHCSR04': ('mac', 'hcsr04_device'),
+    'ESPTransmissionRollup': ('mac_address', 'esp'),
+    'SensorHCSR04Rollup': ('mac', 'hcsr04_device'),
+    'ESPTransmissionChunk': ('mac_address', 'esp'),
+    'SensorHCSR04Chunk': ('mac', 'hcsr04_device'),
+}
+
+# model: (old unique constraint, new one)
+UNIQUE_KEYS = {
+    'ESPTransmission': (
+        'esp_mac_timestamp_unique',
+        models.UniqueConstraint(fields=('device', 'timestamp_origin'), name='esp_device_timestamp_unique'),
+    ),
+    'SensorHCSR04': (
+        'hcsr04_mac_timestamp_unique',
+        models.UniqueConstraint(fields=('device', 'timestamp_origin'), name='hcsr04_device_timestamp_unique'),
+    ),
+    'ESPTransmissionRollup': (
+        'esp_rollup_bucket_unique',
+        models.UniqueConstraint(fields=('device', 'resolution', 'bucket_start'), name='esp_rollup_bucket_unique'),
+    ),
+    'SensorHCSR04Rollup': (
+        'hcsr04_rollup_bucket_unique',
+        models.UniqueConstraint(fields=('device', 'resolution', 'bucket_start'), name='hcsr04_rollup_bucket_unique'),
+    ),
+    'ESPTransmissionChunk': (
+        'esp_chunk_day_unique',
+        models.UniqueConstraint(fields=('device', 'day_start'), name='esp_chunk_day_unique'),
+    ),
+    'SensorHCSR04Chunk': (
+        'hcsr04_chunk_day_unique',
+        models.UniqueConstraint(fields=('device', 'day_start'), name='hcsr04_chunk_day_unique'),
+    ),
+}
+
+
+def merge_duplicate_devices(apps, schema_editor):
+    """
+    Keep the first Device of every device_id, moving the installations of
+    the others to it.
+    """
+    Device = apps.get_model('greenhouse', 'Device')
+    Installation = apps.get_model('greenhouse', 'Installation')
+    duplicates = (
+        Device.objects.values('device_id')
+        .annotate(rows=Count('id'), keep=Min('id'))
+        .filter(rows__gt=1)
+        .order_by()
+    )
+    for group in duplicates:
+        others = Device.objects.filter(device_id=group['device_id']).exclude(id=group['keep'])
+        Installation.objects.filter(device__in=others).update(device_id=group['keep'])
+        print(f'\n  Merged {others.count()} duplicate devices {group["device_id"]}')
+        others.delete()
+
+
+def link_devices(apps, schema_editor):
+    """
+    Point every transmission, rollup and chunk to the Device of its MAC,
+    registering the MACs without one.
+    """
+    Device = apps.get_model('greenhouse', 'Device')
+    for model_name, (field, hardware_type) in DEVICE_MODELS.items():
+        model = apps.get_model('greenhouse', model_name)
+        devices = dict(Device.objects.values_list('device_id', 'id'))
+        registered = 0
+        for mac in model.objects.order_by().values_list(field, flat=True).distinct():
+            device_id = devices.get(str(mac))
+            if device_id is None:
+                device_id = Device.objects.create(
+                    hardware_type=hardware_type,
+                    device_id=str(mac),
+                    description='',
+                    auto_registered=True
+                ).id
+                registered += 1
+            model.objects.filter(**{field: mac}).update(device_id=device_id)
+
+        if registered:
+            print(f'\n  Registered {registered} devices found in {model_name} rows')
+
+
+def restore_macs(apps, schema_editor):
+    """
+    Copy the device_id of the Device of every row back to its MAC.
+    """
+    Device = apps.get_model('greenhouse', 'Device')
+    for model_name, (field, _) in DEVICE_MODELS.items():
+        model = apps.get_model('greenhouse', model_name)
+        mac_field = model._meta.get_field(field)
+        for device, device_id in Device.objects.filter(
+            id__in=model.objects.order_by().values('device').distinct()
+        ).values_list('id', 'device_id'):
+            model.objects.filter(device=device).update(**{field: mac_field.to_python(device_id)})
+
+
+def mac_field(field, null=False):
+    if field == 'mac':
+        return models.IntegerField(null=null)
+    return models.CharField(max_length=50, null=null)
+
+
+def device_key(model_name, field):
+    """
+    Operations replacing the MAC of `model_name` by its device in the
+    unique key, then dropping the MAC.
+    """
+    old, new = UNIQUE_KEYS[model_name]
+    return [
+        migrations.RemoveConstraint(model_name=model_name.lower(), name=old),
+        migrations.AlterField(
+            model_name=model_name.lower(),
+            name='device',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='greenhouse.device'),
+        ),
+        migrations.AddConstraint(model_name=model_name.lower(), constraint=new),
+        migrations.RemoveField(model_name=model_name.lower(), name=field),
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('greenhouse', '0008_transmission_chunks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='auto_registered',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(merge_duplicate_devices, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='device',
+            constraint=models.UniqueConstraint(fields=('device_id',), name='device_id_unique'),
+        ),
+    ] + [
+        migrations.AddField(
+            model_name=model_name.lower(),
+            name='device',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='greenhouse.device'),
+        )
+        for model_name in DEVICE_MODELS
+    ] + [
+        # nullable while no row has a device, so the migration can be reversed
+        migrations.AlterField(
+            model_name=model_name.lower(),
+            name=field,
+            field=mac_field(field, null=True),
+        )
+        for model_name, (field, _) in DEVICE_MODELS.items()
+    ] + [
+        migrations.RunPython(link_devices, restore_macs),
+    ] + [
+        operation
+        for model_name, (field, _) in DEVICE_MODELS.items()
+        for operation in device_key(model_name, field)
+    ]
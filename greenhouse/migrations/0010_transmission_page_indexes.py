@@ -0,0 +1,21 @@
+# Generated by Django 3.2.9 on 2026-10-18 20:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('greenhouse', '0009_transmission_devices'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='esptransmission',
+            index=models.Index(fields=['timestamp_origin', 'id'], name='esp_timestamp_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sensorhcsr04',
+            index=models.Index(fields=['timestamp_origin', 'id'], name='hcsr04_timestamp_id_idx'),
+        ),
+    ]
@@ -1,20 +1,45 @@
 from django.db import models
 
 
+class Device(models.Model):
+    hardware_type = models.CharField(max_length=100, null=False, blank=False)
+    device_id = models.CharField(max_length=50, null=False, blank=False)
+    description = models.TextField()
+    # created by the ingest for an unknown MAC, until createDevice claims it
+    auto_registered = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['device_id'], name='device_id_unique'),
+        ]
+
+
 class ESPTransmission(models.Model):
     timestamp_origin = models.IntegerField(null=False)
     timestamp_receive = models.IntegerField(null=False)
-    mac_address = models.CharField(max_length=50, null=False, blank=False)
+    # the MAC is Device.device_id; unknown MACs are registered by the
+    # ingest (see greenhouse.ingest.DeviceRegistry). Deleting a device
+    # deletes its rows with a single statement per table.
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, db_index=False)
     ldr_sensor = models.FloatField()
     temperature_sensor = models.FloatField()
     pressure = models.FloatField()
     moisture = models.FloatField()
 
-
-class Device(models.Model):
-    hardware_type = models.CharField(max_length=100, null=False, blank=False)
-    device_id = models.CharField(max_length=50, null=False, blank=False)
-    description = models.TextField()
+    class Meta:
+        # a device never sends two readings for the same timestamp, rows
+        # sharing one are MQTT redeliveries; the unique index also serves
+        # the per device time range lookups
+        constraints = [
+            models.UniqueConstraint(
+                fields=['device', 'timestamp_origin'],
+                name='esp_device_timestamp_unique'
+            ),
+        ]
+        indexes = [
+            # keyset pages across every device
+            models.Index(fields=['timestamp_origin', 'id'], name='esp_timestamp_id_idx'),
+        ]
 
 
 class Installation(models.Model):
@@ -26,7 +51,123 @@ class Installation(models.Model):
 
 
 class SensorHCSR04(models.Model):
-    mac = models.IntegerField(null=False)
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, db_index=False)
     timestamp_origin = models.IntegerField(null=False)
     timestamp_receive = models.IntegerField(null=False)
     distance = models.FloatField(null=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['device', 'timestamp_origin'],
+                name='hcsr04_device_timestamp_unique'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['timestamp_origin', 'id'], name='hcsr04_timestamp_id_idx'),
+        ]
+
+
+class TransmissionRollup(models.Model):
+    """
+    Pre-aggregated transmissions of a device within a `resolution` seconds
+    wide bucket starting at `bucket_start`. Every sensor field keeps its
+    sum, sum of squares, min, max and the value of the latest transmission.
+    """
+    RESOLUTIONS = (60, 3600, 86400)
+
+    resolution = models.IntegerField(null=False)
+    bucket_start = models.IntegerField(null=False)
+    count = models.IntegerField(default=0)
+    last_timestamp = models.IntegerField(null=False)
+
+    class Meta:
+        abstract = True
+
+
+class ESPTransmissionRollup(TransmissionRollup):
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, db_index=False)
+    ldr_sensor_sum = models.FloatField(default=0)
+    ldr_sensor_sum_sq = models.FloatField(default=0)
+    ldr_sensor_min = models.FloatField()
+    ldr_sensor_max = models.FloatField()
+    ldr_sensor_last = models.FloatField()
+    temperature_sensor_sum = models.FloatField(default=0)
+    temperature_sensor_sum_sq = models.FloatField(default=0)
+    temperature_sensor_min = models.FloatField()
+    temperature_sensor_max = models.FloatField()
+    temperature_sensor_last = models.FloatField()
+    pressure_sum = models.FloatField(default=0)
+    pressure_sum_sq = models.FloatField(default=0)
+    pressure_min = models.FloatField()
+    pressure_max = models.FloatField()
+    pressure_last = models.FloatField()
+    moisture_sum = models.FloatField(default=0)
+    moisture_sum_sq = models.FloatField(default=0)
+    moisture_min = models.FloatField()
+    moisture_max = models.FloatField()
+    moisture_last = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['device', 'resolution', 'bucket_start'],
+                name='esp_rollup_bucket_unique'
+            ),
+        ]
+
+
+class SensorHCSR04Rollup(TransmissionRollup):
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, db_index=False)
+    distance_sum = models.FloatField(default=0)
+    distance_sum_sq = models.FloatField(default=0)
+    distance_min = models.FloatField()
+    distance_max = models.FloatField()
+    distance_last = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['device', 'resolution', 'bucket_start'],
+                name='hcsr04_rollup_bucket_unique'
+            ),
+        ]
+
+
+class TransmissionChunk(models.Model):
+    """
+    The transmissions of a device within the UTC day starting at
+    `day_start`, stored column by column in `data` (see
+    greenhouse.columnar).
+    """
+    day_start = models.IntegerField(null=False)
+    count = models.IntegerField(null=False)
+    last_timestamp = models.IntegerField(null=False)
+    data = models.BinaryField()
+
+    class Meta:
+        abstract = True
+
+
+class ESPTransmissionChunk(TransmissionChunk):
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, db_index=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['device', 'day_start'],
+                name='esp_chunk_day_unique'
+            ),
+        ]
+
+
+class SensorHCSR04Chunk(TransmissionChunk):
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, db_index=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['device', 'day_start'],
+                name='hcsr04_chunk_day_unique'
+            ),
+        ]
@@ -0,0 +1,98 @@
+import base64
+import binascii
+import graphene
+from django.conf import settings
+from django.db.models import Q
+
+
+def encode_cursor(timestamp_origin, pk):
+    return base64.urlsafe_b64encode(
+        f'{timestamp_origin}:{pk}'.encode('utf-8')
+    ).decode('utf-8')
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp_origin, pk = base64.urlsafe_b64decode(
+            cursor.encode('utf-8')
+        ).decode('utf-8').split(':')
+        return int(timestamp_origin), int(pk)
+    except (ValueError, binascii.Error, UnicodeError):
+        raise Exception('Invalid cursor')
+
+
+def page_size(first=None):
+    """
+    Clamp the requested page size to settings.TRANSMISSION_MAX_PAGE_SIZE.
+    """
+    if first is None:
+        return settings.TRANSMISSION_PAGE_SIZE
+    if first < 1:
+        raise Exception('first must be a positive integer')
+    return min(first, settings.TRANSMISSION_MAX_PAGE_SIZE)
+
+
+def keyset_page(queryset, first=None, after=None):
+    """
+    Return a page of `queryset` ordered by (timestamp_origin, id), starting
+    right after the `after` cursor, and whether there are more rows.
+
+    The page is located through the (device, timestamp_origin) index, or
+    the (timestamp_origin, id) one when not filtered on a device, instead
+    of an OFFSET, so deep pages cost the same as the first one.
+    """
+    size = page_size(first)
+    queryset = queryset.order_by('timestamp_origin', 'id')
+    if after:
+        timestamp_origin, pk = decode_cursor(after)
+        # a single range on timestamp_origin, the id tie breaker only
+        # filters within it, so the index is read in order and no sort
+        # of every following row is needed
+        queryset = queryset.filter(
+            Q(timestamp_origin__gte=timestamp_origin),
+            Q(timestamp_origin__gt=timestamp_origin) | Q(id__gt=pk)
+        )
+
+    rows = list(queryset[:size + 1])
+    return rows[:size], len(rows) > size
+
+
+def keyset_rows(rows, first=None, after=None):
+    """
+    The same page as `keyset_page` out of `.values()` dicts already
+    ordered by (timestamp_origin, id).
+    """
+    size = page_size(first)
+    if after:
+        position = decode_cursor(after)
+        rows = [row for row in rows if (row['timestamp_origin'], row['id']) > position]
+    return rows[:size], len(rows) > size
+
+
+def connection_from_queryset(connection_type, queryset, first=None, after=None):
+    """
+    Build a Relay connection of `connection_type` holding one keyset page.
+    Rows may be model instances or `.values()` dicts.
+    """
+    rows, has_next = keyset_page(queryset, first, after)
+    return connection_from_page(connection_type, rows, has_next, after)
+
+
+def connection_from_page(connection_type, rows, has_next, after=None):
+    edges = []
+    for row in rows:
+        if isinstance(row, dict):
+            cursor = encode_cursor(row['timestamp_origin'], row['id'])
+        else:
+            cursor = encode_cursor(row.timestamp_origin, row.pk)
+        edges.append(connection_type.Edge(node=row, cursor=cursor))
+
+    return connection_type(
+        edges=edges,
+        page_info=graphene.relay.PageInfo(
+            has_next_page=has_next,
+            has_previous_page=bool(after),
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+        )
+    )
@@ -0,0 +1,143 @@
+"""
+Fan-out of freshly ingested transmissions to GraphQL subscriptions.
+
+The ingest path publishes every flushed batch to the process-local `hub`,
+which hands it to each subscription running on an event loop. When the
+configured channel layer can reach other processes, batches are also sent
+to its group and a relay task in the ASGI process forwards them to its own
+hub, so `mqtt_sub` and the web server can run apart. That takes the Redis
+layer of channels_redis, selected by settings.CHANNEL_LAYER_REDIS_URL; with
+the default in-memory layer subscriptions only see the transmissions
+ingested by their own process.
+"""
+import asyncio
+import threading
+import uuid
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from greenhouse.timeseries import row_fields, row_values
+
+
+GROUP = 'greenhouse.transmissions'
+ORIGIN = uuid.uuid4().hex
+GROUP_REFRESH = 3600
+
+
+def transmission_payload(model, instance):
+    payload = dict(zip(row_fields(model), row_values(model, instance)))
+    payload['model'] = model.__name__
+    payload['device_id'] = instance.device.device_id
+    return payload
+
+
+class TransmissionHub:
+    """
+    Thread safe, process-local fan-out of transmission batches to asyncio
+    queues. Batches for a subscriber that fell `max_pending` batches
+    behind are dropped for that subscriber only.
+    """
+    def __init__(self, max_pending=1000):
+        self.max_pending = max_pending
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue(maxsize=self.max_pending))
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, transmissions):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            loop, queue = subscriber
+            try:
+                loop.call_soon_threadsafe(self._offer, queue, transmissions)
+            except RuntimeError:
+                # the subscriber loop is gone
+                self.unsubscribe(subscriber)
+
+    @staticmethod
+    def _offer(queue, transmissions):
+        try:
+            queue.put_nowait(transmissions)
+        except asyncio.QueueFull:
+            pass
+
+
+hub = TransmissionHub()
+_relays = {}
+
+
+def publish_transmissions(model, instances):
+    """
+    Publish committed transmissions of `model` to subscriptions.
+    """
+    transmissions = [transmission_payload(model, tx) for tx in instances]
+    if not transmissions:
+        return
+
+    hub.publish(transmissions)
+    layer = get_channel_layer()
+    if layer is not None and not isinstance(layer, InMemoryChannelLayer):
+        try:
+            async_to_sync(layer.group_send)(GROUP, {
+                'type': 'transmissions',
+                'origin': ORIGIN,
+                'transmissions': transmissions,
+            })
+        except Exception as e:
+            print(f'Failed broadcasting transmissions with error: {str(e)}')
+
+
+async def _relay(layer):
+    channel = await layer.new_channel()
+    await layer.group_add(GROUP, channel)
+    try:
+        while True:
+            try:
+                message = await asyncio.wait_for(layer.receive(channel), GROUP_REFRESH)
+            except asyncio.TimeoutError:
+                # keep the membership from expiring on quiet periods
+                await layer.group_add(GROUP, channel)
+                continue
+            if message.get('origin') != ORIGIN:
+                hub.publish(message['transmissions'])
+    finally:
+        await layer.group_discard(GROUP, channel)
+
+
+def ensure_relay():
+    """
+    Start, once per event loop, the task relaying the channel layer group
+    into the local hub.
+    """
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    loop = asyncio.get_running_loop()
+    relay = _relays.get(loop)
+    if relay is None or relay.done():
+        _relays[loop] = loop.create_task(_relay(layer))
+
+
+async def transmission_stream(device_ids=None):
+    """
+    Yield transmissions published from now on, optionally only those of
+    `device_ids`.
+    """
+    ensure_relay()
+    subscriber = hub.subscribe()
+    _, queue = subscriber
+    try:
+        while True:
+            for transmission in await queue.get():
+                if not device_ids or transmission['device_id'] in device_ids:
+                    yield transmission
+    finally:
+        hub.unsubscribe(subscriber)
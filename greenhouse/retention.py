@@ -0,0 +1,287 @@
+"""
+Retention of raw transmissions and minute rollups, see
+settings.TRANSMISSION_RETENTION_DAYS, with optional archival of the
+pruned raw rows.
+
+Archives are partitioned by model, device and month:
+
+    <TRANSMISSION_ARCHIVE_DIR>/<model>/<device>/<YYYY-MM>/<first timestamp>-<write time>.ndjson.gz
+
+(or .parquet) with the export columns, one file per device and month
+pruned in a run, never overwritten. Rows are deleted once their file is
+written; an interrupted prune archives the rows left again on the next
+run, and the export skips rows found twice, in archives or in the
+database.
+"""
+import gzip
+import heapq
+import json
+import os
+from array import array
+from datetime import datetime, timezone
+from itertools import chain, groupby
+from time import sleep, time, time_ns
+from urllib.parse import quote
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min
+from greenhouse.models import Device, ESPTransmission, SensorHCSR04
+from greenhouse.timeseries import DEVICE_COLUMNS, ROLLUP_MODELS, with_device_column
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+RETENTION_MODELS = {
+    'esp': ESPTransmission,
+    'hcsr04': SensorHCSR04,
+}
+
+ARCHIVE_FORMATS = {
+    'ndjson': '.ndjson.gz',
+    'parquet': '.parquet',
+}
+
+DAY = 86400
+MINUTE = 60
+
+
+def retention_cutoff(days, now=None):
+    """
+    Timestamp before which rows older than `days` are pruned, rounded
+    down to the start of a day so rollups are rebuilt from whole days.
+    """
+    cutoff = int(now if now is not None else time()) - days * DAY
+    return cutoff - cutoff % DAY
+
+
+def raw_cutoff(model, now=None):
+    """
+    Timestamp before which the raw rows of `model` may have been pruned
+    under the configured retention, None when they are kept forever.
+    Readers take the rows before it from the columnar chunks.
+    """
+    name = next(name for name, retained in RETENTION_MODELS.items() if retained is model)
+    days = settings.TRANSMISSION_RETENTION_DAYS[name]
+    return retention_cutoff(days, now) if days else None
+
+
+def _month(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m')
+
+
+def _month_range(month):
+    start = datetime.strptime(month, '%Y-%m').replace(tzinfo=timezone.utc)
+    if start.month == 12:
+        end = start.replace(year=start.year + 1, month=1)
+    else:
+        end = start.replace(month=start.month + 1)
+    return int(start.timestamp()), int(end.timestamp())
+
+
+def archive_dir(model, device_id=None):
+    path = os.path.join(settings.TRANSMISSION_ARCHIVE_DIR, model._meta.model_name)
+    if device_id is not None:
+        path = os.path.join(path, quote(str(device_id), safe=''))
+    return path
+
+
+def _archive_path(model, device_id, month, first, archive_format):
+    directory = os.path.join(archive_dir(model, device_id), month)
+    os.makedirs(directory, exist_ok=True)
+    # rows imported back and pruned again may start at the same timestamp;
+    # of a row archived twice, the export keeps the file sorting first
+    return os.path.join(directory, f'{first}-{time_ns()}{ARCHIVE_FORMATS[archive_format]}')
+
+
+def write_archive(model, columns, rows, archive_format='ndjson'):
+    """
+    Write rows of one device, value tuples of `columns` ordered by
+    timestamp, to a new file per month, streaming them. Returns the paths
+    written.
+    """
+    from greenhouse.export import parquet_schema, stream_ndjson, stream_parquet
+
+    if archive_format == 'parquet' and pyarrow is None:
+        raise ImportError('Parquet archives require pyarrow')
+
+    device = columns.index(DEVICE_COLUMNS[model][0])
+    timestamp = columns.index('timestamp_origin')
+    paths = []
+    for month, month_rows in groupby(rows, key=lambda row: _month(row[timestamp])):
+        first = next(month_rows)
+        path = _archive_path(model, first[device], month, first[timestamp], archive_format)
+        partial = f'{path}.partial'
+        month_rows = chain([first], month_rows)
+        if archive_format == 'parquet':
+            with open(partial, 'wb') as archive:
+                for data in stream_parquet(parquet_schema(model, columns), month_rows):
+                    archive.write(data)
+        else:
+            with gzip.open(partial, 'wb') as archive:
+                for data in stream_ndjson(columns, month_rows):
+                    archive.write(data)
+        os.replace(partial, path)
+        paths.append(path)
+    return paths
+
+
+def read_archive(path, columns):
+    if path.endswith('.parquet'):
+        if pyarrow is None:
+            raise ImportError(f'Reading {path} requires pyarrow')
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(columns=columns):
+            values = batch.to_pydict()
+            yield from zip(*(values[column] for column in columns))
+        return
+    with gzip.open(path, 'rt', encoding='utf-8') as archive:
+        for line in archive:
+            row = json.loads(line)
+            yield tuple(row[column] for column in columns)
+
+
+def _device_rows(device_dir, columns, start, end):
+    timestamp = columns.index('timestamp_origin')
+    for month in sorted(os.listdir(device_dir)):
+        month_start, month_end = _month_range(month)
+        if (start is not None and month_end <= start) or (end is not None and month_start >= end):
+            continue
+        month_dir = os.path.join(device_dir, month)
+        files = [
+            read_archive(os.path.join(month_dir, name), columns)
+            for name in sorted(os.listdir(month_dir))
+            if name.endswith(tuple(ARCHIVE_FORMATS.values()))
+        ]
+        for row in heapq.merge(*files, key=lambda row: row[timestamp]):
+            if start is not None and row[timestamp] < start:
+                continue
+            if end is not None and row[timestamp] >= end:
+                break
+            yield row
+
+
+def archived_rows(model, columns, device_id=None, start=None, end=None):
+    """
+    Iterate archived rows of `model` as value tuples of `columns`, ordered
+    by origin timestamp, from `start` included to `end` excluded.
+    """
+    if device_id is not None:
+        devices = [archive_dir(model, device_id)]
+    else:
+        root = archive_dir(model)
+        devices = [os.path.join(root, name) for name in sorted(os.listdir(root))] if os.path.isdir(root) else []
+
+    timestamp = columns.index('timestamp_origin')
+    return heapq.merge(*(
+        _device_rows(device_dir, columns, start, end)
+        for device_dir in devices
+        if os.path.isdir(device_dir)
+    ), key=lambda row: row[timestamp])
+
+
+def merge_rows(model, columns, *sources):
+    """
+    Merge row iterators ordered by origin timestamp, keeping the first of
+    rows sharing their device and timestamp.
+    """
+    device = columns.index(DEVICE_COLUMNS[model][0])
+    timestamp = columns.index('timestamp_origin')
+    current = None
+    seen = set()
+    for row in heapq.merge(*sources, key=lambda row: row[timestamp]):
+        if row[timestamp] != current:
+            current = row[timestamp]
+            seen.clear()
+        if row[device] in seen:
+            continue
+        seen.add(row[device])
+        yield row
+
+
+def _expired_devices(model, **filters):
+    return list(
+        model.objects.filter(**filters).order_by('device').values_list('device', flat=True).distinct()
+    )
+
+
+def _delete(model, ids, batch_size, pause):
+    for i in range(0, len(ids), batch_size):
+        with transaction.atomic():
+            model.objects.filter(id__in=list(ids[i:i + batch_size])).delete()
+        if pause:
+            # let the ingest in between batches
+            sleep(pause)
+
+
+def _archive_months(model, columns, expired, cutoff, archive_format):
+    """
+    Archive the expired rows of a device month by month, yielding the ids
+    of each archived month.
+    """
+    first = expired.aggregate(first=Min('timestamp_origin'))['first']
+    month_start = _month_range(_month(first))[0]
+    while month_start < cutoff:
+        month_end = _month_range(_month(month_start))[1]
+        rows = with_device_column(model, expired.filter(
+            timestamp_origin__gte=month_start,
+            timestamp_origin__lt=month_end,
+        )).order_by('timestamp_origin').values_list('id', *columns).iterator(chunk_size=2000)
+        # only the ids are kept, as 8 byte integers
+        ids = array('q')
+
+        def archived(rows=rows, ids=ids):
+            for row in rows:
+                ids.append(row[0])
+                yield row[1:]
+
+        write_archive(model, columns, archived(), archive_format)
+        if ids:
+            yield ids
+        month_start = month_end
+
+
+def prune_model(model, cutoff, batch_size=500, archive_format=None, pause=0):
+    """
+    Delete transmissions of `model` older than `cutoff`, device by device
+    in transactions of `batch_size` rows, archiving them first when
+    `archive_format` is given. Returns {device id: rows deleted}.
+    """
+    from greenhouse.export import export_columns
+
+    columns = export_columns(model)
+    devices = _expired_devices(model, timestamp_origin__lt=cutoff)
+    device_ids = dict(Device.objects.filter(id__in=devices).values_list('id', 'device_id'))
+    deleted = {}
+    for device in devices:
+        device_id = device_ids[device]
+        expired = model.objects.filter(device=device, timestamp_origin__lt=cutoff)
+        if archive_format:
+            batches = _archive_months(model, columns, expired, cutoff, archive_format)
+        else:
+            batches = iter(lambda: list(expired.values_list('id', flat=True)[:batch_size]), [])
+        for ids in batches:
+            _delete(model, ids, batch_size, pause)
+            deleted[device_id] = deleted.get(device_id, 0) + len(ids)
+    return deleted
+
+
+def prune_minute_rollups(model, cutoff, batch_size=500, pause=0):
+    """
+    Delete the 1 minute rollups of `model` older than `cutoff`, hour and
+    day rollups are kept. Returns the number of rows deleted.
+    """
+    rollup_model = ROLLUP_MODELS[model]
+    deleted = 0
+    for device in _expired_devices(rollup_model, resolution=MINUTE, bucket_start__lt=cutoff):
+        expired = rollup_model.objects.filter(
+            device=device,
+            resolution=MINUTE,
+            bucket_start__lt=cutoff,
+        )
+        for ids in iter(lambda: list(expired.values_list('id', flat=True)[:batch_size]), []):
+            _delete(rollup_model, ids, batch_size, pause)
+            deleted += len(ids)
+    return deleted
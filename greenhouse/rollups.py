@@ -0,0 +1,282 @@
+from django.db import NotSupportedError, connections, router, transaction
+from django.db.models import Count, ExpressionWrapper, F, IntegerField
+from greenhouse.models import TransmissionRollup
+from greenhouse.timeseries import ROLLUP_MODELS, SENSOR_FIELDS
+
+
+def rollup_columns(model):
+    """
+    Names of the aggregated columns of the rollup model of `model`.
+    """
+    columns = ['count', 'last_timestamp']
+    for field in SENSOR_FIELDS[model]:
+        columns += [
+            f'{field}_sum',
+            f'{field}_sum_sq',
+            f'{field}_min',
+            f'{field}_max',
+            f'{field}_last',
+        ]
+    return columns
+
+
+def _reading_stats(fields, timestamp, values):
+    stats = {'count': 1, 'last_timestamp': timestamp}
+    for field, value in zip(fields, values):
+        stats[f'{field}_sum'] = value
+        stats[f'{field}_sum_sq'] = value * value
+        stats[f'{field}_min'] = value
+        stats[f'{field}_max'] = value
+        stats[f'{field}_last'] = value
+    return stats
+
+
+def merge_stats(fields, stats, other):
+    """
+    Merge the aggregated columns of `other` into `stats`, in place.
+    """
+    newer = other['last_timestamp'] >= stats['last_timestamp']
+    stats['count'] += other['count']
+    if newer:
+        stats['last_timestamp'] = other['last_timestamp']
+    for field in fields:
+        stats[f'{field}_sum'] += other[f'{field}_sum']
+        stats[f'{field}_sum_sq'] += other[f'{field}_sum_sq']
+        stats[f'{field}_min'] = min(stats[f'{field}_min'], other[f'{field}_min'])
+        stats[f'{field}_max'] = max(stats[f'{field}_max'], other[f'{field}_max'])
+        if newer:
+            stats[f'{field}_last'] = other[f'{field}_last']
+    return stats
+
+
+def summarize_values(model, rows, resolutions=TransmissionRollup.RESOLUTIONS):
+    """
+    Aggregate (device primary key, timestamp_origin, *sensor values)
+    tuples into a dict keyed by (device, resolution, bucket_start).
+    """
+    fields = SENSOR_FIELDS[model]
+    device_field = model._meta.get_field('device')
+    rollups = {}
+    for device_id, timestamp, *values in rows:
+        device_id = device_field.to_python(device_id)
+        timestamp = int(timestamp)
+        reading = _reading_stats(fields, timestamp, values)
+        for resolution in resolutions:
+            key = (device_id, resolution, timestamp - timestamp % resolution)
+            if key in rollups:
+                merge_stats(fields, rollups[key], reading)
+            else:
+                rollups[key] = dict(reading)
+    return rollups
+
+
+def summarize(model, instances):
+    fields = SENSOR_FIELDS[model]
+    return summarize_values(model, (
+        (
+            tx.device_id,
+            tx.timestamp_origin,
+            *(getattr(tx, field) for field in fields)
+        )
+        for tx in instances
+    ))
+
+
+# SQL functions returning the greatest and least of two values
+UPSERT_FUNCTIONS = {
+    'sqlite': ('max', 'min'),
+    'postgresql': ('GREATEST', 'LEAST'),
+}
+
+
+def _merge_sql(model, connection):
+    """
+    The SET clause of the upsert merging `excluded` into the stored
+    rollup row, the SQL counterpart of merge_stats.
+    """
+    rollup_model = ROLLUP_MODELS[model]
+    greatest, least = UPSERT_FUNCTIONS[connection.vendor]
+    table = connection.ops.quote_name(rollup_model._meta.db_table)
+
+    def column(name):
+        return connection.ops.quote_name(rollup_model._meta.get_field(name).column)
+
+    def stored(name):
+        return f'{table}.{column(name)}'
+
+    def excluded(name):
+        return f'excluded.{column(name)}'
+
+    # SET expressions all read the row as it was before the update
+    newer = f'{excluded("last_timestamp")} >= {stored("last_timestamp")}'
+    merges = {
+        'count': f'{stored("count")} + {excluded("count")}',
+        'last_timestamp': f'{greatest}({stored("last_timestamp")}, {excluded("last_timestamp")})',
+    }
+    for field in SENSOR_FIELDS[model]:
+        for name in (f'{field}_sum', f'{field}_sum_sq'):
+            merges[name] = f'{stored(name)} + {excluded(name)}'
+        merges[f'{field}_min'] = f'{least}({stored(f"{field}_min")}, {excluded(f"{field}_min")})'
+        merges[f'{field}_max'] = f'{greatest}({stored(f"{field}_max")}, {excluded(f"{field}_max")})'
+        merges[f'{field}_last'] = (
+            f'CASE WHEN {newer} THEN {excluded(f"{field}_last")} ELSE {stored(f"{field}_last")} END'
+        )
+    return ', '.join(f'{column(name)} = {merges[name]}' for name in rollup_columns(model))
+
+
+def upsert_rollups(model, rollups, chunk_size=500):
+    """
+    Merge a dict of stats keyed by (device, resolution, bucket_start), as
+    returned by summarize, into the rollups of `model` with INSERT ... ON
+    CONFLICT DO UPDATE. Writers adding to the same buckets concurrently
+    are serialized by the unique bucket index instead of racing to create
+    the missing rows.
+    """
+    if not rollups:
+        return
+
+    rollup_model = ROLLUP_MODELS[model]
+    connection = connections[router.db_for_write(rollup_model)]
+    if connection.vendor not in UPSERT_FUNCTIONS:
+        raise NotSupportedError(f'Rollups cannot be upserted on {connection.vendor}')
+
+    key = ['device', 'resolution', 'bucket_start']
+    fields = [rollup_model._meta.get_field(name) for name in key + rollup_columns(model)]
+    quote = connection.ops.quote_name
+    row_sql = '(' + ', '.join(['%s'] * len(fields)) + ')'
+    rows = [
+        [
+            field.get_db_prep_save(value, connection)
+            for field, value in zip(fields, (*bucket, *(stats[field.name] for field in fields[3:])))
+        ]
+        for bucket, stats in rollups.items()
+    ]
+
+    batch_size = min(chunk_size, connection.ops.bulk_batch_size(fields, rows))
+    with connection.cursor() as cursor:
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i:i + batch_size]
+            cursor.execute(
+                f'INSERT INTO {quote(rollup_model._meta.db_table)} '
+                f'({", ".join(quote(field.column) for field in fields)}) '
+                f'VALUES {", ".join([row_sql] * len(batch))} '
+                f'ON CONFLICT ({", ".join(quote(field.column) for field in fields[:3])}) '
+                f'DO UPDATE SET {_merge_sql(model, connection)}',
+                [value for row in batch for value in row]
+            )
+
+
+def apply_rollups(model, instances, chunk_size=500):
+    """
+    Merge freshly inserted transmissions of `model` into its rollups. Must
+    run inside the transaction that inserted them so rows and rollups are
+    committed together.
+    """
+    upsert_rollups(model, summarize(model, instances), chunk_size)
+
+
+def _day_runs(days, day):
+    """
+    Group sorted day starts into [start, end) ranges of consecutive days.
+    """
+    runs = []
+    for day_start in days:
+        if runs and runs[-1][1] == day_start:
+            runs[-1][1] += day
+        else:
+            runs.append([day_start, day_start + day])
+    return runs
+
+
+def rebuild_rollups(model, device=None, since=None, chunk_size=10000, all_days=False):
+    """
+    Recompute the rollups of `model` from raw rows, optionally restricted
+    to one device (a Device or its primary key) and/or to transmissions
+    from `since` on (rounded down to the start of its day). Returns the
+    number of raw rows read.
+
+    Raw rows are streamed in (device, timestamp_origin) order and written
+    one device-day at a time, so memory stays bounded. Only the days with
+    raw rows are rebuilt. Days whose day rollup counts more transmissions
+    than their raw rows lost rows to a prune (see greenhouse.retention),
+    their rollups are kept unless `all_days` is set, e.g. to fix rollups
+    counting deleted duplicates.
+    """
+    rollup_model = ROLLUP_MODELS[model]
+    fields = SENSOR_FIELDS[model]
+    day = max(TransmissionRollup.RESOLUTIONS)
+
+    raw = model.objects.all()
+    rollups = rollup_model.objects.all()
+    if device is not None:
+        raw = raw.filter(device=device)
+        rollups = rollups.filter(device=device)
+    if since is not None:
+        since = int(since) - int(since) % day
+        raw = raw.filter(timestamp_origin__gte=since)
+        rollups = rollups.filter(bucket_start__gte=since)
+
+    raw_days = {
+        (device, day_number * day): count
+        for device, day_number, count in raw.annotate(
+            day=ExpressionWrapper(F('timestamp_origin') / day, output_field=IntegerField())
+        ).order_by().values_list('device', 'day').annotate(count=Count('id'))
+    }
+    rolled_up = dict(
+        ((device, bucket_start), count)
+        for device, bucket_start, count in rollups.filter(resolution=day).values_list(
+            'device', 'bucket_start', 'count'
+        )
+    )
+    days = {
+        key for key, count in raw_days.items()
+        if all_days or rolled_up.get(key, 0) <= count
+    }
+    if not days:
+        return 0
+
+    rows = raw.order_by('device', 'timestamp_origin', 'id').values_list(
+        'device', 'timestamp_origin', *fields
+    ).iterator(chunk_size=chunk_size)
+
+    def write(pending):
+        rollup_model.objects.bulk_create([
+            rollup_model(
+                device_id=device,
+                resolution=resolution,
+                bucket_start=bucket_start,
+                **stats
+            )
+            for (device, resolution, bucket_start), stats in pending.items()
+        ], batch_size=500)
+
+    devices = {}
+    for device_pk, day_start in days:
+        devices.setdefault(device_pk, []).append(day_start)
+
+    total = 0
+    with transaction.atomic():
+        for device_pk, day_starts in devices.items():
+            for start, end in _day_runs(sorted(day_starts), day):
+                rollups.filter(
+                    device=device_pk,
+                    bucket_start__gte=start,
+                    bucket_start__lt=end,
+                ).delete()
+
+        current_day = None
+        day_rows = []
+        for row in rows:
+            key = (row[0], row[1] - row[1] % day)
+            if key not in days:
+                continue
+            if key != current_day and day_rows:
+                write(summarize_values(model, day_rows))
+                day_rows = []
+            current_day = key
+            day_rows.append(row)
+            total += 1
+        if day_rows:
+            write(summarize_values(model, day_rows))
+
+    return total
@@ -0,0 +1,58 @@
+"""
+Routing of greenhouse reads to a replica (settings.REPLICA_DATABASE).
+
+Everything goes to the primary (default) database unless wrapped in
+`replica_reads()`, which GraphQL query operations and exports are. The
+ingest, management commands and mutations keep reading from the primary,
+so they always see their own writes; a replica lagging behind only
+delays what queries see.
+"""
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+_state = threading.local()
+
+
+@contextmanager
+def replica_reads():
+    """
+    Read greenhouse models from the replica within this block, in this
+    thread.
+    """
+    previous = getattr(_state, 'replica', False)
+    _state.replica = True
+    try:
+        yield
+    finally:
+        _state.replica = previous
+
+
+def reading_from_replica():
+    return getattr(_state, 'replica', False)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == 'greenhouse' and reading_from_replica():
+            return settings.REPLICA_DATABASE
+        return None
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == 'greenhouse':
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS, settings.REPLICA_DATABASE}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == settings.REPLICA_DATABASE and db != DEFAULT_DB_ALIAS:
+            return False
+        return None
@@ -1,9 +1,18 @@
 from datetime import datetime
 import graphene
 import pytz
+from django.conf import settings
+from django.db.models import Exists, OuterRef, Q
+from greenhouse import hotwindow
+from greenhouse.graphql_cache import depends_on
+from greenhouse.loaders import get_loaders
 from greenhouse.models import ESPTransmission, Device, Installation, SensorHCSR04
+from greenhouse.pagination import connection_from_page, connection_from_queryset, keyset_rows
+from greenhouse.pubsub import transmission_stream
 from greenhouse.util import translate_ldr_value
-from greenhouse.statistics import hour_relative_freq
+from greenhouse.statistics import hour_statistics, lttb
+from greenhouse.timeseries import (SENSOR_FIELDS, bucket_aggregate, row_fields, sensor_summary,
+                                   transmission_model, with_device_column)
 from greenhouse.types import DynamicScalar
 
 
@@ -69,84 +78,176 @@ class ESPTransmissionType(graphene.ObjectType):
         )
 
 
+class SensorBucket(graphene.ObjectType):
+    min = graphene.Float()
+    max = graphene.Float()
+    avg = graphene.Float()
+    last = graphene.Float()
+
+
+class TransmissionBucket(graphene.ObjectType):
+    bucket_start = graphene.Int()
+    datetime_start = graphene.DateTime()
+    count = graphene.Int()
+    ldr_sensor = graphene.Field(SensorBucket)
+    temperature_sensor = graphene.Field(SensorBucket)
+    pressure = graphene.Field(SensorBucket)
+    moisture = graphene.Field(SensorBucket)
+    distance = graphene.Field(SensorBucket)
+
+    def resolve_datetime_start(self, info, **kwargs):
+        return datetime.fromtimestamp(self.bucket_start).astimezone(
+            pytz.timezone('America/Sao_Paulo')
+        )
+
+
+class SensorSummary(graphene.ObjectType):
+    count = graphene.Int()
+    mean = graphene.Float()
+    std = graphene.Float()
+    min = graphene.Float()
+    max = graphene.Float()
+
+
+class SensorHCSR04Connection(graphene.relay.Connection):
+    class Meta:
+        node = SensorHCSR04Type
+
+
+class ESPTransmissionConnection(graphene.relay.Connection):
+    class Meta:
+        node = ESPTransmissionType
+
+
+class TransmissionConnection(graphene.relay.Connection):
+    class Meta:
+        node = DynamicScalar
+
+
 class DeviceType(graphene.ObjectType):
     hardware_type = graphene.String()
     device_id = graphene.String()
     description = graphene.String()
-    transmissions = graphene.List(DynamicScalar)
+    transmissions = graphene.Field(
+        TransmissionConnection,
+        first=graphene.Int(),
+        after=graphene.String(),
+        timestamp_origin__gte=graphene.Int(),
+        timestamp_origin__lte=graphene.Int()
+    )
     transmission_count = graphene.Int()
     is_installed = graphene.Boolean()
     last_transmission = graphene.Field(DynamicScalar)
-    # hour_relative_frequency = graphene.Field(HourRelativeFrequency)
+    sensor_summary = graphene.Field(
+        SensorSummary,
+        field=graphene.String(required=True),
+        start=graphene.DateTime(required=True),
+        end=graphene.DateTime(required=True)
+    )
+    hour_relative_frequency = graphene.Field(HourRelativeFrequency)
 
     def resolve_last_transmission(self, info, **kwargs):
+        depends_on(info, self.device_id)
+        return get_loaders(info.context).last_transmission.load(
+            (self.hardware_type, self.device_id)
+        )
+
+    def resolve_sensor_summary(self, info, **kwargs):
+        depends_on(info, self.device_id)
+        model = transmission_model(self.hardware_type)
+        if kwargs['field'] not in SENSOR_FIELDS[model]:
+            raise Exception(f'Invalid sensor field {kwargs["field"]}')
+
+        return SensorSummary(**sensor_summary(
+            model,
+            self.id,
+            kwargs['field'],
+            int(kwargs['start'].timestamp()),
+            int(kwargs['end'].timestamp())
+        ))
+
+    def resolve_hour_relative_frequency(self, info, **kwargs):
+        depends_on(info, self.device_id)
         if self.hardware_type == 'hcsr04_device':
-            return SensorHCSR04.objects.filter(mac=self.device_id).last()
-
-        return ESPTransmission.objects.filter(mac_address=self.device_id).last()
-
-    # def resolve_hour_relative_frequency(self, info, **kwargs):
-    #     if 'dt_start' in self.__dict__:
-    #         tx = ESPTransmission.objects.filter(
-    #             mac_address=self.device_id,
-    #             timestamp_origin__gte=self.__dict__['dt_start'].timestamp()
-    #         )
-    #     else:
-    #         tx = ESPTransmission.objects.filter(mac_address=self.device_id)
-    #     if not tx:
-    #         return None
-
-    #     rel_freq = hour_relative_freq(tx, '3600S')
-    #     return HourRelativeFrequency(
-    #         hours=rel_freq.index.values,
-    #         ldr_relative_frequency=rel_freq.LDR_REL_FREQ.values,
-    #         ldr_high_std=rel_freq.LDR_POS_STD.values,
-    #         ldr_low_std=rel_freq.LDR_NEG_STD.values,
-    #         temperature_relative_frequency=rel_freq.TEMP_REL_FREQ.values,
-    #         temperature_high_std=rel_freq.TEMP_POS_STD.values,
-    #         temperature_low_std=rel_freq.TEMP_NEG_STD.values,
-    #         pressure_relative_frequency=rel_freq.PRES_REL_FREQ.values,
-    #         pressure_high_std=rel_freq.PRES_POS_STD.values,
-    #         pressure_low_std=rel_freq.PRES_NEG_STD.values,
-    #         moisture_relative_frequency=rel_freq.MOIS_REL_FREQ.values,
-    #         moisture_high_std=rel_freq.MOIS_POS_STD.values,
-    #         moisture_low_std=rel_freq.MOIS_NEG_STD.values,
-    #     )
-
-    def resolve_transmissions(self, info, **kwargs):
-        if self.hardware_type == 'hcsr04_device':
-            if 'dt_start' in self.__dict__:
-                return SensorHCSR04.objects.filter(
-                    mac=self.device_id,
-                    timestamp_origin__gte=self.__dict__['dt_start'].timestamp()
-                )
-            return SensorHCSR04.objects.filter(mac=self.device_id)
+            return None
 
+        dt_start = None
+        tx = ESPTransmission.objects.filter(device=self)
         if 'dt_start' in self.__dict__:
-            return ESPTransmission.objects.filter(
-                mac_address=self.device_id,
-                timestamp_origin__gte=self.__dict__['dt_start'].timestamp()
+            dt_start = int(self.__dict__['dt_start'].timestamp())
+            tx = tx.filter(timestamp_origin__gte=dt_start)
+
+        rel_freq = hour_statistics.hour_relative_freq(
+            tx,
+            self.device_id,
+            '3600S',
+            start=dt_start
+        )
+        if rel_freq is None:
+            return None
+
+        return HourRelativeFrequency(
+            hours=rel_freq.index.values,
+            ldr_relative_frequency=rel_freq.LDR_REL_FREQ.values,
+            ldr_high_std=rel_freq.LDR_POS_STD.values,
+            ldr_low_std=rel_freq.LDR_NEG_STD.values,
+            temperature_relative_frequency=rel_freq.TEMP_REL_FREQ.values,
+            temperature_high_std=rel_freq.TEMP_POS_STD.values,
+            temperature_low_std=rel_freq.TEMP_NEG_STD.values,
+            pressure_relative_frequency=rel_freq.PRES_REL_FREQ.values,
+            pressure_high_std=rel_freq.PRES_POS_STD.values,
+            pressure_low_std=rel_freq.PRES_NEG_STD.values,
+            moisture_relative_frequency=rel_freq.MOIS_REL_FREQ.values,
+            moisture_high_std=rel_freq.MOIS_POS_STD.values,
+            moisture_low_std=rel_freq.MOIS_NEG_STD.values,
+        )
+
+    def resolve_transmissions(self, info, first=None, after=None, **kwargs):
+        depends_on(info, self.device_id)
+        if 'dt_start' in self.__dict__:
+            dt_start = int(self.__dict__['dt_start'].timestamp())
+            kwargs['timestamp_origin__gte'] = max(
+                dt_start,
+                kwargs.get('timestamp_origin__gte', dt_start)
             )
-        return ESPTransmission.objects.filter(mac_address=self.device_id)
 
-    def resolve_transmission_count(self, info, **kwargs):
-        if self.hardware_type == 'hcsr04_device':
-            if 'dt_start' in self.__dict__:
-                return SensorHCSR04.objects.filter(
-                    mac=self.device_id,
-                    timestamp_origin__gte=self.__dict__['dt_start'].timestamp()
-                ).count()
-            return SensorHCSR04.objects.filter(mac=self.device_id).count()
+        if 'timestamp_origin__gte' in kwargs:
+            # recent windows come out of memory when it holds them all
+            rows = hotwindow.recent_rows(
+                transmission_model(self.hardware_type),
+                self.device_id,
+                kwargs['timestamp_origin__gte'],
+                kwargs.get('timestamp_origin__lte')
+            )
+            if rows is not None:
+                return connection_from_page(
+                    TransmissionConnection,
+                    *keyset_rows(rows, first, after),
+                    after=after
+                )
+
+        model = transmission_model(self.hardware_type)
+        transmissions = with_device_column(model, model.objects.filter(device=self, **kwargs))
 
+        return connection_from_queryset(
+            TransmissionConnection,
+            transmissions.values('id', *row_fields(model)),
+            first=first,
+            after=after
+        )
+
+    def resolve_transmission_count(self, info, **kwargs):
+        depends_on(info, self.device_id)
+        dt_start = None
         if 'dt_start' in self.__dict__:
-            return ESPTransmission.objects.filter(
-                mac_address=self.device_id,
-                timestamp_origin__gte=self.__dict__['dt_start'].timestamp()
-            ).count()
-        return ESPTransmission.objects.filter(mac_address=self.device_id).count()
+            dt_start = self.__dict__['dt_start'].timestamp()
+
+        return get_loaders(info.context).transmission_count.load(
+            (self.hardware_type, self.id, dt_start)
+        )
 
     def resolve_is_installed(self, info, **kwargs):
-        return bool(self.installation_set.count())
+        return get_loaders(info.context).installed.load(self.id)
 
 
 class InstallationType(graphene.ObjectType):
@@ -163,13 +264,33 @@ class Query(graphene.ObjectType):
     def resolve_version(self, info, **kwargs):
         return '0.0.9'
     
-    hcsr04_readings = graphene.List(SensorHCSR04Type)
+    hcsr04_readings = graphene.Field(
+        SensorHCSR04Connection,
+        first=graphene.Int(),
+        after=graphene.String(),
+        timestamp_origin__gte=graphene.Int(),
+        timestamp_origin__lte=graphene.Int(),
+        mac=graphene.Int()
+    )
 
-    def resolve_hcsr04_readings(self, info, **kwargs):
-        return SensorHCSR04.objects.filter(**kwargs)
+    def resolve_hcsr04_readings(self, info, first=None, after=None, **kwargs):
+        mac = kwargs.pop('mac', None)
+        depends_on(info, *([str(mac)] if mac is not None else []))
+        if mac is not None:
+            kwargs['device__device_id'] = str(mac)
+        return connection_from_queryset(
+            SensorHCSR04Connection,
+            with_device_column(SensorHCSR04, SensorHCSR04.objects.filter(**kwargs)),
+            first=first,
+            after=after
+        )
 
-    esp_transmissions = graphene.List(
-        ESPTransmissionType,
+    esp_transmissions = graphene.Field(
+        ESPTransmissionConnection,
+        first=graphene.Int(),
+        after=graphene.String(),
+        timestamp_origin__gte=graphene.Int(),
+        timestamp_origin__lte=graphene.Int(),
         ldr_sensor__gte=graphene.Float(),
         ldr_sensor__lte=graphene.Float(),
         temperature_sensor__gte=graphene.Float(),
@@ -180,13 +301,79 @@ class Query(graphene.ObjectType):
         mac_address__icontains=graphene.String()
     )
 
-    def resolve_esp_transmissions(self, info, **kwargs):
-        return ESPTransmission.objects.filter(**kwargs)
+    def resolve_esp_transmissions(self, info, first=None, after=None, **kwargs):
+        depends_on(info, *(kwargs.get('mac_address__in') or []))
+        # the MACs are the device ids of the devices
+        for lookup in ('in', 'icontains'):
+            if f'mac_address__{lookup}' in kwargs:
+                kwargs[f'device__device_id__{lookup}'] = kwargs.pop(f'mac_address__{lookup}')
+        return connection_from_queryset(
+            ESPTransmissionConnection,
+            with_device_column(ESPTransmission, ESPTransmission.objects.filter(**kwargs)),
+            first=first,
+            after=after
+        )
 
-    devices = graphene.List(DeviceType)
+    transmission_buckets = graphene.List(
+        TransmissionBucket,
+        device_id=graphene.String(required=True),
+        start=graphene.DateTime(required=True),
+        end=graphene.DateTime(required=True),
+        bucket=graphene.Int(required=True, description='Bucket width in seconds'),
+        points=graphene.Int(description='Downsample buckets to this many points (LTTB)'),
+        downsample_field=graphene.String(
+            description='Sensor field driving the downsampling, defaults to the first one'
+        )
+    )
 
-    def resolve_devices(self, info, **kwargs):
-        return Device.objects.filter(**kwargs)
+    def resolve_transmission_buckets(self, info, **kwargs):
+        depends_on(info, kwargs['device_id'])
+        try:
+            device = Device.objects.get(device_id=kwargs['device_id'])
+        except Device.DoesNotExist:
+            raise Exception('Device Not found!')
+
+        start = int(kwargs['start'].timestamp())
+        end = int(kwargs['end'].timestamp())
+        bucket = kwargs['bucket']
+        if bucket < 1:
+            raise Exception('bucket must be a positive number of seconds')
+        if (end - start) / bucket > settings.TRANSMISSION_MAX_BUCKETS:
+            raise Exception(
+                f'Too many buckets, max is {settings.TRANSMISSION_MAX_BUCKETS}'
+            )
+
+        model = transmission_model(device.hardware_type)
+        buckets = bucket_aggregate(model, device.id, start, end, bucket)
+
+        points = kwargs.get('points')
+        if points and buckets:
+            field = kwargs.get('downsample_field') or SENSOR_FIELDS[model][0]
+            if field not in SENSOR_FIELDS[model]:
+                raise Exception(f'Invalid downsample field {field}')
+            selected = lttb(
+                [b['bucket_start'] for b in buckets],
+                [b[field]['avg'] for b in buckets],
+                points
+            )
+            buckets = [buckets[i] for i in selected]
+
+        return [TransmissionBucket(**b) for b in buckets]
+
+    devices = graphene.List(
+        DeviceType,
+        has_data=graphene.Boolean(description='Only devices with (or without) transmissions')
+    )
+
+    def resolve_devices(self, info, has_data=None, **kwargs):
+        devices = Device.objects.filter(**kwargs)
+        if has_data is not None:
+            # one (device, timestamp_origin) index probe per device and model
+            with_data = Q(Exists(ESPTransmission.objects.filter(device=OuterRef('pk')))) | Q(
+                Exists(SensorHCSR04.objects.filter(device=OuterRef('pk')))
+            )
+            devices = devices.filter(with_data if has_data else ~with_data)
+        return devices
 
     device = graphene.Field(
         DeviceType,
@@ -202,7 +389,7 @@ class Query(graphene.ObjectType):
     installations = graphene.List(InstallationType)
 
     def resolve_installations(self, info, **kwargs):
-        return Installation.objects.filter(**kwargs)
+        return Installation.objects.select_related('device').filter(**kwargs)
 
     installation = graphene.Field(
         InstallationType,
@@ -211,12 +398,25 @@ class Query(graphene.ObjectType):
     )
 
     def resolve_installation(self, info, **kwargs):
-        installation = Installation.objects.get(reference=kwargs['reference'])
+        installation = Installation.objects.select_related('device').get(reference=kwargs['reference'])
         if installation.device and kwargs.get('tx_datetime_start'):
             installation.device.dt_start = kwargs['tx_datetime_start']
         return installation
 
 
+# SUBSCRIPTIONS
+
+class Subscription(graphene.ObjectType):
+    transmission_received = graphene.Field(
+        DynamicScalar,
+        device_ids=graphene.List(graphene.String)
+    )
+
+    async def resolve_transmission_received(root, info, device_ids=None):
+        async for transmission in transmission_stream(device_ids):
+            yield transmission
+
+
 # MUTATIONS
 
 class CreateDevice(graphene.relay.ClientIDMutation):
@@ -231,11 +431,13 @@ class CreateDevice(graphene.relay.ClientIDMutation):
         device, created = Device.objects.get_or_create(
             device_id=kwargs['device_id']
         )
-        if not created:
+        # devices registered by the ingest can be claimed once
+        if not created and not device.auto_registered:
             raise Exception("Device ID already registered")
 
         device.hardware_type = kwargs['hardware_type']
         device.description = kwargs.get('description', "")
+        device.auto_registered = False
         device.save()
 
         return CreateDevice(device)
@@ -1,61 +1,259 @@
-from collections import Counter
-from datetime import datetime
+import threading
+from collections import Counter, OrderedDict
+from itertools import chain
+from time import monotonic
+import numpy as np
 import pandas as pd
-import pytz
+from django.conf import settings
+from django.db.models import Q, QuerySet
+from greenhouse.graphql_cache import history_generation
+
+
+TIMEZONE = 'America/Sao_Paulo'
+SENSOR_COLUMNS = ('LDR', 'TEMP', 'PRES', 'MOIS')
+SENSOR_FIELDS = ('ldr_sensor', 'temperature_sensor', 'pressure', 'moisture')
+
+
+def transmission_arrays(transmissions):
+    """
+    Return the origin timestamps and a (rows, 4) matrix with the ldr,
+    temperature, pressure and moisture readings of `transmissions`,
+    preserving their order. Querysets are read with `values_list`, so no
+    model instance is built.
+    """
+    columns = ('timestamp_origin',) + SENSOR_FIELDS
+    if isinstance(transmissions, QuerySet):
+        rows = transmissions.values_list(*columns)
+    else:
+        rows = [tuple(getattr(tx, column) for column in columns) for tx in transmissions]
+
+    data = np.fromiter(chain.from_iterable(rows), dtype=np.float64)
+    data = data.reshape(-1, len(columns))
+    return data[:, 0].astype(np.int64), data[:, 1:]
+
+
+def hour_codes(timestamps, period):
+    """
+    Minute of the day (in America/Sao_Paulo) of every timestamp rounded to
+    `period`, which identifies its 'HH:MM' group.
+    """
+    local = pd.to_datetime(timestamps, unit='s', utc=True).tz_convert(TIMEZONE)
+    rounded = local.tz_localize(None).round(freq=period)
+    minutes = rounded.asi8 // 60_000_000_000
+    return minutes % 1440
+
+
+def hour_diff_sums(timestamps, sensors, period, previous=None):
+    """
+    Group the consecutive differences of every sensor column by hour of
+    the day. `previous` holds the readings preceding the first row, if
+    any, so a history can be processed in slices.
+
+    Returns the sorted hour codes, the (hours, 4) diff sums and the
+    (hours,) row counts.
+    """
+    diffs = np.empty_like(sensors)
+    if len(sensors):
+        diffs[0] = 0 if previous is None else sensors[0] - previous
+        diffs[1:] = np.diff(sensors, axis=0)
+
+    codes, inverse = np.unique(hour_codes(timestamps, period), return_inverse=True)
+    sums = np.column_stack([
+        np.bincount(inverse, weights=diffs[:, i], minlength=len(codes))
+        for i in range(sensors.shape[1])
+    ]) if len(codes) else np.zeros((0, sensors.shape[1]))
+    counts = np.bincount(inverse, minlength=len(codes))
+    return codes, sums, counts
+
+
+def relative_freq_frame(codes, sums):
+    """
+    Build the `hour_relative_freq` dataframe from per hour diff sums.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rel_freq = sums / sums.sum(axis=0)
+
+    # deviations are taken between each relative frequency and the hour
+    # frequency F, which the row by row implementation always ends up
+    # computing as zero; std and var of the pair [r, 0] are kept as is
+    mean = rel_freq / 2
+    var = (rel_freq - mean) ** 2 + mean ** 2
+    std = np.sqrt(var)
+    # the row by row implementation uses the pressure deviation for moisture
+    std[:, 3] = std[:, 2]
+
+    frame = {f'{column}_DIFF': sums[:, i] for i, column in enumerate(SENSOR_COLUMNS)}
+    frame['F'] = np.zeros(len(codes))
+    for i, column in enumerate(SENSOR_COLUMNS):
+        frame[f'{column}_REL_FREQ'] = rel_freq[:, i]
+    for i, column in enumerate(SENSOR_COLUMNS):
+        frame[f'{column}_POS_STD'] = var[:, i] + (rel_freq[:, i] + std[:, i])
+        frame[f'{column}_NEG_STD'] = var[:, i] + (rel_freq[:, i] - std[:, i])
+
+    df = pd.DataFrame(
+        frame,
+        index=pd.Index([f'{c // 60:02d}:{c % 60:02d}' for c in codes], name='HOUR')
+    )
+    for column in SENSOR_COLUMNS:
+        scaled = [f'{column}_REL_FREQ', f'{column}_POS_STD', f'{column}_NEG_STD']
+        df[scaled] = df[scaled].clip(0) * 100
+
+    return df.fillna(0).round(2)
 
 
 def hour_relative_freq(transmissions, period):
-    data = []
-    for tx in transmissions:
-        dt = datetime.fromtimestamp(tx.timestamp_origin).astimezone(
-            pytz.timezone('America/Sao_Paulo')
+    """
+    Relative frequency, by hour of the day, of the variation of every
+    sensor reading, with upper and lower deviations.
+
+    `transmissions` is an ordered ESPTransmission queryset (or iterable);
+    differences are taken between consecutive rows in that order.
+    """
+    timestamps, sensors = transmission_arrays(transmissions)
+    codes, sums, _ = hour_diff_sums(timestamps, sensors, period)
+    return relative_freq_frame(codes, sums)
+
+
+class _HourStatistics:
+    """
+    Running per minute-of-day diff sums and counts of a device history,
+    up to the (timestamp_origin, id) of the last processed row.
+    """
+    def __init__(self, generation=0):
+        self.generation = generation
+        self.sums = np.zeros((1440, len(SENSOR_FIELDS)))
+        self.counts = np.zeros(1440, dtype=np.int64)
+        self.last_key = None
+        self.last_values = None
+        self.created_at = monotonic()
+        self.lock = threading.Lock()
+
+    def advance(self, transmissions, period):
+        """
+        Fold the rows of `transmissions` newer than the last processed one.
+        """
+        if self.last_key is not None:
+            timestamp, pk = self.last_key
+            transmissions = transmissions.filter(
+                Q(timestamp_origin__gt=timestamp) |
+                Q(timestamp_origin=timestamp, id__gt=pk)
+            )
+        rows = transmissions.order_by('timestamp_origin', 'id').values_list(
+            'id', 'timestamp_origin', *SENSOR_FIELDS
         )
-        data.append([
-            dt,
-            tx.ldr_sensor,
-            tx.temperature_sensor,
-            tx.pressure,
-            tx.moisture
-        ])
-
-    # set up dataframe
-    df = pd.DataFrame(data, columns=['DATETIME', 'LDR', 'TEMP', 'PRES', 'MOIS'])
-    df = df.set_index(df['DATETIME'])
-
-    df['HOUR'] = df.index.round(freq=period).strftime('%H:'+'%M')
-    df['F'] = df.HOUR.value_counts(normalize=True)
-
-    # calculate sensor value differences
-    df['LDR_DIFF'] = df.LDR.diff().fillna(0)
-    df['TEMP_DIFF'] = df.TEMP.diff().fillna(0)
-    df['PRES_DIFF'] = df.PRES.diff().fillna(0)
-    df['MOIS_DIFF'] = df.MOIS.diff().fillna(0)
-
-    # group diff sums by time
-    df = df[['LDR_DIFF', 'TEMP_DIFF', 'PRES_DIFF', 'MOIS_DIFF', 'HOUR', 'F']].groupby('HOUR').sum()
-
-    # calculate the relative frequency
-    df['LDR_REL_FREQ'] = df['LDR_DIFF'] / df.LDR_DIFF.sum()
-    df['TEMP_REL_FREQ'] = df['TEMP_DIFF'] / df.TEMP_DIFF.sum()
-    df['PRES_REL_FREQ'] = df['PRES_DIFF'] / df.PRES_DIFF.sum()
-    df['MOIS_REL_FREQ'] = df['MOIS_DIFF'] / df.MOIS_DIFF.sum()
-
-    # caulcutae positive and negative deviations
-    df['LDR_POS_STD'] = df[['LDR_REL_FREQ', 'F']].T.var() + (df.LDR_REL_FREQ + df[['LDR_REL_FREQ', 'F']].T.std())
-    df['LDR_NEG_STD'] = df[['LDR_REL_FREQ', 'F']].T.var() + (df.LDR_REL_FREQ - df[['LDR_REL_FREQ', 'F']].T.std())
-
-    df['TEMP_POS_STD'] = df[['TEMP_REL_FREQ', 'F']].T.var() + (df.TEMP_REL_FREQ + df[['TEMP_REL_FREQ', 'F']].T.std())
-    df['TEMP_NEG_STD'] = df[['TEMP_REL_FREQ', 'F']].T.var() + (df.TEMP_REL_FREQ - df[['TEMP_REL_FREQ', 'F']].T.std())
-
-    df['PRES_POS_STD'] = df[['PRES_REL_FREQ', 'F']].T.var() + (df.PRES_REL_FREQ + df[['PRES_REL_FREQ', 'F']].T.std())
-    df['PRES_NEG_STD'] = df[['PRES_REL_FREQ', 'F']].T.var() + (df.PRES_REL_FREQ - df[['PRES_REL_FREQ', 'F']].T.std())
-
-    df['MOIS_POS_STD'] = df[['MOIS_REL_FREQ', 'F']].T.var() + (df.MOIS_REL_FREQ + df[['PRES_REL_FREQ', 'F']].T.std())
-    df['MOIS_NEG_STD'] = df[['MOIS_REL_FREQ', 'F']].T.var() + (df.MOIS_REL_FREQ - df[['PRES_REL_FREQ', 'F']].T.std())
-
-    df[['LDR_REL_FREQ', 'LDR_POS_STD', 'LDR_NEG_STD']] = (df[['LDR_REL_FREQ', 'LDR_POS_STD', 'LDR_NEG_STD']].clip(0)) * 100
-    df[['TEMP_REL_FREQ', 'TEMP_POS_STD', 'TEMP_NEG_STD']] = (df[['TEMP_REL_FREQ', 'TEMP_POS_STD', 'TEMP_NEG_STD']].clip(0)) * 100
-    df[['PRES_REL_FREQ', 'PRES_POS_STD', 'PRES_NEG_STD']] = (df[['PRES_REL_FREQ', 'PRES_POS_STD', 'PRES_NEG_STD']].clip(0)) * 100
-    df[['MOIS_REL_FREQ', 'MOIS_POS_STD', 'MOIS_NEG_STD']] = (df[['MOIS_REL_FREQ', 'MOIS_POS_STD', 'MOIS_NEG_STD']].clip(0)) * 100
+        data = np.fromiter(chain.from_iterable(rows), dtype=np.float64)
+        data = data.reshape(-1, len(SENSOR_FIELDS) + 2)
+        if not len(data):
+            return
 
-    return df.fillna(0).round(2)
+        timestamps = data[:, 1].astype(np.int64)
+        sensors = data[:, 2:]
+        codes, sums, counts = hour_diff_sums(
+            timestamps,
+            sensors,
+            period,
+            previous=self.last_values
+        )
+        self.sums[codes] += sums
+        self.counts[codes] += counts
+        self.last_key = (int(timestamps[-1]), int(data[-1, 0]))
+        self.last_values = sensors[-1].copy()
+
+    def frame(self):
+        codes = np.flatnonzero(self.counts)
+        if not len(codes):
+            return None
+        return relative_freq_frame(codes, self.sums[codes])
+
+
+class HourStatisticsCache:
+    """
+    Per device cache of `hour_relative_freq`. Transmission history is
+    append-only, so every lookup only reads the rows inserted after the
+    previous one.
+
+    Entries are evicted in LRU order beyond `max_entries` and rebuilt from
+    scratch after `ttl` seconds, which bounds how long rows arriving out of
+    timestamp order stay unaccounted for, or once the history generation of
+    their device changed: commands changing past rows (imports, deletions)
+    call `graphql_cache.invalidate_history`, which reaches every process
+    sharing the Django cache. `invalidate` only drops the entries of this
+    process.
+    """
+    def __init__(self, max_entries=256, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hour_relative_freq(self, transmissions, device_id, period, start=None):
+        """
+        Same as `hour_relative_freq(transmissions, period)` for the
+        transmissions of `device_id` from `start` on, or None if empty.
+        `transmissions` must be the queryset of those rows.
+        """
+        key = (device_id, period, start)
+        generation = history_generation(device_id)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if (entry is None or entry.generation != generation
+                    or monotonic() - entry.created_at > self.ttl):
+                entry = _HourStatistics(generation)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        with entry.lock:
+            entry.advance(transmissions, period)
+            return entry.frame()
+
+    def invalidate(self, device_id=None):
+        """
+        Drop the entries of `device_id`, or every entry.
+        """
+        with self._lock:
+            if device_id is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[0] == device_id]:
+                del self._entries[key]
+
+
+hour_statistics = HourStatisticsCache(
+    max_entries=settings.HOUR_STATISTICS_CACHE['MAX_ENTRIES'],
+    ttl=settings.HOUR_STATISTICS_CACHE['TTL'],
+)
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling. Returns the indexes of the
+    `threshold` points of (x, y) that best preserve the visual shape of
+    the series, always keeping the first and last points.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    size = len(x)
+    if threshold >= size or threshold < 3:
+        return np.arange(size)
+
+    every = (size - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        avg_start = int(np.floor((i + 1) * every)) + 1
+        avg_end = min(int(np.floor((i + 2) * every)) + 1, size)
+        avg_x = x[avg_start:avg_end].mean()
+        avg_y = y[avg_start:avg_end].mean()
+
+        range_start = int(np.floor(i * every)) + 1
+        range_end = int(np.floor((i + 1) * every)) + 1
+        areas = np.abs(
+            (x[a] - avg_x) * (y[range_start:range_end] - y[a]) -
+            (x[a] - x[range_start:range_end]) * (avg_y - y[a])
+        )
+        a = range_start + int(np.argmax(areas))
+        selected.append(a)
+
+    selected.append(size - 1)
+    return np.array(selected)
@@ -1,3 +1,1531 @@
-from django.test import TestCase
+import os
+import time
+from unittest import skipUnless
+import pandas as pd
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from greenhouse import decoders, transmission_parser
+from greenhouse.bench import bulk_insert, esp_readings
+from greenhouse.export import export_columns, parquet_schema, pyarrow, stream_parquet
+from greenhouse.ingest import ROWS_FAILED, ROWS_WRITTEN, BatchWriter, DeviceRegistry
+from greenhouse.management.commands.bench_statistics import hour_relative_freq_legacy
+from greenhouse.metrics import Registry
+from greenhouse.pagination import encode_cursor, keyset_page
+from greenhouse.models import (Device, ESPTransmission, ESPTransmissionRollup,
+                               Installation, SensorHCSR04)
+from greenhouse.rollups import rebuild_rollups
+from greenhouse.statistics import HourStatisticsCache, hour_relative_freq, hour_statistics
+from greenhouse.timeseries import row_fields, with_device_column
+from greenhouse.workers import Supervisor
+from iot_api.schema import schema
 
-# Create your tests here.
+
+def esp_transmission(mac='AA:BB', timestamp=1668000000, **kwargs):
+    # unsaved device, linked to the stored one by BatchWriter or bulk_insert
+    values = dict(
+        timestamp_origin=timestamp,
+        timestamp_receive=timestamp + 1,
+        device=Device(device_id=mac),
+        ldr_sensor=1000.0,
+        temperature_sensor=25.0,
+        pressure=1013.0,
+        moisture=40.0
+    )
+    values.update(kwargs)
+    return ESPTransmission(**values)
+
+
+class BatchWriterTestCase(TestCase):
+    def test_flush_writes_every_model(self):
+        writer = BatchWriter(batch_size=2)
+        writer.flush([
+            esp_transmission(timestamp=1),
+            SensorHCSR04(device=Device(device_id='1'), timestamp_origin=1, timestamp_receive=2, distance=3.0),
+            esp_transmission(timestamp=2),
+        ])
+        self.assertEqual(ESPTransmission.objects.count(), 2)
+        self.assertEqual(SensorHCSR04.objects.count(), 1)
+        self.assertEqual(writer.written, 3)
+
+    def test_on_written_gets_only_committed_rows(self):
+        calls = []
+        writer = BatchWriter(recent_keys=0, on_written=lambda model, instances: calls.append(
+            (model, [tx.timestamp_origin for tx in instances])
+        ))
+        writer.flush([esp_transmission(timestamp=1)])
+        writer.flush([esp_transmission(timestamp=1), esp_transmission(timestamp=2)])
+        self.assertEqual(calls, [(ESPTransmission, [1]), (ESPTransmission, [2])])
+
+    def test_drop_newest(self):
+        writer = BatchWriter(queue_size=1, overflow='drop_newest')
+        self.assertTrue(writer.put(esp_transmission(timestamp=1)))
+        self.assertFalse(writer.put(esp_transmission(timestamp=2)))
+        self.assertEqual(writer.queue.get().timestamp_origin, 1)
+        self.assertEqual(writer.dropped, 1)
+
+    def test_drop_oldest(self):
+        writer = BatchWriter(queue_size=1, overflow='drop_oldest')
+        writer.put(esp_transmission(timestamp=1))
+        self.assertTrue(writer.put(esp_transmission(timestamp=2)))
+        self.assertEqual(writer.queue.get().timestamp_origin, 2)
+        self.assertEqual(writer.dropped, 1)
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            BatchWriter(overflow='explode')
+
+    def test_put_drops_recent_duplicates(self):
+        writer = BatchWriter(recent_keys=2)
+        self.assertTrue(writer.put(esp_transmission(timestamp=1)))
+        self.assertFalse(writer.put(esp_transmission(timestamp=1)))
+        self.assertTrue(writer.put(esp_transmission(mac='CC:DD', timestamp=1)))
+        self.assertTrue(writer.put(esp_transmission(timestamp=2)))
+        # evicted, caught by the flush instead
+        self.assertTrue(writer.put(esp_transmission(timestamp=1)))
+        self.assertEqual(writer.duplicates, 1)
+        self.assertEqual(writer.queue.qsize(), 4)
+
+    def test_flush_skips_stored_and_repeated_rows(self):
+        writer = BatchWriter(recent_keys=0)
+        writer.flush([esp_transmission(timestamp=1), esp_transmission(timestamp=2)])
+        writer.flush([
+            esp_transmission(timestamp=2, moisture=99.0),
+            esp_transmission(timestamp=3),
+            esp_transmission(timestamp=3),
+        ])
+        self.assertEqual(ESPTransmission.objects.count(), 3)
+        self.assertEqual(ESPTransmission.objects.get(timestamp_origin=2).moisture, 40.0)
+        self.assertEqual((writer.written, writer.duplicates), (3, 2))
+        self.assertEqual(ESPTransmissionRollup.objects.get(resolution=86400).count, 3)
+
+    def test_flush_loses_only_failing_rows(self):
+        failed = ROWS_FAILED.value()
+        writer = BatchWriter()
+        writer.flush([esp_transmission(timestamp=i, moisture=None if i == 3 else i) for i in range(6)])
+        self.assertEqual(
+            list(ESPTransmission.objects.order_by('timestamp_origin').values_list('timestamp_origin', flat=True)),
+            [0, 1, 2, 4, 5]
+        )
+        self.assertEqual(ESPTransmissionRollup.objects.get(resolution=86400).count, 5)
+        self.assertEqual((writer.written, writer.duplicates), (5, 0))
+        self.assertEqual(ROWS_FAILED.value() - failed, 1)
+
+    def test_flush_retries_transient_errors(self):
+        from unittest import mock
+        from django.db import OperationalError
+        from greenhouse.timeseries import insert_transmissions
+        calls = []
+
+        def locked_once(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            return insert_transmissions(*args)
+
+        writer = BatchWriter(retry_delay=0)
+        with mock.patch('greenhouse.ingest.insert_transmissions', locked_once):
+            writer.flush([esp_transmission(timestamp=i) for i in range(4)])
+        self.assertEqual((len(calls), writer.written), (2, 4))
+        self.assertEqual(ESPTransmission.objects.count(), 4)
+
+    def test_insert_returns_inserted_rows(self):
+        from unittest import mock
+        from greenhouse.timeseries import insert_transmissions
+        for returning in (True, False):
+            ESPTransmission.objects.all().delete()
+            # stored by another writer
+            bulk_insert(ESPTransmission, [esp_transmission(timestamp=2)])
+            with mock.patch('greenhouse.timeseries._returns_rows', return_value=returning):
+                instances = [
+                    esp_transmission(timestamp=1),
+                    esp_transmission(timestamp=2),
+                    esp_transmission(mac='CC:DD', timestamp=2),
+                ]
+                BatchWriter().devices.assign(ESPTransmission, instances)
+                inserted = insert_transmissions(ESPTransmission, instances)
+            self.assertEqual(
+                sorted((tx.pk, tx.device.device_id, tx.timestamp_origin) for tx in inserted),
+                sorted(ESPTransmission.objects.exclude(timestamp_origin=2, device__device_id='AA:BB').values_list(
+                    'id', 'device__device_id', 'timestamp_origin'
+                ))
+            )
+            self.assertEqual(len(inserted), 2)
+
+    def test_unique_constraint(self):
+        bulk_insert(ESPTransmission, [esp_transmission(timestamp=1)])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            bulk_insert(ESPTransmission, [esp_transmission(timestamp=1)])
+
+
+class DatabaseProfileTestCase(TestCase):
+    def test_sqlite_pragmas(self):
+        from django.conf import settings
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite profile')
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_PRAGMAS['busy_timeout'])
+            cursor.execute('PRAGMA synchronous')
+            # NORMAL
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+
+class BatchWriterThreadTestCase(TransactionTestCase):
+    def test_stop_drains_queue(self):
+        writer = BatchWriter(batch_size=10, flush_interval=0.05)
+        writer.start()
+        for i in range(25):
+            writer.put(esp_transmission(timestamp=i))
+        writer.stop(timeout=5)
+        self.assertEqual(ESPTransmission.objects.count(), 25)
+
+
+class DeviceRegistryTestCase(TestCase):
+    def test_flush_links_and_registers_devices(self):
+        Device.objects.create(hardware_type='esp', device_id='AA:BB', description='Known')
+        writer = BatchWriter()
+        writer.flush([
+            esp_transmission(timestamp=1),
+            esp_transmission(mac='CC:DD', timestamp=1),
+            SensorHCSR04(device=Device(device_id='7'), timestamp_origin=1, timestamp_receive=2, distance=3.0),
+        ])
+        self.assertEqual(
+            sorted(Device.objects.values_list('device_id', 'hardware_type', 'auto_registered')),
+            [('7', 'hcsr04_device', True), ('AA:BB', 'esp', False), ('CC:DD', 'esp', True)]
+        )
+        self.assertEqual(
+            sorted(ESPTransmission.objects.values_list('timestamp_origin', 'device__device_id')),
+            [(1, 'AA:BB'), (1, 'CC:DD')]
+        )
+        self.assertEqual(SensorHCSR04.objects.get().device.device_id, '7')
+
+        # known devices are not looked up again
+        with self.assertNumQueries(0):
+            device = writer.devices.get(ESPTransmission, 'CC:DD')
+        self.assertTrue(device.auto_registered)
+
+    def test_device_key(self):
+        columns = {field.column for field in ESPTransmission._meta.concrete_fields}
+        self.assertIn('device_id', columns)
+        self.assertNotIn('mac_address', columns)
+        self.assertNotIn('mac', {field.column for field in SensorHCSR04._meta.concrete_fields})
+
+        # the same timestamp is unique per device
+        bulk_insert(ESPTransmission, [esp_transmission(timestamp=1), esp_transmission(mac='CC:DD', timestamp=1)])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            bulk_insert(ESPTransmission, [esp_transmission(mac='CC:DD', timestamp=1)])
+
+    def test_delete_device_cascades(self):
+        bulk_insert(ESPTransmission, [esp_transmission(timestamp=t) for t in range(50)])
+        bulk_insert(ESPTransmission, [esp_transmission(mac='CC:DD', timestamp=1)])
+        rebuild_rollups(ESPTransmission)
+        device = Device.objects.get(device_id='AA:BB')
+        # one DELETE per table, rows are neither fetched nor updated
+        with CaptureQueriesContext(connection) as queries:
+            device.delete()
+        self.assertFalse(any(query['sql'].startswith('UPDATE') for query in queries))
+        statements = [query['sql'] for query in queries if '"greenhouse_esptransmission"' in query['sql']]
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith('DELETE'))
+        self.assertEqual(list(ESPTransmission.objects.values_list('device__device_id', flat=True)), ['CC:DD'])
+        self.assertEqual(
+            set(ESPTransmissionRollup.objects.values_list('device__device_id', flat=True)), {'CC:DD'}
+        )
+
+    def test_has_data_and_claim(self):
+        Device.objects.create(hardware_type='esp', device_id='EE:FF', description='')
+        BatchWriter().flush([esp_transmission(timestamp=1)])
+        query = '{ devices(hasData: %s) { deviceId } }'
+        self.assertEqual(schema.execute(query % 'true').data['devices'], [{'deviceId': 'AA:BB'}])
+        self.assertEqual(schema.execute(query % 'false').data['devices'], [{'deviceId': 'EE:FF'}])
+
+        mutation = """mutation {
+            createDevice(input: {hardwareType: "esp", deviceId: "AA:BB", description: "Bench"}) {
+                device { description }
+            }
+        }"""
+        result = schema.execute(mutation)
+        self.assertIsNone(result.errors)
+        self.assertFalse(Device.objects.get(device_id='AA:BB').auto_registered)
+        # claimed devices are not overwritten
+        self.assertIsNotNone(schema.execute(mutation).errors)
+
+
+@override_settings(TRANSMISSION_PAGE_SIZE=2, TRANSMISSION_MAX_PAGE_SIZE=3)
+class TransmissionPaginationTestCase(TestCase):
+    query = """
+        query ($after: String, $first: Int) {
+            espTransmissions(first: $first, after: $after, timestampOrigin_Gte: 10) {
+                edges { cursor node { timestampOrigin } }
+                pageInfo { hasNextPage endCursor }
+            }
+        }
+    """
+
+    def setUp(self):
+        # two devices share each timestamp to exercise the id tie breaker
+        bulk_insert(ESPTransmission, [
+            esp_transmission(mac='CC:DD' if i % 2 else 'AA:BB', timestamp=10 + i // 2)
+            for i in range(7)
+        ] + [esp_transmission(timestamp=5)])
+
+    def fetch(self, **variables):
+        result = schema.execute(self.query, variables=variables)
+        self.assertIsNone(result.errors)
+        return result.data['espTransmissions']
+
+    def test_walk_pages(self):
+        timestamps = []
+        after = None
+        pages = 0
+        while True:
+            page = self.fetch(after=after)
+            pages += 1
+            timestamps += [edge['node']['timestampOrigin'] for edge in page['edges']]
+            if not page['pageInfo']['hasNextPage']:
+                break
+            after = page['pageInfo']['endCursor']
+
+        self.assertEqual(pages, 4)
+        self.assertEqual(timestamps, [10, 10, 11, 11, 12, 12, 13])
+
+    def test_max_page_size(self):
+        self.assertEqual(len(self.fetch(first=500)['edges']), 3)
+
+    def test_pages_read_the_time_index_in_order(self):
+        with CaptureQueriesContext(connection) as queries:
+            keyset_page(ESPTransmission.objects.all(), after=encode_cursor(10, 1))
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + queries[0]['sql'])
+            plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+        self.assertIn('esp_timestamp_id_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_device_transmissions(self):
+        result = schema.execute("""{
+            device(deviceId: "AA:BB") {
+                transmissions(first: 2, timestampOrigin_Lte: 11) {
+                    edges { node }
+                    pageInfo { hasNextPage }
+                }
+            }
+        }""")
+        self.assertIsNone(result.errors)
+        transmissions = result.data['device']['transmissions']
+        self.assertEqual(
+            [edge['node']['timestamp_origin'] for edge in transmissions['edges']],
+            [5, 10]
+        )
+        self.assertTrue(transmissions['pageInfo']['hasNextPage'])
+
+
+class TransmissionBucketsTestCase(TestCase):
+    query = """
+        query ($points: Int) {
+            transmissionBuckets(
+                deviceId: "AA:BB",
+                start: "2022-11-09T13:20:00+00:00",
+                end: "2022-11-09T14:20:00+00:00",
+                bucket: 600,
+                points: $points
+            ) {
+                bucketStart count
+                temperatureSensor { min max avg last }
+            }
+        }
+    """
+
+    def setUp(self):
+        Device.objects.create(hardware_type='esp', device_id='AA:BB', description='')
+        # one reading per minute during an hour, temperature grows by one each minute
+        bulk_insert(ESPTransmission, [
+            esp_transmission(timestamp=1668000000 + i * 60, temperature_sensor=i)
+            for i in range(60)
+        ])
+        rebuild_rollups(ESPTransmission)
+
+    def test_buckets(self):
+        result = schema.execute(self.query)
+        self.assertIsNone(result.errors)
+        buckets = result.data['transmissionBuckets']
+        self.assertEqual(len(buckets), 6)
+        self.assertEqual(sum(b['count'] for b in buckets), 60)
+        self.assertEqual(buckets[0]['bucketStart'], 1668000000)
+        self.assertEqual(
+            buckets[0]['temperatureSensor'],
+            {'min': 0.0, 'max': 9.0, 'avg': 4.5, 'last': 9.0}
+        )
+
+    def test_downsample(self):
+        result = schema.execute(self.query, variables={'points': 3})
+        self.assertIsNone(result.errors)
+        buckets = result.data['transmissionBuckets']
+        self.assertEqual(len(buckets), 3)
+        self.assertEqual(buckets[0]['bucketStart'], 1668000000)
+        self.assertEqual(buckets[-1]['bucketStart'], 1668003000)
+
+    def test_raw_rows_match_rollups(self):
+        # an unaligned range is answered from raw rows
+        raw = schema.execute(self.query.replace('14:20:00', '14:20:30'))
+        self.assertIsNone(raw.errors)
+        self.assertEqual(
+            raw.data['transmissionBuckets'],
+            schema.execute(self.query).data['transmissionBuckets']
+        )
+
+
+class RollupTestCase(TestCase):
+    def test_ingest_updates_rollups(self):
+        writer = BatchWriter()
+        writer.flush([esp_transmission(timestamp=1668000000 + i * 30, moisture=i) for i in range(4)])
+        writer.flush([esp_transmission(timestamp=1668000000 + i * 30, moisture=i) for i in range(4, 6)])
+
+        minute = ESPTransmissionRollup.objects.get(resolution=60, bucket_start=1668000060)
+        self.assertEqual(minute.count, 2)
+        self.assertEqual(minute.moisture_sum, 5.0)
+        self.assertEqual(minute.moisture_last, 3.0)
+
+        day = ESPTransmissionRollup.objects.get(resolution=86400)
+        self.assertEqual(day.count, 6)
+        self.assertEqual(day.moisture_sum_sq, 55.0)
+        self.assertEqual((day.moisture_min, day.moisture_max, day.moisture_last), (0, 5, 5))
+
+        incremental = list(ESPTransmissionRollup.objects.order_by('id').values())
+        rebuild_rollups(ESPTransmission)
+        rebuilt = list(ESPTransmissionRollup.objects.order_by('id').values())
+        for row in incremental + rebuilt:
+            del row['id']
+        self.assertCountEqual(incremental, rebuilt)
+
+    def test_ingest_updates_rollup_rows_in_place(self):
+        writer = BatchWriter()
+        writer.flush([esp_transmission(timestamp=1668000000, moisture=2)])
+        ids = dict(ESPTransmissionRollup.objects.values_list('resolution', 'id'))
+
+        writer.flush([
+            esp_transmission(timestamp=1668000030, moisture=1),
+            esp_transmission(timestamp=1668003600, moisture=4),
+        ])
+        minute, hour, day = ESPTransmissionRollup.objects.filter(id__in=ids.values()).order_by('resolution')
+        self.assertEqual(
+            [(row.id, row.count, row.moisture_min, row.moisture_last) for row in (minute, hour, day)],
+            [(ids[60], 2, 1, 1), (ids[3600], 2, 1, 1), (ids[86400], 3, 1, 4)]
+        )
+        self.assertEqual(ESPTransmissionRollup.objects.count(), 5)
+
+    def test_upsert_merges_like_summarize(self):
+        from greenhouse.rollups import summarize, upsert_rollups
+        device = Device.objects.create(hardware_type='esp', device_id='AA:BB', description='')
+        later = [
+            esp_transmission(timestamp=1668000000 + i * 7, moisture=i % 5, pressure=-i, device=device)
+            for i in range(40)
+        ]
+        # older readings of the same buckets arriving afterwards
+        earlier = [esp_transmission(timestamp=1668000001 + i * 7, moisture=9 - i % 3, device=device) for i in range(20)]
+        upsert_rollups(ESPTransmission, summarize(ESPTransmission, later))
+        upsert_rollups(ESPTransmission, summarize(ESPTransmission, earlier))
+
+        expected = summarize(ESPTransmission, later + earlier)
+        stored = {
+            (row.pop('device_id'), row.pop('resolution'), row.pop('bucket_start')): row
+            for row in ESPTransmissionRollup.objects.values()
+        }
+        for row in stored.values():
+            del row['id']
+        self.assertEqual(stored, expected)
+
+    def test_split_range(self):
+        from greenhouse.timeseries import split_range
+        self.assertEqual(split_range(86399, 3 * 86400 + 3661), (
+            [(86400, 86400, 259200), (3600, 259200, 262800), (60, 262800, 262860)],
+            [(86399, 86400), (262860, 262861)]
+        ))
+        # only the resolutions dividing the bucket
+        self.assertEqual(split_range(0, 86400, bucket=5400), ([(60, 0, 86400)], []))
+        self.assertEqual(split_range(10, 50), ([], [(10, 50)]))
+
+    def test_unaligned_ranges(self):
+        from greenhouse.timeseries import bucket_aggregate, sensor_summary
+        day = 1667952000
+        readings = [(day + i * 419, float(i % 13)) for i in range(700)]
+        BatchWriter().flush([esp_transmission(timestamp=t, moisture=value) for t, value in readings])
+        device = Device.objects.get(device_id='AA:BB')
+
+        ranges = [(day + 1, day + 2 * 86400 + 3661, 2), (day - 5, day + 86400 * 3 + 7, 2), (day + 59, day + 61, 1)]
+        for start, end, queries in ranges:
+            values = [value for t, value in readings if start <= t < end]
+            with self.assertNumQueries(queries):
+                summary = sensor_summary(ESPTransmission, device, 'moisture', start, end)
+            self.assertEqual(summary['count'], len(values))
+            if values:
+                self.assertAlmostEqual(summary['mean'], sum(values) / len(values))
+                self.assertEqual((summary['min'], summary['max']), (min(values), max(values)))
+
+            buckets = bucket_aggregate(ESPTransmission, device, start, end, 7200)
+            expected = {}
+            for t, value in readings:
+                if start <= t < end:
+                    expected.setdefault(t // 7200 * 7200, []).append(value)
+            self.assertEqual([row['bucket_start'] for row in buckets], sorted(expected))
+            for row in buckets:
+                values = expected[row['bucket_start']]
+                self.assertEqual(row['count'], len(values))
+                self.assertAlmostEqual(row['moisture']['avg'], sum(values) / len(values))
+                self.assertEqual(
+                    (row['moisture']['min'], row['moisture']['max'], row['moisture']['last']),
+                    (min(values), max(values), values[-1])
+                )
+
+    def test_sensor_summary(self):
+        Device.objects.create(hardware_type='esp', device_id='AA:BB', description='')
+        bulk_insert(ESPTransmission, [
+            esp_transmission(timestamp=1667952000 + i * 3600, pressure=i % 4) for i in range(48)
+        ])
+        rebuild_rollups(ESPTransmission)
+        query = """{
+            device(deviceId: "AA:BB") {
+                sensorSummary(field: "pressure", start: "%s", end: "2022-11-11T00:00:00+00:00") {
+                    count mean std min max
+                }
+            }
+        }"""
+        from_rollups = schema.execute(query % '2022-11-09T00:00:00+00:00')
+        self.assertIsNone(from_rollups.errors)
+        self.assertEqual(
+            from_rollups.data['device']['sensorSummary'],
+            {'count': 48, 'mean': 1.5, 'std': 1.118033988749895, 'min': 0.0, 'max': 3.0}
+        )
+        from_raw = schema.execute(query % '2022-11-08T23:59:59+00:00')
+        self.assertEqual(
+            from_raw.data['device']['sensorSummary'],
+            from_rollups.data['device']['sensorSummary']
+        )
+
+
+class HourRelativeFreqTestCase(TestCase):
+    def setUp(self):
+        hour_statistics.invalidate()
+        Device.objects.create(hardware_type='esp', device_id='AA:BB', description='')
+        bulk_insert(ESPTransmission, esp_readings(Device(device_id='AA:BB'), 1668000000, 3000, step=97))
+
+    def test_matches_row_by_row_implementation(self):
+        transmissions = ESPTransmission.objects.order_by('timestamp_origin', 'id')
+        for period in ('3600S', '1800S'):
+            pd.testing.assert_frame_equal(
+                hour_relative_freq(transmissions, period),
+                hour_relative_freq_legacy(transmissions, period),
+                check_exact=False,
+                atol=0.01
+            )
+
+    def test_device_field(self):
+        result = schema.execute("""{
+            device(deviceId: "AA:BB") {
+                hourRelativeFrequency { hours ldrRelativeFrequency moistureHighStd }
+            }
+        }""")
+        self.assertIsNone(result.errors)
+        frequency = result.data['device']['hourRelativeFrequency']
+        self.assertEqual(len(frequency['hours']), 24)
+        self.assertEqual(frequency['hours'][0], '00:00')
+        self.assertEqual(len(frequency['ldrRelativeFrequency']), 24)
+
+
+class HourStatisticsCacheTestCase(TestCase):
+    def test_incremental_matches_full_computation(self):
+        cache = HourStatisticsCache()
+        readings = list(esp_readings(Device(device_id='AA:BB'), 1668000000, 2000, step=131))
+        transmissions = ESPTransmission.objects.filter(device__device_id='AA:BB')
+
+        self.assertIsNone(cache.hour_relative_freq(transmissions, 'AA:BB', '3600S'))
+        for chunk in (readings[:700], readings[700:701], readings[701:]):
+            bulk_insert(ESPTransmission, chunk)
+            cached = cache.hour_relative_freq(transmissions, 'AA:BB', '3600S')
+
+        pd.testing.assert_frame_equal(
+            cached,
+            hour_relative_freq(transmissions.order_by('timestamp_origin', 'id'), '3600S'),
+            check_exact=False,
+            atol=0.01
+        )
+
+        # nothing new: a single query for rows after the last processed one
+        with self.assertNumQueries(1):
+            cache.hour_relative_freq(transmissions, 'AA:BB', '3600S')
+
+    def test_eviction_and_invalidation(self):
+        cache = HourStatisticsCache(max_entries=1)
+        bulk_insert(ESPTransmission, esp_readings(Device(device_id='AA:BB'), 1668000000, 10))
+        transmissions = ESPTransmission.objects.filter(device__device_id='AA:BB')
+
+        cache.hour_relative_freq(transmissions, 'AA:BB', '3600S')
+        cache.hour_relative_freq(transmissions, 'AA:BB', '3600S', start=1668000000)
+        self.assertEqual(list(cache._entries), [('AA:BB', '3600S', 1668000000)])
+
+        cache.invalidate('AA:BB')
+        self.assertFalse(cache._entries)
+
+    def test_history_invalidation_reaches_other_processes(self):
+        from greenhouse.graphql_cache import invalidate_history
+        cache = HourStatisticsCache()
+        bulk_insert(ESPTransmission, esp_readings(Device(device_id='AA:BB'), 1668000000, 500, step=131))
+        transmissions = ESPTransmission.objects.filter(device__device_id='AA:BB')
+        cache.hour_relative_freq(transmissions, 'AA:BB', '3600S')
+
+        # as prune_transmissions does, without touching this process' entries
+        transmissions.filter(timestamp_origin__lt=1668000000 + 131 * 250).delete()
+        invalidate_history(['AA:BB'])
+
+        pd.testing.assert_frame_equal(
+            cache.hour_relative_freq(transmissions, 'AA:BB', '3600S'),
+            hour_relative_freq(transmissions.order_by('timestamp_origin', 'id'), '3600S'),
+            check_exact=False,
+            atol=0.01
+        )
+
+
+class DeviceQueryCountTestCase(TestCase):
+    def setUp(self):
+        for i in range(20):
+            device = Device.objects.create(
+                hardware_type='hcsr04_device' if i % 4 == 0 else 'esp',
+                device_id=str(i),
+                description=''
+            )
+            if i % 2:
+                Installation.objects.create(
+                    reference=f'greenhouse {i}',
+                    device=device,
+                    latitude=0,
+                    longitude=0,
+                    description=''
+                )
+            if i % 4 == 0:
+                bulk_insert(SensorHCSR04, [
+                    SensorHCSR04(device=device, timestamp_origin=t, timestamp_receive=t, distance=t)
+                    for t in range(i)
+                ])
+            else:
+                bulk_insert(ESPTransmission, [
+                    esp_transmission(timestamp=t, moisture=t, device=device) for t in range(i)
+                ])
+
+    def execute(self, query):
+        result = schema.execute(query, context_value=type('Context', (), {})())
+        self.assertIsNone(result.errors)
+        return result.data
+
+    def test_devices(self):
+        # devices + (count, last) per transmission model + installations
+        with self.assertNumQueries(6):
+            devices = self.execute(
+                '{ devices { deviceId transmissionCount isInstalled lastTransmission } }'
+            )['devices']
+
+        self.assertEqual(len(devices), 20)
+        for device in devices:
+            i = int(device['deviceId'])
+            self.assertEqual(device['transmissionCount'], i)
+            self.assertEqual(device['isInstalled'], bool(i % 2))
+            if not i:
+                self.assertIsNone(device['lastTransmission'])
+            elif i % 4:
+                self.assertEqual(device['lastTransmission']['moisture'], i - 1)
+            else:
+                self.assertEqual(device['lastTransmission']['distance'], i - 1)
+
+    def test_installations(self):
+        # installations joined with devices + one count (only ESP devices are installed)
+        with self.assertNumQueries(2):
+            installations = self.execute(
+                '{ installations { reference device { deviceId transmissionCount } } }'
+            )['installations']
+        self.assertEqual(len(installations), 10)
+
+
+class AsyncGraphQLViewTestCase(TransactionTestCase):
+    async def test_async_endpoint(self):
+        from django.test import AsyncClient
+        response = await AsyncClient().post(
+            '/graphql/async/',
+            {'query': '{ version devices { deviceId } }'},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(),
+            {'data': {'version': '0.0.9', 'devices': []}}
+        )
+
+
+class TransmissionSubscriptionTestCase(TransactionTestCase):
+    query = """
+        subscription {
+            transmissionReceived(deviceIds: ["AA:BB"])
+        }
+    """
+
+    async def subscribe(self):
+        from channels.testing import WebsocketCommunicator
+        from iot_api.asgi import application
+
+        communicator = WebsocketCommunicator(
+            application,
+            '/subscriptions',
+            subprotocols=['graphql-ws']
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.send_json_to({'type': 'connection_init', 'payload': {}})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'connection_ack')
+        await communicator.send_json_to({
+            'id': '1',
+            'type': 'start',
+            'payload': {'query': self.query},
+        })
+        # let the subscription register on the hub
+        await communicator.receive_nothing(0.2)
+        return communicator
+
+    async def test_receives_ingested_transmissions(self):
+        from asgiref.sync import sync_to_async
+
+        communicator = await self.subscribe()
+        writer = BatchWriter()
+        await sync_to_async(writer.flush)([
+            esp_transmission(mac='CC:DD', timestamp=1),
+            esp_transmission(mac='AA:BB', timestamp=2, moisture=12.5),
+        ])
+
+        message = await communicator.receive_json_from(timeout=2)
+        self.assertEqual(message['type'], 'data')
+        transmission = message['payload']['data']['transmissionReceived']
+        self.assertEqual(transmission['mac_address'], 'AA:BB')
+        self.assertEqual(transmission['moisture'], 12.5)
+        self.assertTrue(await communicator.receive_nothing(0.2))
+        await communicator.disconnect()
+
+    async def test_relays_channel_layer(self):
+        from channels.layers import get_channel_layer
+        from greenhouse.pubsub import GROUP
+
+        communicator = await self.subscribe()
+        # a batch broadcast by an mqtt_sub running in another process
+        await get_channel_layer().group_send(GROUP, {
+            'type': 'transmissions',
+            'origin': 'another process',
+            'transmissions': [{'device_id': 'AA:BB', 'distance': 3.0}],
+        })
+        message = await communicator.receive_json_from(timeout=2)
+        self.assertEqual(
+            message['payload']['data']['transmissionReceived'],
+            {'device_id': 'AA:BB', 'distance': 3.0}
+        )
+        await communicator.disconnect()
+
+
+@override_settings(LDR_DEVICE='greenhouse/esp', HCSR_DEVICE='greenhouse/hcsr04')
+class DecodersTestCase(TestCase):
+    def setUp(self):
+        decoders._routes.clear()
+
+    def tearDown(self):
+        decoders._routes.clear()
+
+    def test_text_matches_literal_eval(self):
+        from ast import literal_eval
+        data = ['AA:BB:CC:DD:EE:FF', 1668000000, 1200.5, -3.25, 1e3, 41]
+        payload = str(data).encode('utf-8')
+        self.assertEqual(decoders.decode_text(payload), tuple(literal_eval(payload.decode())))
+
+    def test_text_rejects_expressions(self):
+        for payload in (b"[__import__('os'), 1]", b"[1, [2]]", b"['a\\'', 1]", b'[1, 2', b'[1,, 2]'):
+            with self.assertRaises(decoders.DecodeError):
+                decoders.decode_text(payload)
+
+    def test_checks_field_count_and_values(self):
+        _, decode = decoders.route('greenhouse/esp')
+        with self.assertRaises(decoders.DecodeError):
+            decode(b"['AA:BB', 1, 2.0]")
+        with self.assertRaises(decoders.DecodeError):
+            decode(b"['AA:BB', 1, 2.0, 3.0, 4.0, nan]")
+        with self.assertRaises(decoders.DecodeError):
+            decode(b"[1, 1, 2.0, 3.0, 4.0, 5.0]")
+
+    def test_binary_round_trip(self):
+        data = ('AA:BB:CC:DD:EE:FF', 1668000000, 1200.5, -3.25, 1013.0, 41.0)
+        payload = decoders.encode_binary(decoders.ESP, data)
+        self.assertEqual(len(payload), 26)
+        self.assertEqual(decoders.decode_binary(decoders.ESP, payload), data)
+        with self.assertRaises(decoders.DecodeError):
+            decoders.decode_binary(decoders.ESP, payload[:-1])
+
+    def test_route(self):
+        data = [7, 1668000000, 12.5]
+        kind, decode = decoders.route('greenhouse/hcsr04/json')
+        self.assertEqual(kind, decoders.HCSR04)
+        self.assertEqual(decode(b'[7, 1668000000, 12.5]'), tuple(data))
+
+        kind, decode = decoders.route('greenhouse/hcsr04/bin')
+        self.assertEqual(decode(decoders.encode_binary(kind, data)), tuple(data))
+
+        self.assertEqual(decoders.route('greenhouse/esp')[0], decoders.ESP)
+        self.assertIsNone(decoders.route('greenhouse/other'))
+
+
+def exiting_worker(index, count):
+    pass
+
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class FakeClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload):
+        self.published.append((topic, payload))
+
+
+class FakeWriter:
+    def __init__(self):
+        self.instances = []
+        self.devices = DeviceRegistry()
+
+    def put(self, instance):
+        self.instances.append(instance)
+
+
+@override_settings(LDR_DEVICE='greenhouse/esp', HCSR_DEVICE='greenhouse/hcsr04')
+class ShardedConsumersTestCase(TestCase):
+    def setUp(self):
+        decoders._routes.clear()
+        self.addCleanup(decoders._routes.clear)
+        self.addCleanup(setattr, transmission_parser, 'writer', None)
+        self.addCleanup(setattr, transmission_parser, 'partition', None)
+
+    def consume(self, messages, partition):
+        transmission_parser.writer = FakeWriter()
+        transmission_parser.partition = partition
+        for message in messages:
+            transmission_parser.on_message(FakeClient(), None, message)
+        return transmission_parser.writer.instances
+
+    def test_hash_partitions_devices(self):
+        macs = [f'AA:BB:CC:DD:EE:{i:02X}' for i in range(20)]
+        messages = [
+            FakeMessage('greenhouse/esp', str([mac, 1668000000, 1.0, 2.0, 3.0, 4.0]).encode())
+            for mac in macs
+        ] + [FakeMessage('greenhouse/hcsr04', f'[{i}, 1668000000, 12.5]'.encode()) for i in range(10)]
+
+        seen = []
+        for index in range(3):
+            instances = self.consume(messages, (index, 3))
+            seen += [tx.device.device_id for tx in instances]
+
+        self.assertEqual(sorted(map(str, seen)), sorted(macs + [str(i) for i in range(10)]))
+
+    def test_icon_updates_published_once_written(self):
+        from unittest import mock
+        client = FakeClient()
+        writer = BatchWriter(recent_keys=0, on_written=transmission_parser.publish_icon_updates)
+        with mock.patch.object(transmission_parser, 'mqtt_client', client):
+            writer.flush([
+                esp_transmission(timestamp=1),
+                SensorHCSR04(device=Device(device_id='1'), timestamp_origin=1, timestamp_receive=2, distance=3.0),
+            ])
+            writer.flush([esp_transmission(timestamp=1)])
+        self.assertEqual(client.published, [('map/icon_update', "['AA:BB', 1, 1000.0, 25.0, 1013.0, 40.0]")])
+
+    def test_shared_subscription_topics(self):
+        self.assertEqual(
+            transmission_parser.subscription_topics('greenhouse/#', 'ingest'),
+            '$share/ingest/greenhouse/#'
+        )
+        self.assertEqual(
+            transmission_parser.subscription_topics([('a', 0), ('b', 1)], 'ingest'),
+            [('$share/ingest/a', 0), ('$share/ingest/b', 1)]
+        )
+        self.assertEqual(transmission_parser.subscription_topics('a'), 'a')
+
+    def test_supervisor_restarts_dead_workers(self):
+        from time import monotonic, sleep
+
+        supervisor = Supervisor(
+            2,
+            target='greenhouse.tests.exiting_worker',
+            min_uptime=0,
+            poll_interval=0.05
+        )
+        supervisor.start()
+        try:
+            deadline = monotonic() + 30
+            while supervisor.restarts < 4 and monotonic() < deadline:
+                supervisor.check()
+                sleep(0.05)
+        finally:
+            supervisor.stop()
+        self.assertGreaterEqual(supervisor.restarts, 4)
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        Device.objects.create(hardware_type='esp', device_id='AA:BB', description='')
+        BatchWriter().flush([esp_transmission(timestamp=1), esp_transmission(timestamp=2)])
+
+    def test_render(self):
+        registry = Registry()
+        registry.counter('messages_total', 'Messages.').inc(2, kind='esp')
+        histogram = registry.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1"} 2',
+            'latency_seconds_bucket{le="+Inf"} 3',
+            'latency_seconds_sum 5.55',
+            'latency_seconds_count 3',
+            '# HELP messages_total Messages.',
+            '# TYPE messages_total counter',
+            'messages_total{kind="esp"} 2',
+        ])
+
+    def test_ingest_and_resolvers_are_exposed(self):
+        self.assertGreaterEqual(ROWS_WRITTEN.value(model='ESPTransmission'), 2)
+        self.client.post(
+            '/graphql/',
+            {'query': '{ devices { deviceId transmissionCount } }'},
+            content_type='application/json'
+        )
+        metrics = self.client.get('/metrics').content.decode()
+        self.assertIn('greenhouse_graphql_resolve_seconds_count{field="Query.devices"}', metrics)
+        self.assertIn('greenhouse_graphql_loader_queries_count{loader="TransmissionCountLoader"}', metrics)
+        self.assertIn('greenhouse_ingest_rows_written_total{model="ESPTransmission"}', metrics)
+        self.assertNotIn('field="DeviceType.deviceId"', metrics)
+
+    def test_connections_are_not_left_wrapped(self):
+        for _ in range(2):
+            self.client.post('/graphql/', {'query': '{ devices { deviceId } }'}, content_type='application/json')
+        self.assertFalse(hasattr(connection, '_graphene_cursor'))
+        self.assertEqual(connection.execute_wrappers, [])
+
+    @override_settings(GRAPHQL_TIMING_EXTENSIONS=True)
+    def test_timing_extension(self):
+        query = {'query': '{ devices { deviceId transmissionCount } }'}
+        response = self.client.post('/graphql/', query, content_type='application/json')
+        self.assertNotIn('extensions', response.json())
+
+        response = self.client.post(
+            '/graphql/',
+            query,
+            content_type='application/json',
+            HTTP_X_GRAPHQL_TIMING='1'
+        ).json()
+        self.assertEqual(response['data'], {'devices': [{'deviceId': 'AA:BB', 'transmissionCount': 2}]})
+        resolvers = response['extensions']['timing']['resolvers']
+        devices = next(r for r in resolvers if r.get('field') == 'Query.devices')
+        self.assertEqual((devices['queries'], devices['rows']), (1, 1))
+        loader = next(r for r in resolvers if r.get('loader') == 'TransmissionCountLoader')
+        self.assertEqual((loader['queries'], loader['keys']), (1, 1))
+
+
+class PersistedQueryTestCase(TestCase):
+    query = '{ devices { deviceId } }'
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        Device.objects.create(hardware_type='esp', device_id='AA:BB', description='')
+
+    def post(self, query=None, sha256=None, **extra):
+        body = {}
+        if query:
+            body['query'] = query
+        if sha256:
+            body['extensions'] = {'persistedQuery': {'version': 1, 'sha256Hash': sha256}}
+        return self.client.post('/graphql/', body, content_type='application/json', **extra)
+
+    def test_persisted_query(self):
+        from greenhouse.graphql_cache import query_hash
+        sha256 = query_hash(self.query + ' ')
+
+        response = self.post(sha256=sha256).json()
+        self.assertEqual(response['errors'][0]['message'], 'PersistedQueryNotFound')
+
+        expected = {'data': {'devices': [{'deviceId': 'AA:BB'}]}}
+        self.assertEqual(self.post(self.query + ' ', sha256).json(), expected)
+        self.assertEqual(self.post(sha256=sha256).json(), expected)
+        self.assertEqual(self.post(self.query, sha256).status_code, 400)
+
+    def test_documents_are_parsed_and_validated_once(self):
+        from greenhouse.graphql_cache import backend
+        document = backend.document_from_string(schema, self.query)
+        self.assertIs(backend.document_from_string(schema, self.query), document)
+
+        invalid = backend.document_from_string(schema, '{ nope }')
+        self.assertTrue(invalid.execute().invalid)
+
+    @override_settings(GRAPHQL_RESULT_CACHE_TTL=60)
+    def test_result_cache_invalidation(self):
+        query = '{ devices { deviceId transmissionCount } }'
+        count = lambda: [d['transmissionCount'] for d in self.post(query).json()['data']['devices']]
+
+        BatchWriter().flush([esp_transmission(timestamp=1)])
+        self.assertEqual(count(), [1])
+        # rows written around the ingest path are not seen until invalidated
+        transmission = esp_transmission(timestamp=2, device=Device.objects.get(device_id='AA:BB'))
+        ESPTransmission.objects.create(**{
+            field.name: getattr(transmission, field.name)
+            for field in ESPTransmission._meta.concrete_fields if not field.primary_key
+        })
+        self.assertEqual(count(), [1])
+
+        BatchWriter().flush([esp_transmission(timestamp=3)])
+        self.assertEqual(count(), [3])
+        # the ingest registers unknown devices
+        BatchWriter().flush([esp_transmission(mac='CC:DD', timestamp=4)])
+        self.assertEqual(count(), [3, 1])
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        Device.objects.create(hardware_type='esp', device_id='AA:BB', description='')
+        Device.objects.create(hardware_type='hcsr04_device', device_id='7', description='')
+        bulk_insert(ESPTransmission, [
+            esp_transmission(timestamp=1, moisture=10.5),
+            esp_transmission(timestamp=2),
+            esp_transmission(mac='CC:DD', timestamp=3),
+        ])
+        SensorHCSR04.objects.create(
+            device=Device.objects.get(device_id='7'), timestamp_origin=5, timestamp_receive=6, distance=3.5
+        )
+
+    def export(self, **params):
+        response = self.client.get('/export/transmissions', params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv(self):
+        lines = self.export(device='AA:BB', end='2').splitlines()
+        self.assertEqual(lines, [
+            'timestamp_origin,timestamp_receive,mac_address,ldr_sensor,'
+            'temperature_sensor,pressure,moisture',
+            '1,2,AA:BB,1000.0,25.0,1013.0,10.5',
+        ])
+        # dates without a time zone are UTC, the end is excluded
+        self.assertEqual(self.export(device='AA:BB', end='1970-01-01T00:00:02').splitlines(), lines)
+
+    def test_ndjson(self):
+        import json
+        rows = [json.loads(line) for line in self.export(model='esp', start='2', format='ndjson').splitlines()]
+        self.assertEqual([row['mac_address'] for row in rows], ['AA:BB', 'CC:DD'])
+        rows = [json.loads(line) for line in self.export(device='7', format='ndjson').splitlines()]
+        self.assertEqual(rows, [{'mac': 7, 'timestamp_origin': 5, 'timestamp_receive': 6, 'distance': 3.5}])
+
+    @skipUnless(pyarrow, 'requires pyarrow')
+    def test_parquet(self):
+        import io
+        import pyarrow.parquet
+
+        def read(**params):
+            response = self.client.get('/export/transmissions', dict(params, format='parquet'))
+            return pyarrow.parquet.read_table(io.BytesIO(b''.join(response.streaming_content)))
+
+        self.assertEqual(read(model='esp').column('moisture').to_pylist(), [10.5, 40.0, 40.0])
+        empty = read(model='esp', start='10')
+        self.assertEqual(empty.num_rows, 0)
+        self.assertEqual(empty.schema, parquet_schema(ESPTransmission, export_columns(ESPTransmission)))
+
+        # a row group whose column is all None keeps the schema of the others
+        rows = [(7, 1, 2, None), (7, 2, 3, 4.5)]
+        schema = parquet_schema(SensorHCSR04, export_columns(SensorHCSR04))
+        data = b''.join(stream_parquet(schema, rows, chunk_size=1))
+        self.assertEqual(pyarrow.parquet.read_table(io.BytesIO(data)).column('distance').to_pylist(), [None, 4.5])
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.client.get('/export/transmissions').status_code, 400)
+        self.assertEqual(self.client.get('/export/transmissions', {'device': 'EE:FF'}).status_code, 404)
+        self.assertEqual(
+            self.client.get('/export/transmissions', {'model': 'esp', 'format': 'xml'}).status_code,
+            400
+        )
+        self.assertEqual(
+            self.client.get('/export/transmissions', {'model': 'esp', 'start': 'yesterday'}).status_code,
+            400
+        )
+
+    def test_memory_stays_flat(self):
+        import tracemalloc
+
+        def peak_memory(rows):
+            response = self.client.get('/export/transmissions', {'model': 'esp'})
+            tracemalloc.start()
+            try:
+                exported = sum(chunk.count(b'\n') for chunk in response.streaming_content)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(exported, rows + 1)
+            return peak
+
+        ESPTransmission.objects.all().delete()
+        bulk_insert(ESPTransmission, esp_readings(Device(device_id='AA:BB'), 1668000000, 10000))
+        small = peak_memory(10000)
+        bulk_insert(ESPTransmission, esp_readings(Device(device_id='CC:DD'), 1668000000, 90000))
+        large = peak_memory(100000)
+        # ten times the rows, about the same memory
+        self.assertLess(large, small * 1.5)
+
+
+class ImportTransmissionsTestCase(TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        bulk_insert(ESPTransmission, [esp_transmission(timestamp=60)])
+
+    def dump(self, name, content):
+        import gzip
+        import os
+        path = os.path.join(self.directory.name, name)
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(path, 'wt') as dump:
+            dump.write(content)
+        return path
+
+    def run_import(self, *paths, **options):
+        from io import StringIO
+        from django.core.management import call_command
+        out = StringIO()
+        call_command('import_transmissions', *paths, stdout=out, **options)
+        return out.getvalue()
+
+    def test_import_csv_skips_duplicates_and_invalid_rows(self):
+        path = self.dump('dump.csv', (
+            'timestamp_origin,mac_address,ldr_sensor,temperature_sensor,pressure,moisture\n'
+            '60,AA:BB,1.0,2.0,3.0,4.0\n'
+            '120,AA:BB,1.0,20.0,3.0,4.0\n'
+            '120,AA:BB,1.0,99.0,3.0,4.0\n'
+            '180,AA:BB,1.0,nan,3.0,4.0\n'
+            '240,CC:DD,1.0,22.0,3.0,4.0\n'
+        ))
+        output = self.run_import(path)
+        self.assertIn('2 imported, 2 duplicates, 1 invalid of 5 rows', output)
+
+        rows = ESPTransmission.objects.order_by('timestamp_origin').values_list(
+            'device__device_id', 'timestamp_origin', 'timestamp_receive', 'temperature_sensor'
+        )
+        self.assertEqual(list(rows), [
+            ('AA:BB', 60, 61, 25.0),
+            ('AA:BB', 120, 120, 20.0),
+            ('CC:DD', 240, 240, 22.0),
+        ])
+        rollup = ESPTransmissionRollup.objects.get(device__device_id='AA:BB', resolution=86400)
+        self.assertEqual(rollup.count, 2)
+
+    def test_import_gzipped_ndjson(self):
+        path = self.dump('dump.ndjson.gz', (
+            '{"mac": 7, "timestamp_origin": 10, "timestamp_receive": 11, "distance": 3.5}\n'
+            '{"mac": 7, "timestamp_origin": 20, "distance": 4.5}\n'
+        ))
+        self.assertIn('2 imported', self.run_import(path))
+        self.assertEqual(
+            list(SensorHCSR04.objects.order_by('timestamp_origin').values_list('timestamp_receive', 'distance')),
+            [(11, 3.5), (20, 4.5)]
+        )
+        # unknown devices are registered
+        self.assertEqual(
+            list(Device.objects.filter(device_id='7').values_list('hardware_type', 'auto_registered')),
+            [('hcsr04_device', True)]
+        )
+
+    def test_no_rollups_still_invalidates_caches(self):
+        from greenhouse.graphql_cache import history_generation
+        generation = history_generation('AA:BB')
+        path = self.dump('dump.csv', (
+            'timestamp_origin,mac_address,ldr_sensor,temperature_sensor,pressure,moisture\n'
+            '120,AA:BB,1.0,20.0,3.0,4.0\n'
+        ))
+        self.assertNotIn('Rebuilt rollups', self.run_import(path, no_rollups=True))
+        self.assertFalse(ESPTransmissionRollup.objects.exists())
+        self.assertEqual(history_generation('AA:BB'), generation + 1)
+
+    def test_export_round_trip(self):
+        BatchWriter().flush([esp_transmission(timestamp=i * 60) for i in range(2, 50)])
+        exported = b''.join(self.client.get(
+            '/export/transmissions',
+            {'device': 'AA:BB', 'format': 'ndjson'}
+        ).streaming_content).decode()
+        path = self.dump('export.ndjson', exported)
+        ESPTransmission.objects.filter(timestamp_origin__gte=600).delete()
+
+        self.assertIn('40 imported, 9 duplicates', self.run_import(path))
+        self.assertEqual(ESPTransmission.objects.count(), 49)
+
+
+class RetentionTestCase(TestCase):
+    # 2022-11-09T00:00:00Z, 40 days after the first readings
+    now = 1667952000
+
+    def setUp(self):
+        import tempfile
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(
+            TRANSMISSION_ARCHIVE_DIR=directory.name,
+            TRANSMISSION_RETENTION_DAYS={'esp': 10, 'hcsr04': 0, 'minute_rollups': 0}
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        Device.objects.create(hardware_type='esp', device_id='AA:BB', description='')
+        # one reading every 12 hours from 2022-09-30 to 2022-11-08
+        BatchWriter().flush([
+            esp_transmission(mac=mac, timestamp=self.now - 40 * 86400 + i * 43200, moisture=i)
+            for mac in ('AA:BB', 'CC:DD') for i in range(80)
+        ])
+
+    def prune(self, *args):
+        from io import StringIO
+        from unittest import mock
+        from django.core.management import call_command
+        out = StringIO()
+        with mock.patch('greenhouse.retention.time', return_value=self.now):
+            call_command('prune_transmissions', *args, stdout=out)
+        return out.getvalue()
+
+    def export(self, **params):
+        import json
+        response = self.client.get('/export/transmissions', dict(params, format='ndjson'))
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def test_prune_archives_by_device_and_month(self):
+        import os
+        from django.conf import settings
+        before = self.export(model='esp')
+
+        output = self.prune('--archive', 'ndjson', '--batch-size', '7')
+        self.assertIn('esp: deleted 120 transmissions older than 10 days of 2 devices', output)
+        self.assertEqual(ESPTransmission.objects.count(), 40)
+        device_dir = os.path.join(settings.TRANSMISSION_ARCHIVE_DIR, 'esptransmission', 'AA%3ABB')
+        self.assertEqual(sorted(os.listdir(device_dir)), ['2022-09', '2022-10'])
+
+        # a row archived but not deleted by an interrupted run is exported once
+        bulk_insert(ESPTransmission, [esp_transmission(timestamp=self.now - 40 * 86400)])
+        self.assertEqual(self.export(model='esp'), before)
+        self.assertEqual(
+            [row['moisture'] for row in self.export(device='AA:BB', start=self.now - 11 * 86400, end=self.now - 9 * 86400)],
+            [58.0, 59.0, 60.0, 61.0]
+        )
+        # both bounds within the archives
+        self.assertEqual(
+            [row['moisture'] for row in self.export(device='AA:BB', start=self.now - 11 * 86400, end=self.now - 10 * 86400 - 43200)],
+            [58.0]
+        )
+
+    def test_pruned_rows_read_from_chunks(self):
+        from unittest import mock
+        from greenhouse.columnar import compact_transmissions
+        from greenhouse.timeseries import bucket_aggregate, sensor_summary
+        rebuild_rollups(ESPTransmission)
+        device = Device.objects.get(device_id='AA:BB')
+        # the last reading is in a raw edge finer than a minute
+        start, end = self.now - 40 * 86400 - 30, self.now - 20 * 86400 + 30
+
+        def read():
+            with mock.patch('greenhouse.retention.time', return_value=self.now):
+                return (
+                    sensor_summary(ESPTransmission, device, 'moisture', start, end),
+                    # not a multiple of a minute, only raw rows
+                    bucket_aggregate(ESPTransmission, device, start, end, 86401),
+                    self.export(model='esp'),
+                )
+
+        before = read()
+        self.assertEqual(before[0]['count'], 41)
+        compact_transmissions(ESPTransmission, until=self.now)
+        self.prune()
+        self.assertEqual(ESPTransmission.objects.count(), 40)
+        self.assertEqual(read(), before)
+
+    def test_prune_never_overwrites_archives(self):
+        import os
+        from django.conf import settings
+        self.prune('--archive', 'ndjson', '--model', 'esp')
+        before = self.export(model='esp')
+        month_dir = os.path.join(settings.TRANSMISSION_ARCHIVE_DIR, 'esptransmission', 'AA%3ABB', '2022-09')
+        self.assertEqual(len(os.listdir(month_dir)), 1)
+
+        # the first row of the month imported back and pruned again
+        bulk_insert(ESPTransmission, [esp_transmission(timestamp=self.now - 40 * 86400)])
+        self.prune('--archive', 'ndjson', '--model', 'esp')
+        files = sorted(os.listdir(month_dir))
+        self.assertEqual(len(files), 2)
+        self.assertEqual(files[0].split('-')[0], files[1].split('-')[0])
+        self.assertEqual(self.export(model='esp'), before)
+
+    def test_prune_keeps_old_rollups(self):
+        self.prune()
+        days = ESPTransmissionRollup.objects.filter(device__device_id='AA:BB', resolution=86400)
+        self.assertEqual(days.count(), 40)
+        rebuild_rollups(ESPTransmission)
+        self.assertEqual(days.count(), 40)
+        self.assertEqual(sum(days.values_list('count', flat=True)), 80)
+
+    def test_rebuild_keeps_pruned_days(self):
+        self.prune()
+        days = ESPTransmissionRollup.objects.filter(device__device_id='AA:BB', resolution=86400)
+        # one row of a pruned day imported back, one of a new day
+        bulk_insert(ESPTransmission, [
+            esp_transmission(timestamp=self.now - 30 * 86400, moisture=20),
+            esp_transmission(timestamp=self.now - 50 * 86400, moisture=1),
+        ])
+        self.assertEqual(rebuild_rollups(ESPTransmission, device=Device.objects.get(device_id='AA:BB')), 21)
+        self.assertEqual(days.count(), 41)
+        self.assertEqual(days.get(bucket_start=self.now - 30 * 86400).count, 2)
+        self.assertEqual(sum(days.values_list('count', flat=True)), 81)
+
+        # unless asked to
+        rebuild_rollups(ESPTransmission, device=Device.objects.get(device_id='AA:BB'), all_days=True)
+        self.assertEqual(days.get(bucket_start=self.now - 30 * 86400).count, 1)
+        self.assertEqual(days.get(bucket_start=self.now - 20 * 86400).count, 2)
+
+    def test_prune_minute_rollups(self):
+        with override_settings(TRANSMISSION_RETENTION_DAYS={'esp': 0, 'hcsr04': 0, 'minute_rollups': 10}):
+            output = self.prune('--model', 'esp')
+        self.assertIn('esp: raw transmissions are kept forever', output)
+        self.assertIn('esp: deleted 120 1 minute rollups', output)
+        self.assertEqual(ESPTransmission.objects.count(), 160)
+        self.assertEqual(ESPTransmissionRollup.objects.filter(resolution=60).count(), 40)
+        self.assertEqual(ESPTransmissionRollup.objects.filter(resolution=3600).count(), 160)
+
+
+class ReplicaRoutingTestCase(TestCase):
+    def setUp(self):
+        Device.objects.create(hardware_type='esp', device_id='AA:BB', description='')
+
+    def reads(self, request):
+        """
+        Run `request` and return the (model, alias) of the greenhouse reads
+        it routed, while actually reading from the default database.
+        """
+        from unittest import mock
+        from greenhouse.routers import ReplicaRouter
+        reads = []
+        route = ReplicaRouter.db_for_read
+
+        def db_for_read(router, model, **hints):
+            reads.append((model.__name__, route(router, model, **hints) or 'default'))
+            return None
+
+        with override_settings(REPLICA_DATABASE='replica'), \
+                mock.patch.object(ReplicaRouter, 'db_for_read', db_for_read):
+            response = request()
+        self.assertEqual(response.status_code, 200)
+        return reads
+
+    def post(self, query):
+        return lambda: self.client.post('/graphql/', {'query': query}, content_type='application/json')
+
+    def test_queries_read_from_replica(self):
+        reads = self.reads(self.post('{ devices { deviceId transmissionCount } }'))
+        self.assertIn(('Device', 'replica'), reads)
+        self.assertEqual({alias for _, alias in reads}, {'replica'})
+
+    def test_mutations_read_their_writes(self):
+        reads = self.reads(self.post("""mutation {
+            createInstallation(input: {reference: "r", deviceId: "AA:BB", latitude: 1, longitude: 2}) {
+                installation { device { deviceId } }
+            }
+        }"""))
+        self.assertTrue(reads)
+        self.assertEqual({alias for _, alias in reads}, {'default'})
+        self.assertEqual(Installation.objects.count(), 1)
+
+    def test_ingest_and_commands_use_primary(self):
+        from greenhouse.routers import ReplicaRouter
+        with override_settings(REPLICA_DATABASE='replica'):
+            self.assertIsNone(ReplicaRouter().db_for_read(ESPTransmission))
+            self.assertEqual(ReplicaRouter().db_for_write(ESPTransmission), 'default')
+            self.assertFalse(ReplicaRouter().allow_migrate('replica', 'greenhouse'))
+
+
+class HotWindowTestCase(TestCase):
+    def setUp(self):
+        from greenhouse import hotwindow
+        self.hotwindow = hotwindow
+        self.now = int(time.time()) + 60
+        hotwindow.reset()
+        settings = override_settings(HOT_WINDOW={'SIZE': 3, 'SHARED_MEMORY': '', 'DEVICES': 8})
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(hotwindow.reset)
+
+    def last_from_database(self, keys):
+        from greenhouse.loaders import LastTransmissionLoader
+        with override_settings(HOT_WINDOW={'SIZE': 0, 'SHARED_MEMORY': '', 'DEVICES': 8}):
+            return LastTransmissionLoader().load_batch(keys)
+
+    def test_last_transmission_from_memory(self):
+        from greenhouse.loaders import LastTransmissionLoader
+        for hardware_type, device_id in (('esp', 'AA:BB'), ('hcsr04_device', '7'), ('esp', 'CC:DD')):
+            Device.objects.create(hardware_type=hardware_type, device_id=device_id, description='')
+        BatchWriter().flush([
+            esp_transmission(timestamp=self.now, temperature_sensor=25.3),
+            esp_transmission(timestamp=self.now + 1, temperature_sensor=25.4),
+            SensorHCSR04(device=Device(device_id='7'), timestamp_origin=self.now, timestamp_receive=self.now, distance=1.1),
+        ])
+        keys = [('esp', 'AA:BB'), ('hcsr04_device', '7'), ('esp', 'CC:DD')]
+        expected = self.last_from_database(keys)
+        self.assertEqual(expected[0]['temperature_sensor'], 25.4)
+        with self.assertNumQueries(1):
+            # only the unknown device reaches the database
+            self.assertEqual(LastTransmissionLoader().load_batch(keys), expected)
+
+    def test_recent_rows_within_coverage(self):
+        BatchWriter().flush([esp_transmission(timestamp=self.now + i) for i in range(5)])
+        rows = self.hotwindow.recent_rows(ESPTransmission, 'AA:BB', self.now + 2)
+        self.assertEqual([row['timestamp_origin'] for row in rows], [self.now + 2, self.now + 3, self.now + 4])
+        self.assertEqual(rows, list(with_device_column(ESPTransmission, ESPTransmission.objects.filter(
+            timestamp_origin__gte=self.now + 2
+        )).order_by('timestamp_origin').values('id', *row_fields(ESPTransmission))))
+        # evicted or older than the window
+        self.assertIsNone(self.hotwindow.recent_rows(ESPTransmission, 'AA:BB', self.now + 1))
+        self.assertIsNone(self.hotwindow.recent_rows(ESPTransmission, 'AA:BB', self.now - 3600))
+        self.assertIsNone(self.hotwindow.recent_rows(ESPTransmission, 'CC:DD', self.now))
+
+    def test_recent_transmissions_query(self):
+        Device.objects.create(hardware_type='esp', device_id='AA:BB', description='')
+        BatchWriter().flush([esp_transmission(timestamp=self.now + i) for i in range(3)])
+        query = """query ($after: String) {
+            devices { transmissions(first: 2, after: $after, timestampOrigin_Gte: %d) {
+                edges { cursor node }
+                pageInfo { hasNextPage endCursor }
+            } }
+        }""" % self.now
+
+        def pages():
+            after, edges = None, []
+            while True:
+                result = schema.execute(query, variables={'after': after})
+                self.assertIsNone(result.errors)
+                connection = result.data['devices'][0]['transmissions']
+                edges += connection['edges']
+                if not connection['pageInfo']['hasNextPage']:
+                    return edges
+                after = connection['pageInfo']['endCursor']
+
+        with self.assertNumQueries(2):
+            from_memory = pages()
+        with override_settings(HOT_WINDOW={'SIZE': 0, 'SHARED_MEMORY': '', 'DEVICES': 8}):
+            self.assertEqual(pages(), from_memory)
+        self.assertEqual(len(from_memory), 3)
+
+    def test_shared_memory(self):
+        name = f'greenhouse-test-{os.getpid()}'
+        with override_settings(HOT_WINDOW={'SIZE': 3, 'SHARED_MEMORY': name, 'DEVICES': 8}):
+            self.hotwindow.create_shared(0, 1)
+            BatchWriter().flush([esp_transmission(timestamp=self.now + i) for i in range(2)])
+            # a web server process only attaches the segments
+            writer = self.hotwindow._local.pop(ESPTransmission)
+            latest = self.hotwindow.last_rows(ESPTransmission, ['AA:BB'])
+            self.assertEqual(latest['AA:BB']['timestamp_origin'], self.now + 1)
+            self.assertEqual(latest['AA:BB']['id'], ESPTransmission.objects.latest('timestamp_origin').id)
+            self.hotwindow._local[ESPTransmission] = writer
+            self.hotwindow.reset()
+
+            # the segments of a missing worker leave its devices uncovered
+            self.hotwindow.create_shared(0, 2)
+            BatchWriter().flush([esp_transmission(timestamp=self.now + 2)])
+            self.hotwindow._attached.clear()
+            writer = self.hotwindow._local.pop(ESPTransmission)
+            self.assertEqual(self.hotwindow.last_rows(ESPTransmission, ['AA:BB']), {})
+            self.hotwindow._local[ESPTransmission] = writer
+
+
+class ColumnarTestCase(TestCase):
+    def setUp(self):
+        self.day = 1668038400
+        bulk_insert(ESPTransmission, esp_readings(Device(device_id='AA:BB'), self.day - 3600, 150, step=1200))
+
+    def test_chunk_round_trip(self):
+        import numpy as np
+        from greenhouse.columnar import columns, decode_chunk, encode_chunk
+        values = {
+            'id': np.array([7, 3, 2 ** 40, 8]),
+            'timestamp_origin': np.array([0, 59, 60, 1668038400]),
+            'timestamp_receive': np.array([1, 50, 61, 1668038402]),
+            'ldr_sensor': np.array([0.0, -0.0, 1e308, -3.5]),
+            'temperature_sensor': np.array([25.3, float('inf'), float('nan'), 25.3]),
+            'pressure': np.array([1013.25] * 4),
+            'moisture': np.array([1e-300, 40.0, 40.0, 41.0]),
+        }
+        decoded = decode_chunk(ESPTransmission, encode_chunk(ESPTransmission, values))
+        for name, _ in columns(ESPTransmission):
+            np.testing.assert_array_equal(decoded[name], values[name])
+        self.assertEqual(np.signbit(decoded['ldr_sensor'][1]), True)
+
+        with self.assertRaises(ValueError):
+            decode_chunk(SensorHCSR04, encode_chunk(ESPTransmission, values))
+
+    def test_read_compacted_days(self):
+        from greenhouse.columnar import compact_transmissions, read_columns
+        from greenhouse.models import ESPTransmissionChunk
+        end = self.day + 86400
+        self.assertEqual(compact_transmissions(ESPTransmission, until=end), (2, 75))
+        self.assertEqual(compact_transmissions(ESPTransmission, until=end), (0, 0))
+        self.assertEqual(ESPTransmissionChunk.objects.count(), 2)
+
+        expected = list(ESPTransmission.objects.filter(
+            timestamp_origin__gte=self.day - 1800,
+            timestamp_origin__lt=end + 7200
+        ).order_by('timestamp_origin').values_list('id', 'timestamp_origin', 'moisture'))
+        # compacted rows survive their deletion
+        ESPTransmission.objects.filter(timestamp_origin__lt=end).delete()
+
+        device = Device.objects.get(device_id='AA:BB')
+        values = read_columns(ESPTransmission, device, self.day - 1800, end + 7200)
+        self.assertEqual(
+            list(zip(values['id'].tolist(), values['timestamp_origin'].tolist(), values['moisture'].tolist())),
+            expected
+        )
+        self.assertEqual(len(read_columns(ESPTransmission, device)['id']), 150)
+        self.assertEqual(list(read_columns(ESPTransmission, device, names=['pressure'])), ['timestamp_origin', 'pressure'])
+
+        # a backfilled day is merged into its chunk
+        ESPTransmission.objects.create(
+            timestamp_origin=self.day + 10, timestamp_receive=self.day + 10,
+            device=device,
+            ldr_sensor=1, temperature_sensor=2, pressure=3, moisture=4
+        )
+        day_rows = ESPTransmissionChunk.objects.get(day_start=self.day).count
+        self.assertEqual(compact_transmissions(ESPTransmission, until=end), (1, 1))
+        self.assertEqual(compact_transmissions(ESPTransmission, until=end), (0, 0))
+        self.assertEqual(ESPTransmissionChunk.objects.get(day_start=self.day).count, day_rows + 1)
+        values = read_columns(ESPTransmission, device, self.day, end, ['moisture'])
+        self.assertEqual(len(values['timestamp_origin']), day_rows + 1)
+        self.assertIn(4.0, values['moisture'].tolist())
+
+        # unless the chunk is replaced
+        self.assertEqual(compact_transmissions(ESPTransmission, until=end, replace=True), (1, 1))
+        self.assertEqual(ESPTransmissionChunk.objects.get(day_start=self.day).count, 1)
+
+    def test_column_summary(self):
+        from greenhouse.columnar import column_summary, compact_transmissions
+        from greenhouse.timeseries import sensor_summary
+        compact_transmissions(ESPTransmission, until=self.day + 86400)
+        rebuild_rollups(ESPTransmission)
+        device = Device.objects.get(device_id='AA:BB')
+        expected = sensor_summary(ESPTransmission, device, 'pressure', self.day - 100, self.day + 100000)
+        summary = column_summary(ESPTransmission, device, 'pressure', self.day - 100, self.day + 100000)
+        self.assertEqual(summary['count'], expected['count'])
+        for key in ('mean', 'std', 'min', 'max'):
+            self.assertAlmostEqual(summary[key], expected[key], places=6)
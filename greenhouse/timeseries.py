@@ -0,0 +1,388 @@
+import math
+from sqlite3 import sqlite_version_info
+from django.db import connections, router
+from django.db.models import (CharField, Count, ExpressionWrapper, F, IntegerField, Max, Min, Q,
+                              Sum)
+from django.db.models.functions import Cast
+from greenhouse.models import (ESPTransmission, ESPTransmissionRollup,
+                               SensorHCSR04, SensorHCSR04Rollup,
+                               TransmissionRollup)
+
+
+SENSOR_FIELDS = {
+    ESPTransmission: ('ldr_sensor', 'temperature_sensor', 'pressure', 'moisture'),
+    SensorHCSR04: ('distance',),
+}
+
+# name and type of the column holding Device.device_id in the rows of
+# transmissions exported, archived, published or returned by the API
+DEVICE_COLUMNS = {
+    ESPTransmission: ('mac_address', CharField()),
+    SensorHCSR04: ('mac', IntegerField()),
+}
+
+# hardware_type of the devices registered by the ingest
+HARDWARE_TYPES = {
+    ESPTransmission: 'esp',
+    SensorHCSR04: 'hcsr04_device',
+}
+
+ROLLUP_MODELS = {
+    ESPTransmission: ESPTransmissionRollup,
+    SensorHCSR04: SensorHCSR04Rollup,
+}
+
+
+def row_fields(model):
+    """
+    The columns of the values of a transmission: its concrete fields but
+    the primary key, the device being named by its DEVICE_COLUMNS entry.
+    """
+    return [
+        DEVICE_COLUMNS[model][0] if field.is_relation else field.attname
+        for field in model._meta.concrete_fields
+        if not field.primary_key
+    ]
+
+
+def with_device_column(model, transmissions):
+    """
+    Annotate a queryset of `model` with its device column, read from
+    Device.device_id, so `.values(*row_fields(model))` can select it.
+    """
+    name, field = DEVICE_COLUMNS[model]
+    return transmissions.annotate(**{name: Cast('device__device_id', field)})
+
+
+def row_values(model, instance):
+    """
+    The values of `row_fields` of a transmission instance whose device is
+    loaded, as the ingest sets them.
+    """
+    device_field = DEVICE_COLUMNS[model][1]
+    return [
+        device_field.to_python(instance.device.device_id) if field.is_relation else getattr(instance, field.attname)
+        for field in model._meta.concrete_fields
+        if not field.primary_key
+    ]
+
+
+def transmission_model(hardware_type):
+    """
+    Return the model that stores transmissions of a given hardware type.
+    """
+    if hardware_type == 'hcsr04_device':
+        return SensorHCSR04
+    return ESPTransmission
+
+
+def device_transmissions(model, device, start=None, end=None):
+    """
+    Transmissions of a device, a Device or its primary key, with
+    timestamp_origin in [start, end).
+    """
+    filters = {'device': device}
+    if start is not None:
+        filters['timestamp_origin__gte'] = start
+    if end is not None:
+        filters['timestamp_origin__lt'] = end
+    return model.objects.filter(**filters)
+
+
+def transmission_key(instance):
+    """
+    The (model, device, timestamp_origin) identifying a transmission.
+    """
+    model = type(instance)
+    return model, instance.device.device_id, instance.timestamp_origin
+
+
+def _returns_rows(connection):
+    # RETURNING came with SQLite 3.35
+    if connection.vendor == 'sqlite':
+        return sqlite_version_info >= (3, 35)
+    return connection.vendor == 'postgresql'
+
+
+def insert_transmissions(model, instances, batch_size=500):
+    """
+    Insert unsaved `instances` of `model`, skipping those whose (device,
+    timestamp_origin) is already stored, and return the ones actually
+    inserted with their primary key set.
+
+    Rows are inserted with ON CONFLICT DO NOTHING (SQLite 3.24) and the
+    inserted ones are told apart by RETURNING, so rows a concurrent writer
+    stores meanwhile are not taken for ours. SQLite before 3.35 inserts
+    row by row and checks the row count instead. Being a write, the insert also takes the SQLite
+    write lock when it opens a transaction, waiting for other writers
+    with busy_timeout instead of failing to upgrade a read.
+    """
+    if not instances:
+        return []
+    connection = connections[router.db_for_write(model)]
+    quote = connection.ops.quote_name
+    fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+    key_fields = [model._meta.get_field('device'), model._meta.get_field('timestamp_origin')]
+    insert = (
+        f'INSERT INTO {quote(model._meta.db_table)} '
+        f'({", ".join(quote(field.column) for field in fields)}) VALUES '
+    )
+    row_sql = '(' + ', '.join(['%s'] * len(fields)) + ')'
+    # unlike INSERT OR IGNORE, only skips rows breaking a unique constraint
+    suffix = 'ON CONFLICT DO NOTHING'
+
+    rows = {}
+    for instance in instances:
+        values = [field.get_db_prep_save(getattr(instance, field.attname), connection) for field in fields]
+        key = tuple(field.get_db_prep_save(getattr(instance, field.attname), connection) for field in key_fields)
+        rows[key] = (instance, values)
+
+    inserted = []
+    with connection.cursor() as cursor:
+        if not _returns_rows(connection):
+            for instance, values in rows.values():
+                cursor.execute(f'{insert}{row_sql} {suffix}', values)
+                if cursor.rowcount == 1:
+                    instance.pk = cursor.lastrowid
+                    inserted.append(instance)
+            return inserted
+
+        returning = ', '.join(quote(field.column) for field in [model._meta.pk] + key_fields)
+        pending = list(rows.values())
+        batch_size = min(batch_size, connection.ops.bulk_batch_size(fields, pending))
+        for i in range(0, len(pending), batch_size):
+            batch = pending[i:i + batch_size]
+            cursor.execute(
+                f'{insert}{", ".join([row_sql] * len(batch))} {suffix} RETURNING {returning}',
+                [value for _, values in batch for value in values]
+            )
+            for pk, *key in cursor.fetchall():
+                instance = rows[tuple(key)][0]
+                instance.pk = pk
+                inserted.append(instance)
+    return inserted
+
+
+def split_range(start, end, bucket=None):
+    """
+    Split [start, end) into the ranges read from rollups and the ranges
+    read from raw rows: the aligned interior comes from the coarsest
+    rollup, the partial edges from finer ones and the edges finer than a
+    minute from raw rows. Only resolutions dividing `bucket`, if given,
+    are used. Returns ([(resolution, start, end)], [(start, end)]).
+    """
+    rollups = []
+    pending = [(start, end)]
+    for resolution in sorted(TransmissionRollup.RESOLUTIONS, reverse=True):
+        if bucket is not None and bucket % resolution:
+            continue
+        remaining = []
+        for range_start, range_end in pending:
+            first = -(-range_start // resolution) * resolution
+            last = range_end - range_end % resolution
+            if first >= last:
+                remaining.append((range_start, range_end))
+                continue
+            rollups.append((resolution, first, last))
+            remaining += [edge for edge in ((range_start, first), (last, range_end)) if edge[0] < edge[1]]
+        pending = remaining
+    return rollups, pending
+
+
+def _rollup_ranges(model, device, ranges):
+    # the device is repeated in every term so each one seeks the unique
+    # (device, resolution, bucket_start) index instead of scanning the
+    # rollups of the device
+    condition = Q()
+    for resolution, start, end in ranges:
+        condition |= Q(**{
+            'device': device,
+            'resolution': resolution,
+            'bucket_start__gte': start,
+            'bucket_start__lt': end,
+        })
+    return ROLLUP_MODELS[model].objects.filter(condition)
+
+
+def _raw_ranges(model, device, ranges):
+    condition = Q()
+    for start, end in ranges:
+        condition |= Q(**{
+            'device': device,
+            'timestamp_origin__gte': start,
+            'timestamp_origin__lt': end,
+        })
+    return model.objects.filter(condition)
+
+
+def _pruned_ranges(model, ranges):
+    """
+    Split raw `ranges` at the retention cutoff of `model`: the ranges
+    before it, whose rows may have been pruned and are read from the
+    columnar chunks, and the ranges read from the row table.
+    """
+    from greenhouse.retention import raw_cutoff
+
+    cutoff = raw_cutoff(model)
+    if cutoff is None:
+        return [], ranges
+    pruned = [(start, min(end, cutoff)) for start, end in ranges if start < cutoff]
+    rows = [(max(start, cutoff), end) for start, end in ranges if end > cutoff]
+    return pruned, rows
+
+
+def _raw_buckets(model, device, ranges, bucket):
+    fields = SENSOR_FIELDS[model]
+    transmissions = _raw_ranges(model, device, ranges)
+    aggregates = {
+        'count': Count('id'),
+        'last_timestamp': Max('timestamp_origin'),
+    }
+    for field in fields:
+        aggregates[f'{field}__sum'] = Sum(field)
+        aggregates[f'{field}__min'] = Min(field)
+        aggregates[f'{field}__max'] = Max(field)
+    rows = list(transmissions.annotate(
+        bucket=ExpressionWrapper(F('timestamp_origin') / bucket, output_field=IntegerField())
+    ).values('bucket').annotate(**aggregates).order_by('bucket'))
+
+    # one extra indexed lookup fetches the latest row of every bucket
+    latest = transmissions.filter(
+        timestamp_origin__in=[row['last_timestamp'] for row in rows]
+    ).order_by('timestamp_origin', 'id').values_list('timestamp_origin', *fields)
+    last_rows = {row[0]: row[1:] for row in latest}
+    for row in rows:
+        row['last'] = last_rows.get(row['last_timestamp'], (None,) * len(fields))
+    return rows
+
+
+def _rollup_buckets(model, device, ranges, bucket):
+    fields = SENSOR_FIELDS[model]
+    rollups = _rollup_ranges(model, device, ranges)
+    aggregates = {
+        'count': Sum('count'),
+        'last_timestamp': Max('last_timestamp'),
+    }
+    for field in fields:
+        aggregates[f'{field}__sum'] = Sum(f'{field}_sum')
+        aggregates[f'{field}__min'] = Min(f'{field}_min')
+        aggregates[f'{field}__max'] = Max(f'{field}_max')
+    rows = list(rollups.annotate(
+        bucket=ExpressionWrapper(F('bucket_start') / bucket, output_field=IntegerField())
+    ).values('bucket').annotate(**aggregates).order_by('bucket'))
+
+    # the ranges do not overlap, a last timestamp is in a single rollup
+    latest = rollups.filter(
+        last_timestamp__in=[row['last_timestamp'] for row in rows]
+    ).values_list('last_timestamp', *(f'{field}_last' for field in fields))
+    last_rows = {row[0]: row[1:] for row in latest}
+    for row in rows:
+        row['last'] = last_rows.get(row['last_timestamp'], (None,) * len(fields))
+    return rows
+
+
+def bucket_aggregate(model, device, start, end, bucket):
+    """
+    Aggregate a device transmissions into `bucket` seconds wide buckets
+    computed by the database, grouping on timestamp_origin / bucket.
+    Reads the rollups covering the range (see `split_range`) and raw rows
+    for the rest, merging both within the buckets they share. Raw rows
+    older than the retention cutoff are read from the columnar chunks.
+
+    Returns a list of dicts ordered by time with the keys `bucket_start`,
+    `count` and, for every sensor field, a dict with min, max, avg and
+    last (the value of the latest transmission within the bucket).
+    """
+    fields = SENSOR_FIELDS[model]
+    rollup_ranges, raw_ranges = split_range(start, end, bucket)
+    rows = []
+    if rollup_ranges:
+        rows += _rollup_buckets(model, device, rollup_ranges, bucket)
+    pruned_ranges, raw_ranges = _pruned_ranges(model, raw_ranges)
+    if pruned_ranges:
+        from greenhouse.columnar import column_buckets
+        rows += column_buckets(model, device, pruned_ranges, bucket)
+    if raw_ranges:
+        rows += _raw_buckets(model, device, raw_ranges, bucket)
+
+    merged = {}
+    for row in rows:
+        current = merged.get(row['bucket'])
+        if current is None:
+            merged[row['bucket']] = row
+            continue
+        if row['last_timestamp'] > current['last_timestamp']:
+            current['last_timestamp'] = row['last_timestamp']
+            current['last'] = row['last']
+        current['count'] += row['count']
+        for field in fields:
+            current[f'{field}__sum'] += row[f'{field}__sum']
+            current[f'{field}__min'] = min(current[f'{field}__min'], row[f'{field}__min'])
+            current[f'{field}__max'] = max(current[f'{field}__max'], row[f'{field}__max'])
+
+    buckets = []
+    for key in sorted(merged):
+        row = merged[key]
+        data = {
+            'bucket_start': key * bucket,
+            'count': row['count'],
+        }
+        for field, last in zip(fields, row['last']):
+            data[field] = {
+                'min': row[f'{field}__min'],
+                'max': row[f'{field}__max'],
+                'avg': row[f'{field}__sum'] / row['count'],
+                'last': last,
+            }
+        buckets.append(data)
+
+    return buckets
+
+
+def sensor_summary(model, device, field, start, end):
+    """
+    Count, mean, population standard deviation, min and max of a sensor
+    field over [start, end). The rollups covering the range (see
+    `split_range`) are merged with the raw rows of its edges finer than a
+    minute, so the cost does not depend on the number of raw rows. Raw
+    rows older than the retention cutoff are read from the columnar
+    chunks.
+    """
+    rollup_ranges, raw_ranges = split_range(start, end)
+    summaries = []
+    if rollup_ranges:
+        summaries.append(_rollup_ranges(model, device, rollup_ranges).aggregate(
+            count=Sum('count'),
+            total=Sum(f'{field}_sum'),
+            total_sq=Sum(f'{field}_sum_sq'),
+            minimum=Min(f'{field}_min'),
+            maximum=Max(f'{field}_max'),
+        ))
+    pruned_ranges, raw_ranges = _pruned_ranges(model, raw_ranges)
+    if pruned_ranges:
+        from greenhouse.columnar import column_totals
+        summaries.append(column_totals(model, device, field, pruned_ranges))
+    if raw_ranges:
+        summaries.append(_raw_ranges(model, device, raw_ranges).aggregate(
+            count=Count('id'),
+            total=Sum(field),
+            total_sq=Sum(F(field) * F(field)),
+            minimum=Min(field),
+            maximum=Max(field),
+        ))
+    summaries = [summary for summary in summaries if summary['count']]
+
+    count = sum(summary['count'] for summary in summaries)
+    if not count:
+        return {'count': 0, 'mean': None, 'std': None, 'min': None, 'max': None}
+
+    mean = sum(summary['total'] for summary in summaries) / count
+    total_sq = sum(summary['total_sq'] for summary in summaries)
+    variance = max(0.0, total_sq / count - mean * mean)
+    return {
+        'count': count,
+        'mean': mean,
+        'std': math.sqrt(variance),
+        'min': min(summary['minimum'] for summary in summaries),
+        'max': max(summary['maximum'] for summary in summaries),
+    }
@@ -1,64 +1,157 @@
 from ast import literal_eval
 from datetime import datetime
 from time import sleep
+from zlib import crc32
 import paho.mqtt.client as mqttClient
+from greenhouse import hotwindow
+from greenhouse.decoders import ESP, HCSR04, DecodeError, route
+from greenhouse.ingest import ROWS_FAILED, BatchWriter
+from greenhouse.metrics import registry
 from greenhouse.models import ESPTransmission, SensorHCSR04
 from django.conf import settings
+from django.db import DatabaseError, connection
 
 
 CONFIG = settings.MQTT_CONFIG
+INGEST_CONFIG = settings.INGEST_CONFIG
+MESSAGES = registry.counter(
+    'greenhouse_ingest_messages_total',
+    'Transmissions received from MQTT and decoded.'
+)
+PARSE_FAILURES = registry.counter(
+    'greenhouse_ingest_parse_failures_total',
+    'MQTT messages that could not be decoded.'
+)
+
 mqtt_connected = False
+writer = None
+# (index, count) when this process only handles a hash partition of devices
+partition = None
+shared_group = None
+
+
+def start_writer(batch_size=None, flush_interval=None, queue_size=None,
+                 overflow=None, recent_keys=None):
+    """
+    Start the background writer that persists parsed transmissions.
+    Missing options fall back to settings.INGEST_CONFIG.
+    """
+    global writer
+    if writer is not None:
+        writer.stop()
+
+    writer = BatchWriter(
+        batch_size=batch_size or INGEST_CONFIG['BATCH_SIZE'],
+        flush_interval=flush_interval or INGEST_CONFIG['FLUSH_INTERVAL'],
+        queue_size=queue_size or INGEST_CONFIG['QUEUE_SIZE'],
+        overflow=overflow or INGEST_CONFIG['OVERFLOW'],
+        recent_keys=INGEST_CONFIG['RECENT_KEYS'] if recent_keys is None else recent_keys,
+        on_written=publish_icon_updates,
+    )
+    writer.start()
+    return writer
+
+
+def publish_icon_updates(model, instances):
+    """
+    Tell the map about the ESP transmissions written by a flush, in the
+    list format they were received in.
+    """
+    if model is not ESPTransmission:
+        return
+    for instance in instances:
+        mqtt_client.publish('map/icon_update', str([
+            instance.device.device_id,
+            instance.timestamp_origin,
+            instance.ldr_sensor,
+            instance.temperature_sensor,
+            instance.pressure,
+            instance.moisture,
+        ]))
+
+
+def owns(device_id, index, count):
+    """
+    Tell if the worker `index` out of `count` handles `device_id`. The hash
+    is stable across processes, so every device always lands on the same
+    worker and its transmissions stay in order.
+    """
+    return crc32(str(device_id).encode('utf-8')) % count == index
+
+
+def subscription_topics(topics, group=None):
+    """
+    Prefix topics with `$share/<group>/` so that the broker delivers each
+    message to only one of the clients subscribed with the same group.
+    """
+    if not group:
+        return topics
+    if isinstance(topics, str):
+        return f'$share/{group}/{topics}'
+    return [(f'$share/{group}/{name}', qos) for name, qos in topics]
 
 
-def on_connect(client, userdata, flags, rc):
+def on_connect(client, userdata, flags, rc, properties=None):
     if rc == 0:
         print("Connected to broker")
         global mqtt_connected
         mqtt_connected = True
-        mqtt_client.subscribe(topic)
+        client.subscribe(subscription_topics(topic, shared_group))
     else:
         print("Connection failed")
 
 
 def on_message(client, userdata, message):
-    message_origin = message.topic
-    print('********')
-    print(message_origin)
-    message = str(message.payload.decode("utf-8"))
-    print("message received " , message)
-    data = literal_eval(message)
+    routed = route(message.topic)
+    if routed is None:
+        return
+    if writer is None:
+        start_writer()
+
+    kind, decode = routed
+    try:
+        data = decode(message.payload)
+    except DecodeError as e:
+        PARSE_FAILURES.inc(kind=kind)
+        print(f'Failed parsing message from {message.topic}: {str(e)}')
+        return
+
+    if partition is not None and not owns(data[0], *partition):
+        return
+    MESSAGES.inc(kind=kind)
+
+    model = ESPTransmission if kind == ESP else SensorHCSR04
+    try:
+        # cached, only the first message of a new device hits the database
+        device = writer.devices.get(model, data[0])
+    except DatabaseError as e:
+        ROWS_FAILED.inc()
+        # reconnect after a lost connection
+        connection.close_if_unusable_or_obsolete()
+        print(f'Failed registering device {data[0]} with error: {str(e)}')
+        return
+
     tstp_receive = datetime.now().timestamp()
-    if message_origin == settings.LDR_DEVICE:
-        device_id, tstp_origin, ldr, temp, pressure, moisture = data
-        try:
-            tx = ESPTransmission.objects.create(
-                timestamp_origin=tstp_origin,
-                timestamp_receive=tstp_receive,
-                mac_address=device_id,
-                ldr_sensor=ldr,
-                temperature_sensor=temp,
-                pressure=pressure,
-                moisture=moisture
-            )
-            tx.save()
-            client.publish('map/icon_update', str(list(data)))
-            print('Published ', data)
-
-        except Exception as e:
-            print(f'Failed saving transmission with error: {str(e)}')
-    elif message_origin == settings.HCSR_DEVICE:
-        tstp_receive = datetime.now().timestamp()
-        device_id, tstp_origin, distance = data
-        try:
-            tx = SensorHCSR04.objects.create(
-                timestamp_origin=tstp_origin,
-                timestamp_receive=tstp_receive,
-                mac=device_id,
-                distance=distance,
-            )
-            tx.save()
-        except Exception as e:
-            print(f'Failed saving transmission with error: {str(e)}')
+    if kind == ESP:
+        _, tstp_origin, ldr, temp, pressure, moisture = data
+        writer.put(ESPTransmission(
+            timestamp_origin=tstp_origin,
+            timestamp_receive=tstp_receive,
+            device=device,
+            ldr_sensor=ldr,
+            temperature_sensor=temp,
+            pressure=pressure,
+            moisture=moisture
+        ))
+
+    elif kind == HCSR04:
+        _, tstp_origin, distance = data
+        writer.put(SensorHCSR04(
+            device=device,
+            timestamp_origin=tstp_origin,
+            timestamp_receive=tstp_receive,
+            distance=distance,
+        ))
 
 
 broker_address= CONFIG['MQTT_HOST']
@@ -72,18 +165,52 @@ except Exception as e:
     topic = topic
 
 print(topic)
-mqtt_client = mqttClient.Client(CONFIG['MQTT_CLIENT'])
-mqtt_client.on_connect = on_connect
-mqtt_client.on_message = on_message
 
 
-def subscribe():
+def create_client(client_id, protocol=mqttClient.MQTTv311):
+    client = mqttClient.Client(client_id, protocol=protocol)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    return client
+
+
+mqtt_client = create_client(CONFIG['MQTT_CLIENT'])
+
+
+def subscribe(client_id=None, group=None, worker_partition=None, worker=(0, 1),
+              **writer_options):
+    """
+    Consume transmissions until the connection is closed.
+
+    `group` subscribes through an MQTT v5 shared subscription and
+    `worker_partition`, an (index, count) tuple, drops the devices hashed
+    to other workers. Both are used by the multi process mode of mqtt_sub,
+    which passes the (index, count) of the `worker` naming its shared hot
+    window segments.
+    """
+    global mqtt_client, partition, shared_group
+    partition = worker_partition
+    shared_group = group
+    if client_id is not None or group:
+        mqtt_client = create_client(
+            client_id or CONFIG['MQTT_CLIENT'],
+            protocol=mqttClient.MQTTv5 if group else mqttClient.MQTTv311
+        )
+
+    if settings.HOT_WINDOW['SIZE'] and settings.HOT_WINDOW['SHARED_MEMORY']:
+        hotwindow.create_shared(*worker)
+    start_writer(**writer_options)
     mqtt_client.connect(
         broker_address,
         port=port,
         keepalive=True
     )
-    mqtt_client.loop_forever()
+    try:
+        mqtt_client.loop_forever()
+    finally:
+        # flush whatever is still buffered before leaving
+        writer.stop()
+        hotwindow.close_shared()
 
     # Wait connection to mqtt roker suceeds
     while not mqtt_connected:    #Wait for connection
@@ -1,3 +1,231 @@
-from django.shortcuts import render
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
+from time import perf_counter
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import (HttpResponse, HttpResponseBadRequest, HttpResponseNotFound,
+                         StreamingHttpResponse)
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.http import require_GET
+from graphene_django.views import GraphQLView
+from graphql.error import GraphQLError
+from graphql.execution import ExecutionResult
+from greenhouse import export, graphql_cache
+from greenhouse.metrics import CONTENT_TYPE, registry
+from greenhouse.models import Device, ESPTransmission, SensorHCSR04
+from greenhouse.routers import replica_reads
+from greenhouse.timeseries import transmission_model
 
-# Create your views here.
+
+RESULT_CACHE = registry.counter(
+    'greenhouse_graphql_result_cache_total',
+    'GraphQL result cache lookups by outcome.'
+)
+PERSISTED_QUERIES = registry.counter(
+    'greenhouse_graphql_persisted_queries_total',
+    'Persisted query lookups by outcome.'
+)
+
+graphql_executor = ThreadPoolExecutor(
+    max_workers=settings.GRAPHQL_THREAD_POOL_SIZE,
+    thread_name_prefix='graphql'
+)
+
+
+class TimingGraphQLView(GraphQLView):
+    """
+    GraphQLView adding an `extensions.timing` block, with the resolvers and
+    loader batches recorded by TimingMiddleware, to responses of requests
+    sending the X-GraphQL-Timing header when settings.GRAPHQL_TIMING_EXTENSIONS
+    is enabled.
+    """
+    def get_response(self, request, data, show_graphiql=False):
+        if not (settings.GRAPHQL_TIMING_EXTENSIONS and request.META.get('HTTP_X_GRAPHQL_TIMING')):
+            return super().get_response(request, data, show_graphiql)
+
+        request.graphql_timing = []
+        start = perf_counter()
+        result, status_code = super().get_response(request, data, show_graphiql)
+        if result is None:
+            return result, status_code
+
+        response = json.loads(result)
+        response['extensions'] = {
+            'timing': {
+                'duration_ms': (perf_counter() - start) * 1000,
+                'resolvers': request.graphql_timing,
+            },
+        }
+        return self.json_encode(request, response, pretty=show_graphiql), status_code
+
+
+class CachedGraphQLView(TimingGraphQLView):
+    """
+    GraphQLView serving persisted queries and cached results, see
+    greenhouse.graphql_cache. Query operations read from the replica
+    database, mutations from the primary so they see their own writes.
+    """
+    def get_backend(self, request):
+        return graphql_cache.backend
+
+    def execute_graphql_request(self, request, data, query, variables,
+                                operation_name, show_graphiql=False):
+        sha256 = graphql_cache.persisted_query_hash(data)
+        if sha256 and query:
+            if graphql_cache.query_hash(query) != sha256:
+                return ExecutionResult(
+                    errors=[GraphQLError('provided sha does not match query')],
+                    invalid=True
+                )
+            PERSISTED_QUERIES.inc(outcome='registered')
+        elif sha256:
+            document = graphql_cache.backend.get(sha256)
+            if document is None:
+                PERSISTED_QUERIES.inc(outcome='not_found')
+                return ExecutionResult(errors=[GraphQLError('PersistedQueryNotFound')])
+            PERSISTED_QUERIES.inc(outcome='hit')
+            query = document.document_string
+
+        execute = lambda: super(CachedGraphQLView, self).execute_graphql_request(
+            request, data, query, variables, operation_name, show_graphiql
+        )
+        if not query:
+            return execute()
+
+        try:
+            document = graphql_cache.backend.document_from_string(self.schema, query)
+            operation = document.get_operation_type(operation_name)
+        except Exception:
+            # let the view report the error
+            operation = None
+        if operation != 'query':
+            return execute()
+
+        with replica_reads():
+            if not settings.GRAPHQL_RESULT_CACHE_TTL:
+                return execute()
+
+            key = graphql_cache.result_cache_key(document.sha256, variables, operation_name)
+            cached = graphql_cache.get_cached_result(key)
+            if cached is not None:
+                RESULT_CACHE.inc(outcome='hit')
+                return ExecutionResult(data=cached)
+
+            RESULT_CACHE.inc(outcome='miss')
+            graphql_cache.start_tracking(request)
+            result = execute()
+            if result is not None and not result.errors and not result.invalid:
+                graphql_cache.set_cached_result(key, result.data, request.graphql_dependencies)
+            return result
+
+
+def metrics_view(request):
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)
+
+
+EXPORT_MODELS = {
+    'esp': ESPTransmission,
+    'hcsr04': SensorHCSR04,
+}
+
+
+def _timestamp(value):
+    if value is None:
+        return None
+    if value.lstrip('-').isdigit():
+        return int(value)
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f'Invalid date {value}')
+    if parsed.tzinfo is None:
+        # not the local time of the server
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+@require_GET
+def export_transmissions(request):
+    """
+    Stream transmissions of a device (`device`), or of every device of a
+    `model` (esp or hcsr04), from an optional `start` included to an
+    optional `end` excluded (timestamps or ISO dates, UTC unless they say
+    otherwise) as csv, ndjson or parquet (`format`).
+    """
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in export.EXPORT_FORMATS:
+        return HttpResponseBadRequest(
+            f'Invalid format, choose one of {", ".join(export.EXPORT_FORMATS)}'
+        )
+    if export_format == 'parquet' and export.pyarrow is None:
+        return HttpResponseBadRequest('Parquet export requires pyarrow')
+
+    device = None
+    device_id = request.GET.get('device')
+    if device_id:
+        try:
+            device = Device.objects.get(device_id=device_id)
+        except Device.DoesNotExist:
+            return HttpResponseNotFound('Device not found')
+        model = transmission_model(device.hardware_type)
+    elif request.GET.get('model') in EXPORT_MODELS:
+        model = EXPORT_MODELS[request.GET['model']]
+    else:
+        return HttpResponseBadRequest(
+            f'Either device or model ({", ".join(EXPORT_MODELS)}) is required'
+        )
+
+    try:
+        start = _timestamp(request.GET.get('start'))
+        end = _timestamp(request.GET.get('end'))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    columns = export.export_columns(model)
+    # the rows are read while the response streams, possibly outside this
+    # thread, so the replica is selected explicitly
+    rows = export.export_rows(model, device, start, end, using=settings.REPLICA_DATABASE)
+    if export_format == 'parquet':
+        # typed from the model, so every row group and an empty export agree
+        columns = export.parquet_schema(model, columns)
+    response = StreamingHttpResponse(
+        export.STREAMS[export_format](columns, rows),
+        content_type=export.EXPORT_FORMATS[export_format]
+    )
+    name = (device_id or request.GET['model']).replace(':', '')
+    response['Content-Disposition'] = f'attachment; filename="transmissions-{name}.{export_format}"'
+    return response
+
+
+def _run_view(view, request, args, kwargs):
+    close_old_connections()
+    try:
+        return view(request, *args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+def async_graphql_view(**initkwargs):
+    """
+    GraphQL view for the ASGI application. The request is accepted on the
+    event loop while parsing, resolvers and database work run in a bounded
+    thread pool (settings.GRAPHQL_THREAD_POOL_SIZE), so slow queries do not
+    hold the loop and the pool size caps concurrent database connections.
+    """
+    view = CachedGraphQLView.as_view(**initkwargs)
+
+    async def graphql_view(request, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            graphql_executor,
+            _run_view,
+            view,
+            request,
+            args,
+            kwargs
+        )
+
+    # csrf_exempt would wrap the coroutine into a sync function
+    graphql_view.csrf_exempt = True
+    return graphql_view
@@ -0,0 +1,164 @@
+"""
+Supervisor of the multi process mode of `mqtt_sub`.
+
+Each worker is a spawned process with its own MQTT client, database
+connection and BatchWriter. Messages are spread over the workers either by
+the broker, through an MQTT v5 shared subscription (`shared`), or by every
+worker receiving everything and keeping only the devices hashed to it
+(`hash`), which keeps the transmissions of a device in order.
+
+This module is imported before Django is set up in the spawned processes,
+so Django and the ingest code are only imported inside the workers.
+"""
+import multiprocessing
+import os
+import signal
+from time import monotonic, sleep
+
+
+SHARDING_MODES = ('shared', 'hash')
+
+
+def run_worker(index, count, sharding, group, client_id, writer_options,
+               metrics_port=None):
+    """
+    Entry point of an ingest worker process. Its metrics are served on
+    `metrics_port` + `index`.
+    """
+    from greenhouse.metrics import serve_metrics
+    from greenhouse.transmission_parser import subscribe
+
+    if metrics_port:
+        serve_metrics(metrics_port + index)
+
+    # leave the MQTT loop like on Ctrl-C so the writer gets flushed
+    signal.signal(signal.SIGTERM, _interrupt)
+
+    subscribe(
+        client_id=f'{client_id or "greenhouse"}-{index}',
+        group=group if sharding == 'shared' else None,
+        worker_partition=(index, count) if sharding == 'hash' else None,
+        worker=(index, count),
+        **writer_options
+    )
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def setup_django():
+    """
+    Set Django up in a spawned process.
+    """
+    import django
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'iot_api.settings')
+    django.setup()
+
+
+def _bootstrap(target, args):
+    from django.utils.module_loading import import_string
+
+    setup_django()
+    import_string(target)(*args)
+
+
+class Supervisor:
+    """
+    Runs `count` worker processes calling the function at the dotted path
+    `target` with (index, count, *args) and restarts the ones that die.
+    A worker dying again within `min_uptime` seconds is restarted after a
+    delay doubling up to `max_delay`.
+    """
+    def __init__(self, count, target='greenhouse.workers.run_worker', args=(),
+                 min_uptime=10.0, max_delay=30.0, poll_interval=0.5):
+        self.count = count
+        self.target = target
+        self.args = tuple(args)
+        self.min_uptime = min_uptime
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.restarts = 0
+        self._context = multiprocessing.get_context('spawn')
+        self._processes = {}
+        self._started = {}
+        self._delays = {}
+        self._restart_at = {}
+        self._stopping = False
+
+    def start(self):
+        for index in range(self.count):
+            self._spawn(index)
+
+    def _spawn(self, index):
+        process = self._context.Process(
+            target=_bootstrap,
+            args=(self.target, (index, self.count, *self.args)),
+            name=f'mqtt-worker-{index}',
+            daemon=True
+        )
+        process.start()
+        self._processes[index] = process
+        self._started[index] = monotonic()
+
+    def check(self):
+        """
+        Restart dead workers whose delay has passed. Returns the number of
+        workers alive.
+        """
+        now = monotonic()
+        for index, process in self._processes.items():
+            if process.is_alive() or self._stopping:
+                continue
+
+            if index not in self._restart_at:
+                if now - self._started[index] < self.min_uptime:
+                    delay = min(self._delays.get(index, 0.5) * 2, self.max_delay)
+                else:
+                    delay = 0
+                self._delays[index] = delay or 0.5
+                self._restart_at[index] = now + delay
+                print(
+                    f'Worker {index} exited with code {process.exitcode}, '
+                    f'restarting in {delay:.1f}s'
+                )
+
+            if now >= self._restart_at[index]:
+                del self._restart_at[index]
+                process.join()
+                self._spawn(index)
+                self.restarts += 1
+
+        return sum(1 for process in self._processes.values() if process.is_alive())
+
+    def run(self, duration=None):
+        """
+        Supervise the workers until interrupted or `duration` seconds passed.
+        """
+        self.start()
+        deadline = None if duration is None else monotonic() + duration
+        try:
+            while deadline is None or monotonic() < deadline:
+                self.check()
+                sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self, timeout=10.0):
+        """
+        Ask the workers to stop, so they flush their writers, and kill the
+        ones still running after `timeout` seconds.
+        """
+        self._stopping = True
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = monotonic() + timeout
+        for process in self._processes.values():
+            process.join(max(deadline - monotonic(), 0))
+            if process.is_alive():
+                process.kill()
+                process.join()
@@ -1,9 +1,7 @@
 import os
 
-from channels.routing import ProtocolTypeRouter
-from django.core.asgi import get_asgi_application
 import django
-from channels.routing import get_default_application
+from channels.routing import ProtocolTypeRouter
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'iot_api.settings')
 # Initialize Django ASGI application early to ensure the AppRegistry
@@ -11,11 +9,16 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'iot_api.settings')
 
 django.setup()
 
-application = get_default_application()
+from channels.routing import URLRouter  # noqa: E402
+from django.core.asgi import get_asgi_application  # noqa: E402
+from django.urls import path  # noqa: E402
+from graphql_ws.django.consumers import GraphQLSubscriptionConsumer  # noqa: E402
 
-# django_asgi_app = get_asgi_application()
+django_asgi_app = get_asgi_application()
 
-# application = ProtocolTypeRouter({
-#     "http": django_asgi_app,
-#     'websocket': django_asgi_app
-# })
+application = ProtocolTypeRouter({
+    'http': django_asgi_app,
+    'websocket': URLRouter([
+        path('subscriptions', GraphQLSubscriptionConsumer.as_asgi()),
+    ]),
+})
@@ -9,7 +9,12 @@ class Mutation(greenhouse.schema.Mutation, graphene.ObjectType):
     pass
 
 
+class Subscription(greenhouse.schema.Subscription, graphene.ObjectType):
+    pass
+
+
 schema = graphene.Schema(
     query=Query,
     mutation=Mutation,
+    subscription=Subscription,
 )
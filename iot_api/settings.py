@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 
 import os
 import uuid
+from django.core.exceptions import ImproperlyConfigured
 # import django
 # from django.utils.encoding import force_str
 # django.utils.encoding.force_text = force_str
@@ -88,17 +89,70 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'iot_api.wsgi.application'
+ASGI_APPLICATION = 'iot_api.asgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/2.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# DATABASE_PROFILE selects the database:
+#   sqlite: a local file in WAL mode, so the ingest process and the
+#       GraphQL server do not block each other's reads (SQLITE_PRAGMAS
+#       are applied to every connection by greenhouse.database);
+#   postgresql: the POSTGRES_* server with persistent connections, the
+#       transmission tables become TimescaleDB hypertables when
+#       TIMESCALEDB is set before migrating, otherwise get BRIN indexes.
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'sqlite')
+
+if DATABASE_PROFILE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'greenhouse'),
+            'USER': os.environ.get('POSTGRES_USER', 'greenhouse'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': int(os.environ.get('CONN_MAX_AGE', 60)),
+        }
+    }
+elif DATABASE_PROFILE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('SQLITE_PATH', os.path.join(BASE_DIR, 'db.sqlite3')),
+            # tests and benchmarks use an in-memory database unless set
+            'TEST': {'NAME': os.environ.get('SQLITE_TEST_PATH')},
+        }
     }
+else:
+    raise ImproperlyConfigured(
+        f'Invalid DATABASE_PROFILE {DATABASE_PROFILE}, choose sqlite or postgresql'
+    )
+
+# Optional PostgreSQL read replica, GraphQL queries and exports read
+# greenhouse data from it while the ingest and mutations use the primary
+# (see greenhouse.routers). It may lag a little behind the primary.
+if DATABASE_PROFILE == 'postgresql' and os.environ.get('POSTGRES_REPLICA_HOST'):
+    DATABASES['replica'] = dict(
+        DATABASES['default'],
+        HOST=os.environ['POSTGRES_REPLICA_HOST'],
+        PORT=os.environ.get('POSTGRES_REPLICA_PORT', DATABASES['default']['PORT']),
+        TEST={'MIRROR': 'default'},
+    )
+REPLICA_DATABASE = 'replica' if 'replica' in DATABASES else 'default'
+DATABASE_ROUTERS = ['greenhouse.routers.ReplicaRouter']
+
+SQLITE_PRAGMAS = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'wal'),
+    # durable at checkpoints only, a power loss can lose the last commits
+    'synchronous': 'normal',
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    # milliseconds a writer waits for the lock before "database is locked"
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
 }
 
+TIMESCALEDB = os.environ.get('TIMESCALEDB', '').lower() in ('1', 'true', 'yes')
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
@@ -140,6 +194,31 @@ STATIC_URL = '/static/'
 
 GRAPHENE = {
     'SCHEMA': 'iot_api.schema.schema',
+    # set explicitly: graphene_django adds DjangoDebugMiddleware by default
+    # in DEBUG, whose cursor wrapper stays on connections without a _debug
+    # field in the schema
+    'MIDDLEWARE': [
+        'greenhouse.middleware.TimingMiddleware',
+    ],
+}
+
+# Add resolver timings to responses of requests with the X-GraphQL-Timing header
+GRAPHQL_TIMING_EXTENSIONS = os.environ.get(
+    'GRAPHQL_TIMING_EXTENSIONS',
+    str(DEBUG)
+).lower() in ('1', 'true', 'yes')
+
+# Persisted queries and result cache (see greenhouse.graphql_cache). The
+# result cache is disabled with a TTL of 0; its invalidation from mqtt_sub
+# needs a cache shared between processes.
+GRAPHQL_DOCUMENT_CACHE_SIZE = int(os.environ.get('GRAPHQL_DOCUMENT_CACHE_SIZE', 256))
+GRAPHQL_RESULT_CACHE_TTL = int(os.environ.get('GRAPHQL_RESULT_CACHE_TTL', 0))
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
 }
 
 MQTT_CONFIG = {
@@ -151,3 +230,70 @@ MQTT_CONFIG = {
 
 HCSR_DEVICE = os.environ.get('HCSR_DEVICE')
 LDR_DEVICE = os.environ.get('LDR_DEVICE')
+
+# Buffered ingestion of MQTT transmissions (see greenhouse.ingest.BatchWriter)
+INGEST_CONFIG = {
+    'BATCH_SIZE': int(os.environ.get('INGEST_BATCH_SIZE', 500)),
+    'FLUSH_INTERVAL': float(os.environ.get('INGEST_FLUSH_INTERVAL', 0.25)),
+    'QUEUE_SIZE': int(os.environ.get('INGEST_QUEUE_SIZE', 10000)),
+    'OVERFLOW': os.environ.get('INGEST_OVERFLOW', 'block'),
+    # keys of the last transmissions remembered to drop QoS 1 redeliveries
+    # without a database lookup, 0 disables it
+    'RECENT_KEYS': int(os.environ.get('INGEST_RECENT_KEYS', 10000)),
+}
+
+# Last transmissions of every device kept in memory by the ingest for
+# last_transmission and recent connections (see greenhouse.hotwindow), 0
+# disables it. Without SHARED_MEMORY they only serve the ingest process;
+# with it mqtt_sub writes them to shared memory segments of that name read
+# by the web server on the same host. DEVICES is the number of device
+# slots per model.
+HOT_WINDOW = {
+    'SIZE': int(os.environ.get('HOT_WINDOW_SIZE', 0)),
+    'SHARED_MEMORY': os.environ.get('HOT_WINDOW_SHARED_MEMORY', ''),
+    'DEVICES': int(os.environ.get('HOT_WINDOW_DEVICES', 1024)),
+}
+
+# Keyset pagination of transmission connections
+TRANSMISSION_PAGE_SIZE = int(os.environ.get('TRANSMISSION_PAGE_SIZE', 100))
+TRANSMISSION_MAX_PAGE_SIZE = int(os.environ.get('TRANSMISSION_MAX_PAGE_SIZE', 1000))
+TRANSMISSION_MAX_BUCKETS = int(os.environ.get('TRANSMISSION_MAX_BUCKETS', 10000))
+
+# Days prune_transmissions keeps raw transmissions and 1 minute rollups,
+# 0 keeps them forever. Hour and day rollups are always kept.
+TRANSMISSION_RETENTION_DAYS = {
+    'esp': int(os.environ.get('ESP_RETENTION_DAYS', 0)),
+    'hcsr04': int(os.environ.get('HCSR04_RETENTION_DAYS', 0)),
+    'minute_rollups': int(os.environ.get('MINUTE_ROLLUP_RETENTION_DAYS', 0)),
+}
+# Where pruned transmissions are archived, read back by the export
+TRANSMISSION_ARCHIVE_DIR = os.environ.get(
+    'TRANSMISSION_ARCHIVE_DIR',
+    os.path.join(BASE_DIR, 'archive')
+)
+
+# Incremental per device cache of hour of day statistics
+HOUR_STATISTICS_CACHE = {
+    'MAX_ENTRIES': int(os.environ.get('HOUR_STATISTICS_CACHE_ENTRIES', 256)),
+    'TTL': int(os.environ.get('HOUR_STATISTICS_CACHE_TTL', 3600)),
+}
+
+# Threads running GraphQL requests received by the async view
+GRAPHQL_THREAD_POOL_SIZE = int(os.environ.get('GRAPHQL_THREAD_POOL_SIZE', 8))
+
+# Channel layer carrying new transmissions from mqtt_sub to the ASGI server.
+# The in-memory layer only reaches subscriptions within the same process:
+# when mqtt_sub and daphne run apart, subscriptions only receive new
+# transmissions with CHANNEL_LAYER_REDIS_URL set (e.g. redis://localhost:6379),
+# which needs channels_redis.
+if os.environ.get('CHANNEL_LAYER_REDIS_URL'):
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {'hosts': [os.environ['CHANNEL_LAYER_REDIS_URL']]},
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'},
+    }
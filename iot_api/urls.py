@@ -15,10 +15,14 @@ Including another URLconf
 """
 from django.urls import path
 from django.views.decorators.csrf import csrf_exempt
-from graphene_django.views import GraphQLView
+from greenhouse.views import (CachedGraphQLView, async_graphql_view, export_transmissions,
+                             metrics_view)
 
 
 
 urlpatterns = [
-    path('graphql/', csrf_exempt(GraphQLView.as_view(graphiql=True))),
+    path('graphql/', csrf_exempt(CachedGraphQLView.as_view(graphiql=True))),
+    path('graphql/async/', async_graphql_view(graphiql=True)),
+    path('metrics', metrics_view),
+    path('export/transmissions', export_transmissions),
 ]